@@ -0,0 +1,320 @@
+'''
+File: backfill.py
+
+Index (or re-index) objects that are already in the bucket, e.g., for an existing bucket, to rebuild the index,
+or after a configuration change such as a new dataFilenameRegex.
+
+The keyspace is split by prefix and the shards are listed in parallel. Each listed object is run through the
+same metadata.extract_attributes pipeline as an S3 event on a pool of worker threads, and the results are indexed
+with bulk requests. Progress is checkpointed to a file after every page of objects, so an interrupted backfill
+resumes where it left off instead of starting over.
+
+With --from-shadow (e.g., to recover a lost index), the documents are rebuilt from the HEAD of each object when its
+S3 user metadata is a shadow copy of its metadata (see objectmeta.ShadowMarker), so no bodies or companion metadata
+files are read. Only the objects without a shadow copy go through the full extraction.
+
+Usage:
+    python -m backfill [--prefix data/] [--listers 8] [--workers 32] [--checkpoint backfill_checkpoint.json] [--restart] [--from-shadow]
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import logging
+import argparse
+import threading
+import json
+import os
+import time
+import configutils
+import metadata
+import metafile
+import objectmeta
+import filenamemeta
+import indexbackend
+import retryqueue
+from multiprocessing.pool import ThreadPool
+
+DefaultCheckpointFile = 'backfill_checkpoint.json'
+PageSize = 1000 # Max keys per list_objects_v2 page (the S3 maximum) and so also the most per bulk request
+
+def get_shards(s3, bucket, prefix, minShards, maxDepth=3):
+    '''
+    Split the keyspace under prefix into shards that can be listed independently.
+
+    A shard is a dictionary with a 'prefix' and a 'delimiter'. A shard with a '/' delimiter only covers the keys
+    directly under its prefix (not those in "sub-directories"); a shard with an empty delimiter covers everything
+    under its prefix. "Directories" are split out into their own shards, one level at a time, until there are at least
+    minShards shards or maxDepth levels have been split.
+
+    Returns: list of shards, sorted by prefix
+    '''
+    shards = [{'prefix': prefix, 'delimiter': ''}]
+    for depth in range(maxDepth):
+        if len(shards) >= minShards:
+            break
+        splitShards = []
+        for shard in shards:
+            if shard['delimiter'] != '':
+                splitShards.append(shard)
+                continue
+            splitShards.append({'prefix': shard['prefix'], 'delimiter': '/'})
+            paginator = s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, Prefix=shard['prefix'], Delimiter='/'):
+                splitShards.extend({'prefix': commonPrefix['Prefix'], 'delimiter': ''} for commonPrefix in page.get('CommonPrefixes', []))
+        if splitShards == shards:
+            break # Nothing left to split
+        shards = splitShards
+    return sorted(shards, key=lambda shard: (shard['prefix'], shard['delimiter']))
+
+def get_shard_id(shard):
+    return shard['prefix'] + '|' + shard['delimiter']
+
+class Checkpoint(object):
+    '''
+    Durable record of the progress of a backfill, saved as json to fileName.
+
+    For each shard, records the last key that has been indexed (startAfter) and whether the shard is done.
+    The file is replaced atomically (write to a temporary file and rename) so a crash never leaves it half written.
+    '''
+    def __init__(self, fileName, bucket):
+        self.fileName = fileName
+        self.lock = threading.Lock()
+        self.state = {'bucket': bucket, 'shards': None, 'progress': {}, 'indexed': 0, 'failed': 0}
+
+    def load(self):
+        ''' Returns: True if an existing checkpoint for the same bucket was loaded '''
+        if not os.path.exists(self.fileName):
+            return False
+        with open(self.fileName, 'r') as f:
+            state = json.loads(f.read())
+        if state['bucket'] != self.state['bucket']:
+            raise ValueError('Checkpoint file {} is for bucket {}'.format(self.fileName, state['bucket']))
+        self.state = state
+        return True
+
+    def save(self):
+        tmpFileName = self.fileName + '.tmp'
+        with open(tmpFileName, 'w') as f:
+            f.write(json.dumps(self.state, indent=4))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpFileName, self.fileName)
+
+    def get_shards(self):
+        return self.state['shards']
+
+    def set_shards(self, shards):
+        with self.lock:
+            self.state['shards'] = shards
+            self.save()
+
+    def get_progress(self, shard):
+        return self.state['progress'].get(get_shard_id(shard), {'startAfter': '', 'done': False})
+
+    def update(self, shard, lastKey, done, indexed, failed):
+        with self.lock:
+            self.state['progress'][get_shard_id(shard)] = {'startAfter': lastKey, 'done': done}
+            self.state['indexed'] += indexed
+            self.state['failed'] += failed
+            self.save()
+
+class Backfill(object):
+    '''
+    Lists the bucket shard by shard (listers shards at a time) and extracts and indexes the objects on a pool
+    of workers threads. Uses the habitat configs, except that companion metadata files are always looked up
+    from the data file (as in written_first mode) since the data files are what is listed.
+    If fromShadow, objects with a shadow copy of their metadata are indexed from their HEAD alone.
+    '''
+    def __init__(self, configs, checkpoint, listers=8, workers=32, fromShadow=False):
+        self.configs = dict(configs)
+        if self.configs.get('metafileMode', 'disable') == 'written_last':
+            self.configs['metafileMode'] = 'written_first'
+        self.bucket = configs['bucket']
+        self.checkpoint = checkpoint
+        self.listers = listers
+        self.workers = workers
+        self.fromShadow = fromShadow
+        self.workerPool = None
+
+    def run(self, prefix):
+        ''' Returns: (number of objects indexed, number of objects that failed) in total, including earlier runs '''
+        if self.checkpoint.load() and self.checkpoint.get_shards() is not None:
+            logging.info('Resuming backfill from checkpoint ' + self.checkpoint.fileName)
+        else:
+            self.checkpoint.set_shards(get_shards(metadata.get_s3(), self.bucket, prefix, self.listers))
+        shards = [shard for shard in self.checkpoint.get_shards() if not self.checkpoint.get_progress(shard)['done']]
+        logging.info('Backfilling {} shards of bucket {}'.format(len(shards), self.bucket))
+
+        startTime = time.time()
+        self.workerPool = ThreadPool(self.workers)
+        listerPool = ThreadPool(self.listers)
+        try:
+            listerPool.map(self.run_shard, shards, chunksize=1)
+        finally:
+            listerPool.close()
+            self.workerPool.close()
+
+        state = self.checkpoint.state
+        logging.info('Backfill complete in {:.1f} seconds. Indexed: {} Failed: {}'.format(
+            time.time() - startTime, state['indexed'], state['failed']))
+        return (state['indexed'], state['failed'])
+
+    def run_shard(self, shard):
+        ''' List the shard a page at a time, starting after the checkpointed key, and index each page '''
+        startAfter = self.checkpoint.get_progress(shard)['startAfter']
+        paginator = metadata.get_s3().get_paginator('list_objects_v2')
+        listArgs = {'Bucket': self.bucket, 'Prefix': shard['prefix'], 'PaginationConfig': {'PageSize': PageSize}}
+        if shard['delimiter'] != '':
+            listArgs['Delimiter'] = shard['delimiter']
+        if startAfter != '':
+            listArgs['StartAfter'] = startAfter
+        pages = paginator.paginate(**listArgs)
+        for page in pages:
+            items = page.get('Contents', [])
+            if len(items) > 0:
+                (indexed, failed) = self.index_items(items)
+                startAfter = items[-1]['Key']
+                self.checkpoint.update(shard, startAfter, False, indexed, failed)
+        self.checkpoint.update(shard, startAfter, True, 0, 0)
+        logging.info('Shard {} complete'.format(get_shard_id(shard)))
+
+    def index_items(self, items):
+        ''' Extract the attributes for one page of listed objects in parallel and index them with one bulk request '''
+        resolver = metafile.CompanionResolver(metadata.get_s3(), self.configs)
+        def extract(item):
+            attributes = {
+                    'region': self.configs['region'],
+                    'bucket': self.bucket,
+                    'key': item['Key'],
+                    'size': item['Size']
+                    }
+            try:
+                if self.fromShadow and self.extract_from_shadow(attributes):
+                    return attributes
+                return metadata.extract_attributes(attributes, self.configs, resolver)
+            except Exception as e:
+                logging.error(e)
+                logging.error('Error extracting attributes for key ' + item['Key'])
+                return None
+        attributesList = self.workerPool.map(extract, items)
+        objectIds = metadata.save_attributes_batch(attributesList, indexbackend.get_backend(self.configs), retryqueue.get_retry_queue(self.configs))
+        indexed = len([objectId for objectId in objectIds if objectId is not None])
+        return (indexed, len(items) - indexed)
+
+    def extract_from_shadow(self, attributes):
+        '''
+        Add the attributes from the key and from the HEAD of the object if it has a shadow copy of its metadata,
+        in the same order of precedence as metadata.extract_attributes.
+
+        Returns: True if the object has a shadow copy (and attributes were added)
+        '''
+        shadowAttributes = objectmeta.get_attributes_from_shadow(metadata.get_s3(), attributes['bucket'], attributes['key'],
+                self.configs.get('inspectS3head', False))
+        if shadowAttributes is None:
+            return False
+        router = filenamemeta.get_router(self.configs)
+        if router is not None:
+            attributes.update(router.get_attributes(attributes['key']) or {})
+        attributes.update(shadowAttributes)
+        return True
+
+def main():
+    parser = argparse.ArgumentParser(description='Index the objects that are already in the habitat bucket')
+    parser.add_argument('--prefix', default=None, help='Only index keys with this prefix (default: the data prefix, data/)')
+    parser.add_argument('--listers', type=int, default=8, help='Number of shards to list in parallel')
+    parser.add_argument('--workers', type=int, default=32, help='Number of objects to extract metadata from in parallel')
+    parser.add_argument('--checkpoint', default=DefaultCheckpointFile, help='Checkpoint file used to resume')
+    parser.add_argument('--restart', action='store_true', help='Ignore any existing checkpoint and start over')
+    parser.add_argument('--from-shadow', action='store_true', help='Index objects from the shadow copy of their metadata in the S3 object metadata where there is one')
+    args = parser.parse_args()
+
+    configs = configutils.load_configs()
+    prefix = args.prefix
+    if prefix is None:
+        prefix = configs.get('metafilePairing', {}).get('dataPrefix', 'data/')
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    backfill = Backfill(configs, Checkpoint(args.checkpoint, configs['bucket']), args.listers, args.workers, args.from_shadow)
+    (indexed, failed) = backfill.run(prefix)
+    print 'Indexed: {} Failed: {}'.format(indexed, failed)
+
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        self.configs = configutils.load_configs()
+        self.bucket = self.configs['bucket']
+        self.checkpointFile = 'unittest_backfill_checkpoint.json'
+        if os.path.exists(self.checkpointFile):
+            os.remove(self.checkpointFile)
+
+    def tearDown(self):
+        if os.path.exists(self.checkpointFile):
+            os.remove(self.checkpointFile)
+
+    def test_get_shards(self):
+        ''' Every key under the prefix is covered by exactly one shard '''
+        shards = get_shards(metadata.get_s3(), self.bucket, '', 2)
+        self.assertIn({'prefix': '', 'delimiter': '/'}, shards)
+        self.assertIn({'prefix': 'data/', 'delimiter': ''}, shards)
+        self.assertIn({'prefix': 'meta/', 'delimiter': ''}, shards)
+
+    def test_checkpoint(self):
+        shard = {'prefix': 'data/', 'delimiter': ''}
+        checkpoint = Checkpoint(self.checkpointFile, self.bucket)
+        self.assertFalse(checkpoint.load(), 'Expected no existing checkpoint')
+        checkpoint.set_shards([shard])
+        checkpoint.update(shard, 'data/b', False, 2, 1)
+
+        checkpoint = Checkpoint(self.checkpointFile, self.bucket)
+        self.assertTrue(checkpoint.load(), 'Expected the checkpoint to be loaded')
+        self.assertEqual(checkpoint.get_shards(), [shard])
+        self.assertEqual(checkpoint.get_progress(shard), {'startAfter': 'data/b', 'done': False})
+        self.assertEqual((checkpoint.state['indexed'], checkpoint.state['failed']), (2, 1))
+
+    def test_backfill(self):
+        ''' Backfill the unit test objects and then resume the completed backfill without indexing anything more '''
+        checkpoint = Checkpoint(self.checkpointFile, self.bucket)
+        (indexed, failed) = Backfill(self.configs, checkpoint, 2, 4).run('data/')
+        self.assertGreater(indexed, 0, 'Expected the unit test objects to be indexed')
+        self.assertEqual(failed, 0, 'Expected no failures')
+
+        checkpoint = Checkpoint(self.checkpointFile, self.bucket)
+        self.assertEqual(Backfill(self.configs, checkpoint, 2, 4).run('data/'), (indexed, failed), 'Expected nothing more to be indexed')
+
+    def test_backfill_from_shadow(self):
+        ''' Objects without a shadow copy fall back to the full extraction '''
+        checkpoint = Checkpoint(self.checkpointFile, self.bucket)
+        (indexed, failed) = Backfill(self.configs, checkpoint, 2, 4, fromShadow=True).run('data/')
+        self.assertGreater(indexed, 0, 'Expected the unit test objects to be indexed')
+        self.assertEqual(failed, 0, 'Expected no failures')
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    logFormat = '%(levelname)s:%(asctime)s:HABITAT:%(module)s-%(lineno)d: %(message)s'
+    logLevel = logging.INFO
+    logging.basicConfig(format=logFormat, level=logLevel)
+
+    main()
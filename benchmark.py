@@ -0,0 +1,348 @@
+'''
+File: benchmark.py
+
+Offline benchmarks of the indexing pipeline, so that performance changes can be measured reproducibly before
+deployment without an S3 bucket or an Elasticsearch domain.
+
+S3 and Elasticsearch are replaced by in-process stand-ins (StubS3 and StubES) that add a configurable latency to
+every call. The stages of the pipeline are timed on their own (the event attributes, the file name regexes, the
+json, csv and custom metadata file parsers, the body parser, the index write) and end to end through
+habitat_handler.event_handler for each permutation of inspectS3head, dataBodyParserMaxBytes and metafileMode.
+Index writes can also be timed against the embedded SQLite backend (sqlitebackend).
+
+For each benchmark the report has the number of operations per second and the 50th, 90th and 99th percentile and
+maximum latencies in milliseconds.
+
+Usage:
+    python -m benchmark [--iterations 200] [--s3-latency 0.005] [--es-latency 0.01] [--only handler] [--json]
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import logging
+import argparse
+import contextlib
+import itertools
+import datetime
+import json
+import time
+import io
+import botocore.exceptions
+import configutils
+import esutils
+import filenamemeta
+import metafile
+import metadata
+import objectmeta
+import pluginregistry
+import sqlitebackend
+import habitat_handler
+
+DefaultIterations = 200
+DefaultS3Latency = 0.005 # Seconds added to every S3 call
+DefaultESLatency = 0.01 # Seconds added to every Elasticsearch call
+StubEndpoint = 'benchmark.stub'
+Bucket = 'habitat-benchmark'
+DataKey = 'data/unittest-a1234-15-imager_1234567890.tif'
+MetaStem = 'meta/unittest-a1234-15-imager_1234567890'
+
+BaseConfigs = {
+        'region': 'us-east-1',
+        'bucket': Bucket,
+        'esEndpoint': StubEndpoint,
+        'esHabitatIndex': 'habitat-benchmark',
+        'esDocType': 'habitat',
+        'dataFilenameRegex': '^data/unittest-(?P<assayId>\\w+)-(?P<runId>\\d+)-\\w+.tif$',
+        'inspectS3head': True,
+        'getMetadataFromObject': True,
+        'metafileMode': 'disable',
+        'metafileFormat': 'json',
+        'metafileParserModule': 'defaultMetafileParser',
+        'dataBodyParserMaxBytes': 1024,
+        'dataBodyParserModule': 'defaultDataBodyParser',
+        }
+
+MetafileData = {
+        'json': json.dumps({'operator': 'jdoe', 'instrument': 'imager', 'plate': '7', 'wells': '384'}),
+        'csv': 'operator,instrument,plate,wells\njdoe,imager,7,384\n',
+        'custom': 'operator=jdoe\ninstrument=imager\nplate=7\nwells=384\n',
+        }
+
+class StubBody(object):
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, amount=None):
+        return self.stream.read() if amount is None else self.stream.read(amount)
+
+class StubPaginator(object):
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None):
+        yield self.s3.list_objects_v2(Bucket=Bucket, Prefix=Prefix, Delimiter=Delimiter)
+
+class StubS3(object):
+    ''' In-memory stand-in for the boto3 S3 client calls made while indexing. objects is a dictionary of key to bytes. '''
+    def __init__(self, objects, latency=DefaultS3Latency):
+        self.objects = objects
+        self.latency = latency
+        self.calls = 0
+
+    def call(self, key):
+        self.calls += 1
+        time.sleep(self.latency)
+        if key is not None and key not in self.objects:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey', 'Message': key}}, 'GetObject')
+
+    def get_head(self, data):
+        return {'LastModified': datetime.datetime(2016, 3, 26, 12, 0, 0), 'ContentLength': len(data),
+                'ContentType': 'image/tiff', 'ETag': '"0123456789abcdef"', 'Metadata': {'operator': 'jdoe'}}
+
+    def head_object(self, Bucket, Key):
+        self.call(Key)
+        return self.get_head(self.objects[Key])
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.call(Key)
+        data = self.objects[Key]
+        response = self.get_head(data)
+        if Range is not None:
+            (start, end) = Range[len('bytes='):].split('-')
+            (start, end) = (int(start), min(int(end), len(data) - 1))
+            response['ContentRange'] = 'bytes {}-{}/{}'.format(start, end, len(data))
+            data = data[start:end + 1]
+        response['ContentLength'] = len(data)
+        response['Body'] = StubBody(data)
+        return response
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, MaxKeys=1000):
+        self.call(None)
+        keys = [key for key in sorted(self.objects) if key.startswith(Prefix) and not (Delimiter and Delimiter in key[len(Prefix):])]
+        return {'Contents': [{'Key': key, 'Size': len(self.objects[key])} for key in keys[:MaxKeys]]}
+
+    def get_paginator(self, operation):
+        return StubPaginator(self)
+
+class StubES(object):
+    ''' Stand-in for the Elasticsearch client calls made while indexing. Requests are serialized as the client would. '''
+    def __init__(self, latency=DefaultESLatency):
+        self.latency = latency
+        self.calls = 0
+
+    def call(self, body):
+        self.calls += 1
+        json.dumps(body, default=str)
+        time.sleep(self.latency)
+
+    def index(self, index, doc_type, id, body, **kwargs):
+        self.call(body)
+        return {'_id': id, 'created': True}
+
+    def bulk(self, body, **kwargs):
+        self.call(body)
+        return {'errors': False, 'items': [{action.keys()[0]: {'_id': action.values()[0]['_id'], 'status': 201}}
+                for action in body if action.keys()[0] in ('index', 'update', 'delete')]}
+
+    def search(self, index, body, **kwargs):
+        self.call(body)
+        return {'hits': {'hits': []}}
+
+    def mget(self, body, **kwargs):
+        self.call(body)
+        return {'docs': [{'_id': doc['_id'], 'found': False} for doc in body['docs']]}
+
+def get_objects():
+    ''' Returns: the objects of the stub bucket, a data file and its companion metadata file in every format '''
+    with open('unittest-sampledata.tif', 'rb') as f:
+        data = f.read()
+    objects = {DataKey: data}
+    for (metafileFormat, metafileData) in MetafileData.items():
+        objects[MetaStem + '.' + metafileFormat] = metafileData
+    return objects
+
+def get_event(key, size):
+    return {'Records': [{
+            'eventName': 'ObjectCreated:Put',
+            'awsRegion': 'us-east-1',
+            'userIdentity': {'principalId': 'AWS:BENCHMARK'},
+            's3': {'bucket': {'name': Bucket}, 'object': {'key': key, 'size': size, 'sequencer': '0055AED6DCD90281E5'}}
+            }]}
+
+@contextlib.contextmanager
+def stubbed(configs, s3, es):
+    ''' Route the pipeline's S3 and Elasticsearch calls (and the handler's configs) to the stand-ins '''
+    (savedS3, savedGetConfigs) = (metadata.s3, configutils.get_configs)
+    savedES = esutils.esClients.get(StubEndpoint, None)
+    metadata.s3 = s3
+    configutils.get_configs = lambda: configs
+    esutils.esClients[StubEndpoint] = es
+    try:
+        yield
+    finally:
+        metadata.s3 = savedS3
+        configutils.get_configs = savedGetConfigs
+        if savedES is None:
+            esutils.esClients.pop(StubEndpoint, None)
+        else:
+            esutils.esClients[StubEndpoint] = savedES
+
+def get_percentile(sortedTimes, percent):
+    ''' Nearest rank percentile of a sorted list '''
+    return sortedTimes[max(0, int(round(percent / 100.0 * len(sortedTimes))) - 1)]
+
+def measure(name, operation, iterations):
+    '''
+    Call operation() iterations times (after one untimed warm up call).
+
+    Returns: dictionary of the name, iterations, operations per second and latency percentiles in milliseconds
+    '''
+    operation()
+    times = []
+    startTime = time.time()
+    for i in range(iterations):
+        opStart = time.time()
+        operation()
+        times.append(time.time() - opStart)
+    elapsed = time.time() - startTime
+    times.sort()
+    return {'name': name, 'iterations': iterations, 'opsPerSec': iterations / max(elapsed, 1e-9),
+            'p50': get_percentile(times, 50) * 1000, 'p90': get_percentile(times, 90) * 1000,
+            'p99': get_percentile(times, 99) * 1000, 'max': times[-1] * 1000}
+
+def get_stage_benchmarks(s3, es):
+    ''' Returns: list of (name, operation) for the stages of the pipeline '''
+    objects = s3.objects
+    event = get_event(DataKey, len(objects[DataKey]))
+    router = filenamemeta.get_router(BaseConfigs)
+    route = pluginregistry.ParserRoute(BaseConfigs['dataBodyParserModule'], BaseConfigs['dataBodyParserMaxBytes'])
+    attributes = dict(metadata.get_attributes_from_event(event), assayId='a1234', runId='15', operator='jdoe')
+    sqlite = sqlitebackend.SqliteBackend(':memory:')
+
+    benchmarks = [
+            ('event', lambda: metadata.get_attributes_from_event(event)),
+            ('filename', lambda: router.get_attributes(DataKey)),
+            ]
+    for metafileFormat in ('json', 'csv', 'custom'):
+        data = MetafileData[metafileFormat]
+        benchmarks.append(('metafile-' + metafileFormat,
+                (lambda data, metafileFormat: lambda: metafile.parse_metafile_data(data, metafileFormat, BaseConfigs['metafileParserModule']))(data, metafileFormat)))
+    benchmarks.extend([
+            ('metafile-get', lambda: metafile.get_attributes_from_metadatafile(s3, Bucket, MetaStem + '.json', 'json', None)),
+            ('body', lambda: objectmeta.get_body_attributes_from_ranges(objectmeta.RangedBody(s3, Bucket, DataKey, route.maxBytes), route, {})),
+            ('object', lambda: objectmeta.get_attributes_from_object(s3, Bucket, DataKey, True, True, route.maxBytes, route.plugin)),
+            ('index', lambda: esutils.indexAttributes(attributes, StubEndpoint)),
+            ('index-bulk-100', lambda: esutils.bulkIndexAttributes([dict(attributes, key='data/{}.tif'.format(i)) for i in range(100)], StubEndpoint)),
+            ('index-sqlite', lambda: sqlite.index(attributes)),
+            ])
+    return benchmarks
+
+def get_handler_benchmarks(s3):
+    '''
+    Returns: list of (name, operation, configs) running event_handler for each permutation of
+    inspectS3head, dataBodyParserMaxBytes and metafileMode
+    '''
+    benchmarks = []
+    for (inspectHead, maxBodyBytes, metafileMode) in itertools.product((True, False), (0, 1024), ('disable', 'written_first', 'written_last')):
+        configs = dict(BaseConfigs, inspectS3head=inspectHead, getMetadataFromObject=inspectHead,
+                dataBodyParserMaxBytes=maxBodyBytes, metafileMode=metafileMode)
+        if metafileMode == 'written_last':
+            event = get_event(MetaStem + '.json', len(s3.objects[MetaStem + '.json']))
+        else:
+            event = get_event(DataKey, len(s3.objects[DataKey]))
+        name = 'handler head={} body={} metafile={}'.format(int(inspectHead), maxBodyBytes, metafileMode)
+        benchmarks.append((name, (lambda event: lambda: habitat_handler.event_handler(event, None))(event), configs))
+    return benchmarks
+
+def run(iterations=DefaultIterations, s3Latency=DefaultS3Latency, esLatency=DefaultESLatency, only=None):
+    '''
+    Run the benchmarks whose names start with only (all if None).
+
+    Returns: list of the measure() results, with the S3 and Elasticsearch calls per operation
+    '''
+    s3 = StubS3(get_objects(), s3Latency)
+    es = StubES(esLatency)
+    benchmarks = [(name, operation, BaseConfigs) for (name, operation) in get_stage_benchmarks(s3, es)]
+    benchmarks.extend(get_handler_benchmarks(s3))
+
+    results = []
+    for (name, operation, configs) in benchmarks:
+        if only is not None and not name.startswith(only):
+            continue
+        with stubbed(configs, s3, es):
+            (s3Calls, esCalls) = (s3.calls, es.calls)
+            result = measure(name, operation, iterations)
+        result['s3Calls'] = (s3.calls - s3Calls) / float(iterations + 1)
+        result['esCalls'] = (es.calls - esCalls) / float(iterations + 1)
+        results.append(result)
+    return results
+
+def format_results(results):
+    lines = ['{:<50} {:>10} {:>9} {:>9} {:>9} {:>9} {:>6} {:>6}'.format('benchmark', 'ops/sec', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 's3', 'es')]
+    for result in results:
+        lines.append('{name:<50} {opsPerSec:>10.1f} {p50:>9.3f} {p90:>9.3f} {p99:>9.3f} {max:>9.3f} {s3Calls:>6.1f} {esCalls:>6.1f}'.format(**result))
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the habitat indexing pipeline against stub S3 and Elasticsearch')
+    parser.add_argument('--iterations', type=int, default=DefaultIterations, help='Timed operations per benchmark')
+    parser.add_argument('--s3-latency', type=float, default=DefaultS3Latency, help='Seconds added to every S3 call')
+    parser.add_argument('--es-latency', type=float, default=DefaultESLatency, help='Seconds added to every Elasticsearch call')
+    parser.add_argument('--only', default=None, help='Only run the benchmarks whose names start with this, e.g., handler')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser.add_argument('--log-level', default='WARNING', help='Logging level while benchmarking (the pipeline logs at INFO in Lambda)')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level) # habitat_handler sets up logging at INFO when it is imported
+
+    results = run(args.iterations, args.s3_latency, args.es_latency, args.only)
+    if args.json:
+        print json.dumps(results, indent=4)
+    else:
+        print format_results(results)
+
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def test_percentile(self):
+        times = range(1, 101)
+        self.assertEqual((get_percentile(times, 50), get_percentile(times, 99), get_percentile(times, 100)), (50, 99, 100))
+
+    def test_run(self):
+        ''' Every benchmark runs against the stubs without latency '''
+        results = run(iterations=2, s3Latency=0, esLatency=0)
+        self.assertEqual(len(results), len(set(result['name'] for result in results)))
+        handler = [result for result in results if result['name'] == 'handler head=1 body=1024 metafile=written_first'][0]
+        self.assertGreater(handler['s3Calls'], 0)
+        self.assertEqual(handler['esCalls'], 1, 'Expected one bulk request per event')
+        self.assertEqual([result['name'] for result in run(iterations=1, s3Latency=0, esLatency=0, only='metafile-')],
+                ['metafile-json', 'metafile-csv', 'metafile-custom', 'metafile-get'])
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    logFormat = '%(levelname)s:%(asctime)s:HABITAT:%(module)s-%(lineno)d: %(message)s'
+    logLevel = logging.WARNING
+    logging.basicConfig(format=logFormat, level=logLevel)
+
+    main()
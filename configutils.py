@@ -4,6 +4,11 @@ File: configutils.py
 Utility functions to read and write the config file. Also, provides an interface to make it easy to call from a shell script.
 Config file name is hard coded in this module.
 
+The handler does not use the raw json. get_configs() returns a compiled snapshot instead (see compile_configs): the configs
+are validated once, the derived artifacts (file name regexes, parser plugins, metafile mode settings, bucket lifecycle
+rules) are built once, and the result is read-only. A misconfiguration raises ConfigError at cold start (or when
+habitat_tools.sh loads the configs) instead of failing once per object.
+
 Author: Ken Robbins, March 2016
 
    Copyright 2016 Novartis Institutes for BioMedical Research
@@ -21,8 +26,14 @@ Author: Ken Robbins, March 2016
    limitations under the License.
 '''
 
+import logging
+import pipes
 import sys
+import os
 import json
+import re
+import filenamemeta
+import pluginregistry
 
 configFile = 'habitatconfig.json'
 '''
@@ -46,12 +57,288 @@ def load_configs():
         configs = json.loads(f.read())
     return configs
 
+class ConfigError(ValueError):
+    ''' The configs are not valid. The message names the offending key. '''
+    pass
+
+String = basestring
+Integer = (int, long)
+Number = (int, long, float)
+
+# Top level key -> (allowed types, allowed values or None)
+Schema = {
+    'awsAccountId': (String, None),
+    'region': (String, None),
+    'bucket': (String, None),
+    'esDomain': (String, None),
+    'esEndpoint': (String, None),
+    'esHabitatIndex': (String, None),
+    'esDocType': (String, None),
+    'esFieldMappings': (dict, None),
+    'esTotalFieldsLimit': (Integer, None),
+    'esRollover': (dict, None),
+    'indexBackend': (String, ['elasticsearch', 'sqlite']),
+    'sqlitePath': (String, None),
+    'dataFilenameRegex': (String, None),
+    'dataFilenameRoutes': (list, None),
+    'dataFilenameRegexGuard': (bool, None),
+    'dataFilenameMaxLength': (Integer, None),
+    'dataBodyParserModule': (String, None),
+    'dataBodyParserMaxBytes': (Integer, None),
+    'dataBodyParsers': (list, None),
+    'dataBodyParserLimitBytes': (Integer, None),
+    'inspectS3head': (bool, None),
+    'getMetadataFromObject': (bool, None),
+    'daysBeforeIA': (Integer, None),
+    'daysBeforeGlacier': (Integer, None),
+    'daysBeforeExpire': (Integer, None),
+    'metafileMode': (String, ['disable', 'written_first', 'written_last']),
+    'metafileFormat': (String, ['json', 'csv', 'custom']),
+    'metafileParserModule': (String, None),
+    'metafilePairing': (dict, None),
+    'metafileExtensions': (list, None),
+    'metadataSourceThreads': (Integer, None),
+    'metricsSampleRate': (Number, None),
+    'indexRetry': (dict, None),
+    'manifestPrefix': (String, None),
+    'manifestKeyColumn': (String, None),
+    'manifestBatchSize': (Integer, None),
+    'attachMetadataToObject': (bool, None),
+    'useCrossRegionReplication': (bool, None),
+    'useVersioning': (bool, None),
+    }
+RequiredKeys = ['region', 'bucket']
+RequiredElasticsearchKeys = ['esHabitatIndex', 'esDocType']
+
+# The values that habitat_tools.sh reads (see get_shell_assignments)
+ShellKeys = ['region', 'bucket', 'awsAccountId', 'esDomain', 'metafileMode', 'daysBeforeIA', 'daysBeforeGlacier', 'daysBeforeExpire',
+        'manifestPrefix']
+
+MinDaysBeforeIA = 30 # S3 does not transition objects to STANDARD_IA any sooner
+
+class FrozenDict(dict):
+    ''' A dict that cannot be modified '''
+    def read_only(self, *args, **kwargs):
+        raise TypeError('The compiled configs are read-only. Use configutils.load_configs() for a copy that may be modified.')
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = read_only
+
+class ConfigSnapshot(FrozenDict):
+    '''
+    The compiled configs: the config keys and values (read-only, with lists as tuples), plus the derived artifacts
+    as attributes (see compile_configs).
+    '''
+    pass
+
+def freeze(value):
+    ''' Returns: value with its dictionaries (at any depth) made read-only and its lists made tuples '''
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for (key, item) in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+TypeNames = {String: 'a string', Integer: 'an integer', Number: 'a number', bool: 'true or false', dict: 'an object', list: 'a list'}
+
+def check_type(name, value, types, allowed=None):
+    ''' Raise ConfigError if value (of the key name) is not one of types, or not one of the allowed values '''
+    typeList = types if isinstance(types, tuple) else (types,)
+    if not isinstance(value, typeList) or (isinstance(value, bool) and bool not in typeList):
+        raise ConfigError('{} must be {}, not {}'.format(name, TypeNames[types], json.dumps(value)))
+    if allowed is not None and value not in allowed:
+        raise ConfigError('{} must be one of {}, not {}'.format(name, ', '.join(allowed), json.dumps(value)))
+
+def check_routes(name, routes, requiredKey, types):
+    ''' Check a routing table (dataFilenameRoutes or dataBodyParsers): a list of dictionaries with requiredKey '''
+    for (i, route) in enumerate(routes):
+        routeName = '{}[{}]'.format(name, i)
+        check_type(routeName, route, dict)
+        if requiredKey not in route:
+            raise ConfigError('{} has no {}'.format(routeName, requiredKey))
+        for (key, value) in route.items():
+            if key in types:
+                check_type('{}.{}'.format(routeName, key), value, types[key])
+
+def check_regexes(configs):
+    ''' Compile all of the file name regexes (so that each one is compiled once), raising ConfigError for a bad one '''
+    guard = configs.get('dataFilenameRegexGuard', False)
+    regexes = [('dataFilenameRoutes[{}].regex'.format(i), route['regex']) for (i, route) in enumerate(configs.get('dataFilenameRoutes', []))]
+    if len(configs.get('dataFilenameRegex', '')) > 0:
+        regexes.append(('dataFilenameRegex', configs['dataFilenameRegex']))
+    for (name, regex) in regexes:
+        try:
+            filenamemeta.compile_regex(regex, guard)
+        except (re.error, ValueError) as e:
+            raise ConfigError('{} is not a valid regex: {}'.format(name, e))
+
+def check_plugin(name, module, functions):
+    ''' Import the parser plugin module (once per process), raising ConfigError if it does not define any of functions '''
+    try:
+        plugin = pluginregistry.load_plugin(module)
+    except ImportError as e:
+        raise ConfigError('{} names a plugin that cannot be imported: {} ({})'.format(name, module, e))
+    if not any(hasattr(plugin, function) for function in functions):
+        raise ConfigError('{} names a plugin without {}: {}'.format(name, ' or '.join(functions), module))
+
+def get_notification_prefix(configs):
+    ''' Returns: the prefix of the keys whose create events go to the handler for the metafileMode '''
+    pairing = configs.get('metafilePairing', {})
+    if configs.get('metafileMode', 'disable') == 'written_last':
+        return pairing.get('metaPrefix', 'meta/')
+    return pairing.get('dataPrefix', 'data/')
+
+def get_lifecycle(configs):
+    '''
+    Returns: the S3 bucket lifecycle configuration for daysBeforeIA, daysBeforeGlacier and daysBeforeExpire (a missing
+    or 0 value omits that step), or None if there are no steps
+    '''
+    days = dict((name, configs.get(name, 0)) for name in ('daysBeforeIA', 'daysBeforeGlacier', 'daysBeforeExpire'))
+    for (name, value) in days.items():
+        if value < 0:
+            raise ConfigError('{} must not be negative'.format(name))
+    if 0 < days['daysBeforeIA'] < MinDaysBeforeIA:
+        raise ConfigError('daysBeforeIA must be at least {}'.format(MinDaysBeforeIA))
+    if 0 < days['daysBeforeGlacier'] <= days['daysBeforeIA']:
+        raise ConfigError('daysBeforeGlacier must be more than daysBeforeIA')
+    if 0 < days['daysBeforeExpire'] <= max(days['daysBeforeIA'], days['daysBeforeGlacier']):
+        raise ConfigError('daysBeforeExpire must be more than daysBeforeIA and daysBeforeGlacier')
+
+    rule = {'ID': 'lifecycle_id1', 'Prefix': '', 'Status': 'Enabled'}
+    transitions = [{'Days': days[name], 'StorageClass': storageClass}
+            for (name, storageClass) in (('daysBeforeIA', 'STANDARD_IA'), ('daysBeforeGlacier', 'GLACIER')) if days[name] > 0]
+    if len(transitions) > 0:
+        rule['Transitions'] = transitions
+    if days['daysBeforeExpire'] > 0:
+        rule['Expiration'] = {'Days': days['daysBeforeExpire']}
+    if len(rule) == 3:
+        return None
+    return {'Rules': [rule]}
+
+def compile_configs(configs):
+    '''
+    Validate configs (the parsed json) and compile it into a ConfigSnapshot, with the derived artifacts built once:
+        router: the filenamemeta.FilenameRouter for the file name regexes, or None
+        registry: the pluginregistry.PluginRegistry for the body parsers (all of the plugins are imported)
+        notificationPrefix: the key prefix of the create events to send to the handler (data or meta, by metafileMode)
+        manifestNotificationPrefix: the key prefix of the manifests (manifestPrefix), or '' if there are none
+        dataPrefix: the key prefix of the data files (whose removals are always sent to the handler)
+        lifecycle: the S3 bucket lifecycle configuration, or None (see get_lifecycle)
+
+    Keys that are not in the Schema are allowed, with a warning, in case of a typo.
+
+    Raises: ConfigError for the first problem found
+    '''
+    if not isinstance(configs, dict):
+        raise ConfigError('The configs must be a json object')
+    required = RequiredKeys + (RequiredElasticsearchKeys if configs.get('indexBackend', 'elasticsearch') == 'elasticsearch' else [])
+    for name in required:
+        if name not in configs:
+            raise ConfigError('{} is missing'.format(name))
+    for (name, value) in sorted(configs.items()):
+        if name not in Schema:
+            logging.warning('Unknown config key (ignored): ' + name)
+            continue
+        check_type(name, value, *Schema[name])
+
+    check_routes('dataFilenameRoutes', configs.get('dataFilenameRoutes', []), 'regex',
+            {'regex': String, 'prefix': String, 'suffix': String})
+    check_routes('dataBodyParsers', configs.get('dataBodyParsers', []), 'module',
+            {'module': String, 'prefix': String, 'suffix': String, 'contentType': String, 'maxBytes': Integer, 'limitBytes': Integer})
+    for (name, value) in configs.get('metafilePairing', {}).items():
+        check_type('metafilePairing.' + name, value, String)
+    for (i, extension) in enumerate(configs.get('metafileExtensions', [])):
+        check_type('metafileExtensions[{}]'.format(i), extension, String)
+    if not 0 <= configs.get('metricsSampleRate', 0) <= 1:
+        raise ConfigError('metricsSampleRate must be between 0 and 1')
+    indexRetry = configs.get('indexRetry', {})
+    check_type('indexRetry.queue', indexRetry.get('queue', 'file'), String, ['file', 'sqs'])
+    if indexRetry.get('queue', 'file') == 'sqs':
+        # The sqs queue is drained in Lambda, where a (file) dead-letter directory cannot be written
+        for name in ('queueUrl', 'deadLetterQueueUrl'):
+            if name not in indexRetry:
+                raise ConfigError('indexRetry.{} is missing for the sqs queue'.format(name))
+
+    check_regexes(configs)
+    for (i, route) in enumerate(configs.get('dataBodyParsers', [])):
+        check_plugin('dataBodyParsers[{}].module'.format(i), route['module'], ['parseranges', 'parsebody'])
+    if len(configs.get('dataBodyParserModule', '')) > 0 and configs.get('dataBodyParserMaxBytes', 0) > 0:
+        check_plugin('dataBodyParserModule', configs['dataBodyParserModule'], ['parseranges', 'parsebody'])
+
+    metafileMode = configs.get('metafileMode', 'disable')
+    metafileFormat = configs.get('metafileFormat', 'json')
+    if metafileMode != 'disable':
+        formats = [extension if extension in ('json', 'csv') else 'custom' for extension in configs.get('metafileExtensions', [metafileFormat])]
+        if 'custom' in formats and not configs.get('metafileParserModule', None):
+            raise ConfigError('metafileParserModule is missing for the custom metafileFormat (or metafileExtensions)')
+        if configs.get('metafileParserModule', None):
+            check_plugin('metafileParserModule', configs['metafileParserModule'], ['parsebody'])
+
+    manifestPrefix = configs.get('manifestPrefix', '')
+    if len(manifestPrefix) > 0:
+        dataPrefix = configs.get('metafilePairing', {}).get('dataPrefix', 'data/')
+        for prefix in (dataPrefix, get_notification_prefix(configs)):
+            if prefix.startswith(manifestPrefix) or manifestPrefix.startswith(prefix):
+                raise ConfigError('manifestPrefix must not contain, or be under, the data (or meta) files: ' + manifestPrefix)
+    if configs.get('manifestBatchSize', 1) <= 0:
+        raise ConfigError('manifestBatchSize must be positive')
+
+    snapshot = ConfigSnapshot((name, freeze(value)) for (name, value) in configs.items())
+    snapshot.router = filenamemeta.get_router(snapshot)
+    snapshot.registry = pluginregistry.get_registry(snapshot)
+    snapshot.notificationPrefix = get_notification_prefix(snapshot)
+    snapshot.dataPrefix = snapshot.get('metafilePairing', {}).get('dataPrefix', 'data/')
+    snapshot.manifestNotificationPrefix = manifestPrefix
+    snapshot.lifecycle = get_lifecycle(snapshot)
+    return snapshot
+
+_cachedConfigs = None
+_cachedStamp = None
+
+def get_configs():
+    '''
+    Return the compiled configs (see compile_configs), cached for the life of the process (e.g., across warm Lambda
+    invocations).
+
+    The config file is only re-read and recompiled when its modification time or size has changed
+    since it was last loaded. The returned ConfigSnapshot is shared and read-only.
+    Use load_configs() to get a private copy that may be modified (e.g., before store_configs).
+
+    Raises: ConfigError if the configs are not valid
+    '''
+    global _cachedConfigs, _cachedStamp
+    stat = os.stat(configFile)
+    stamp = (stat.st_mtime, stat.st_size)
+    if _cachedConfigs is None or stamp != _cachedStamp:
+        _cachedConfigs = compile_configs(load_configs())
+        _cachedStamp = stamp
+    return _cachedConfigs
+
+def get_shell_assignments(snapshot):
+    '''
+    Returns: shell variable assignments, one per line, of the ShellKeys and the derived notificationPrefix, dataPrefix,
+    manifestNotificationPrefix and lifecycleConfiguration (json, or empty if there is no lifecycle), for habitat_tools.sh to eval.
+    Missing keys are assigned empty strings.
+    '''
+    values = [(name, snapshot.get(name, '')) for name in ShellKeys]
+    values.append(('notificationPrefix', snapshot.notificationPrefix))
+    values.append(('dataPrefix', snapshot.dataPrefix))
+    values.append(('manifestNotificationPrefix', snapshot.manifestNotificationPrefix))
+    values.append(('lifecycleConfiguration', json.dumps(snapshot.lifecycle, indent=4) if snapshot.lifecycle is not None else ''))
+    return '\n'.join('{}={}'.format(name, pipes.quote(unicode(value))) for (name, value) in values)
+
 def get_config():
     ''' 
     Called from the command line, print to stdout the value for the specified key.
     If not key is specified, pretty print the full json of the config.
+    With --shell, validate and compile the configs and print the shell assignments for habitat_tools.sh
+    (see get_shell_assignments), or print the problem to stderr and exit with status 1.
     '''
-    if len(sys.argv) == 1:
+    if len(sys.argv) == 2 and sys.argv[1] == '--shell':
+        try:
+            print get_shell_assignments(compile_configs(load_configs()))
+        except (ConfigError, IOError, ValueError) as e:
+            sys.stderr.write('Config error in {}: {}\n'.format(configFile, e))
+            sys.exit(1)
+    elif len(sys.argv) == 1:
         configs = load_configs()
         print 'Config file: ', configFile
         print json.dumps(configs, indent=4)
@@ -63,6 +350,7 @@ def get_config():
         print '  {} prints this usage message'.format(sys.argv[0])
         print '  {} pretty prints config file to stdout'.format(sys.argv[0])
         print '  {} <topLevelKey> - prints the value for key to stdout'.format(sys.argv[0])
+        print '  {} --shell - validates the configs and prints shell variable assignments to stdout'.format(sys.argv[0])
 
 def store_configs(configs):
     '''
@@ -81,12 +369,17 @@ if __name__ == '__main__':
     # Normal function to execute from command line
     get_config()
 
-    # No unit tests. Just inspect manually using one or more of the following...
+    # The unit tests (of the config compiler) are in test_configutils.py. Otherwise, inspect manually using one or more of the following...
     '''
     # Test load_configs
     print json.dumps(load_configs(), indent=4)
     '''
 
+    '''
+    # Test get_configs (should print True since the file is only parsed once)
+    print get_configs() is get_configs()
+    '''
+
     '''
     # Test store_configs
     configs = load_configs()
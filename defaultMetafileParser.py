@@ -21,7 +21,6 @@ Author: Ken Robbins, March 2016
    limitations under the License.
 '''
 
-import unittest
 
 def parsebody(body):
     '''
@@ -46,34 +45,3 @@ def parsebody(body):
     # TODO: End of custom code
 
     return attributes
-
-
-#############
-# unittests #
-#############
-class TestController(unittest.TestCase):
-    def setUp(self):
-        pass
-
-    def test_parsebody(self):
-        ''' Happy path test case '''
-        body = '''
-key1=value1
-key2=value2
-        '''
-        attributes = parsebody(body)
-        expected = {
-                'key1': 'value1',
-                'key2': 'value2'
-                }
-        self.assertEqual(attributes, expected, 'Attribute dictionaries do not match')
-
-def AllModuleTests():
-    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
-    return unittest.TestSuite([suite1])
-
-########
-# MAIN #
-########
-if __name__ == '__main__':
-    unittest.main()
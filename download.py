@@ -0,0 +1,203 @@
+'''
+File: download.py
+
+Download all of the objects that match a metadata query in one step, e.g., a whole assay run.
+
+The matching keys are streamed from the index (the search of the configured indexbackend) and downloaded by a bounded pool of
+workers. Large objects are downloaded as parallel ranged parts (boto3 managed transfers). Each download is
+written to a temporary file and checked against the indexed ContentLength (if the head was inspected) before
+it is moved into place. Local files that are already current (same size and not older than the object) are skipped.
+
+Usage:
+    python -m download --query '{"term": {"runId": "15"}}' [--dest .] [--workers 16] [--part-threads 4]
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import logging
+import argparse
+import calendar
+import threading
+import shutil
+import json
+import time
+import os
+import boto3
+import configutils
+import indexbackend
+from boto3.s3.transfer import TransferConfig
+from dateutil import parser as dateparser
+from multiprocessing.pool import ThreadPool
+
+DefaultWorkers = 16 # Objects downloaded at once
+DefaultPartThreads = 4 # Ranged parts downloaded at once for each large object
+DefaultPartSize = 8 * 1024 * 1024 # Objects larger than this are downloaded in parts of this size
+SourceFields = ['bucket', 'key', 'ContentLength', 'LastModified']
+
+def get_local_path(destDir, key):
+    ''' Returns: the path under destDir for key, refusing keys that would escape destDir '''
+    path = os.path.normpath(os.path.join(destDir, key))
+    if not path.startswith(os.path.normpath(destDir) + os.sep):
+        raise ValueError('Key is outside of the destination directory: ' + key)
+    return path
+
+def get_timestamp(lastModified):
+    ''' Returns: seconds since the epoch of the indexed LastModified (an ISO 8601 string), or None '''
+    if not lastModified:
+        return None
+    return calendar.timegm(dateparser.parse(lastModified).utctimetuple())
+
+def is_current(path, size, timestamp):
+    ''' Returns: True if the local file at path has the object's size (if known) and is not older than it (if known) '''
+    if not os.path.isfile(path):
+        return False
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    return timestamp is None or os.path.getmtime(path) >= timestamp
+
+class Downloader(object):
+    '''
+    Downloads the objects of search hits into destDir (keeping their keys as relative paths) on a pool of workers.
+    At most workers objects are in flight at once, so the hits are consumed no faster than they are downloaded.
+    '''
+    def __init__(self, s3, destDir, workers=DefaultWorkers, partThreads=DefaultPartThreads, partSize=DefaultPartSize):
+        self.s3 = s3
+        self.destDir = destDir
+        self.workers = workers
+        self.transferConfig = TransferConfig(multipart_threshold=partSize, multipart_chunksize=partSize,
+                max_concurrency=partThreads, use_threads=partThreads > 1)
+        self.lock = threading.Lock()
+        self.stats = {'downloaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+
+    def count(self, outcome, nbytes=0):
+        with self.lock:
+            self.stats[outcome] += 1
+            self.stats['bytes'] += nbytes
+
+    def download_hit(self, hit):
+        source = hit['_source']
+        try:
+            path = get_local_path(self.destDir, source['key'])
+            size = source.get('ContentLength', None)
+            timestamp = get_timestamp(source.get('LastModified', None))
+            if is_current(path, size, timestamp):
+                self.count('skipped')
+                return
+
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass # Made by another worker
+            tmpPath = path + '.download'
+            self.s3.download_file(source['bucket'], source['key'], tmpPath, Config=self.transferConfig)
+            nbytes = os.path.getsize(tmpPath)
+            if size is not None and nbytes != size:
+                os.remove(tmpPath)
+                raise IOError('Downloaded {} bytes but the index has ContentLength {}'.format(nbytes, size))
+            if timestamp is not None:
+                os.utime(tmpPath, (timestamp, timestamp)) # So that is_current holds next time
+            os.rename(tmpPath, path)
+            self.count('downloaded', nbytes)
+        except Exception as e:
+            logging.error(e)
+            logging.error('Error downloading key ' + source.get('key', ''))
+            self.count('failed')
+
+    def run(self, hits):
+        '''
+        Download the objects for hits (any iterable, e.g., esutils.searchHits)
+
+        Returns: dictionary of the numbers of objects downloaded, skipped and failed, the bytes downloaded,
+        the elapsed seconds and the throughput in MB/s
+        '''
+        startTime = time.time()
+        slots = threading.BoundedSemaphore(self.workers)
+        def done(result):
+            slots.release()
+        pool = ThreadPool(self.workers)
+        try:
+            for hit in hits:
+                slots.acquire()
+                pool.apply_async(self.download_hit, (hit,), callback=done)
+        finally:
+            pool.close()
+            pool.join()
+
+        stats = dict(self.stats)
+        stats['seconds'] = time.time() - startTime
+        stats['MBps'] = stats['bytes'] / (1024.0 * 1024.0) / max(stats['seconds'], 0.001)
+        logging.info('Downloaded: {downloaded} Skipped: {skipped} Failed: {failed} ({bytes} bytes in {seconds:.1f} seconds, {MBps:.1f} MB/s)'.format(**stats))
+        return stats
+
+def download(query, destDir, configs, workers=DefaultWorkers, partThreads=DefaultPartThreads):
+    ''' Download every object matching query (an Elasticsearch query clause). Returns: the run() statistics '''
+    hits = indexbackend.get_backend(configs).search(query, fields=SourceFields)
+    downloader = Downloader(boto3.client('s3', region_name=configs['region']), destDir, workers, partThreads)
+    return downloader.run(hits)
+
+def main():
+    argParser = argparse.ArgumentParser(description='Download the habitat objects that match a metadata query')
+    argParser.add_argument('--query', required=True, help='Elasticsearch query clause as JSON, e.g., {"term": {"runId": "15"}}')
+    argParser.add_argument('--dest', default='.', help='Directory to download into. Keys are kept as relative paths')
+    argParser.add_argument('--workers', type=int, default=DefaultWorkers, help='Number of objects to download at once')
+    argParser.add_argument('--part-threads', type=int, default=DefaultPartThreads, help='Number of parts of a large object to download at once')
+    args = argParser.parse_args()
+
+    stats = download(json.loads(args.query), args.dest, configutils.load_configs(), args.workers, args.part_threads)
+    print json.dumps(stats, indent=4)
+
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        self.configs = configutils.load_configs()
+        self.destDir = 'unittest_download'
+        self.key = 'data/unittest-a1234-15-imager_1234567890.tif'
+
+    def tearDown(self):
+        if os.path.isdir(self.destDir):
+            shutil.rmtree(self.destDir)
+
+    def test_get_local_path(self):
+        self.assertEqual(get_local_path('dest', 'data/a.tif'), os.path.join('dest', 'data', 'a.tif'))
+        self.assertRaises(ValueError, get_local_path, 'dest', '../a.tif')
+
+    def test_download(self):
+        ''' The unit test object is downloaded and then skipped as current '''
+        query = {'term': {'key': self.key}}
+        stats = download(query, self.destDir, self.configs, workers=2)
+        self.assertEqual((stats['downloaded'], stats['failed']), (1, 0), 'Expected the object to be downloaded')
+        self.assertTrue(os.path.isfile(get_local_path(self.destDir, self.key)))
+
+        stats = download(query, self.destDir, self.configs, workers=2)
+        self.assertEqual((stats['downloaded'], stats['skipped']), (0, 1), 'Expected the current file to be skipped')
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    logFormat = '%(levelname)s:%(asctime)s:HABITAT:%(module)s-%(lineno)d: %(message)s'
+    logLevel = logging.INFO
+    logging.basicConfig(format=logFormat, level=logLevel)
+
+    main()
@@ -21,24 +21,107 @@ Author: Ken Robbins, March 2016
    See the License for the specific language governing permissions and
    limitations under the License.
 '''
-import unittest
 import logging
-import boto3
 import time
 import json
 import configutils
-import secret
-
-from elasticsearch import Elasticsearch, RequestsHttpConnection
-from requests_aws4auth import AWS4Auth
 
 # TODO KLR: Review all es calls and surround with try/except
 
-Configs = configutils.load_configs()
-HabitatIndex = Configs['esHabitatIndex']
-DocType = Configs['esDocType']
+# The configs and elasticsearch (with requests and the request signer) are loaded on first use rather than on import,
+# see loadConfigs and loadElasticsearch. They are not needed on every path, and they are a large part of the cold start.
+# The configs (and the index names from them) follow configutils.get_configs, so they change with the config file.
+Configs = None
+HabitatIndex = None # With esRollover, this is the alias that writes go to
+DocType = None
+RolloverConfigs = None
+ReadAlias = None # Alias of all of the rolled over indexes, used for reads when esRollover is set
+ReadIndex = None
+
+class NotLoaded(Exception):
+    ''' Stands in for the elasticsearch exception classes until elasticsearch is loaded, so it is never raised '''
+
+Elasticsearch = None
+RequestsHttpConnection = None
+ConflictError = NotLoaded
+NotFoundError = NotLoaded
+
+def loadConfigs():
+    '''
+    Set the module configs (index names, etc.) from the compiled configs of configutils.get_configs, whenever they are
+    needed, so that they are the same configs that the handler uses (including after the config file has changed).
+    '''
+    global Configs, HabitatIndex, DocType, RolloverConfigs, ReadAlias, ReadIndex
+    configs = configutils.get_configs()
+    if configs is not Configs:
+        HabitatIndex = configs['esHabitatIndex']
+        DocType = configs['esDocType']
+        RolloverConfigs = configs.get('esRollover', None)
+        ReadAlias = HabitatIndex + '-all'
+        ReadIndex = ReadAlias if RolloverConfigs is not None else HabitatIndex
+        Configs = configs
+    return Configs
+
+def loadElasticsearch():
+    ''' Import elasticsearch the first time a client is needed '''
+    global Elasticsearch, RequestsHttpConnection, ConflictError, NotFoundError
+    if Elasticsearch is None:
+        import elasticsearch
+        (RequestsHttpConnection, ConflictError, NotFoundError) = (elasticsearch.RequestsHttpConnection,
+                elasticsearch.ConflictError, elasticsearch.NotFoundError)
+        Elasticsearch = elasticsearch.Elasticsearch
+
+class RefreshingAWS4Auth(object):
+    '''
+    Request signer for the Elasticsearch Service that is created lazily (on the first signed request)
+    and lives for the life of the process.
 
-awsauth = AWS4Auth(secret.AWS_ACCESS_KEY_ID, secret.AWS_SECRET_ACCESS_KEY, secret.AWS_DEFAULT_REGION, 'es')
+    The keys in secret.py are used if they are set. Otherwise the boto3 credential chain is used
+    (e.g., the Lambda execution role) and the signer is rebuilt whenever those credentials are rotated.
+    '''
+    def __init__(self, region):
+        self.region = region
+        self.credentials = None
+        self.frozen = None
+        self.auth = None
+
+    def get_auth(self):
+        if self.auth is not None and self.credentials is None:
+            return self.auth # Static keys never change
+
+        import secret
+        import boto3
+        from requests_aws4auth import AWS4Auth
+
+        if self.auth is None and getattr(secret, 'AWS_ACCESS_KEY_ID', None):
+            self.auth = AWS4Auth(secret.AWS_ACCESS_KEY_ID, secret.AWS_SECRET_ACCESS_KEY, self.region, 'es')
+            return self.auth
+
+        if self.credentials is None:
+            self.credentials = boto3.Session().get_credentials()
+        frozen = self.credentials.get_frozen_credentials() # Refreshes the credentials only when they are about to expire
+        if frozen != self.frozen:
+            self.auth = AWS4Auth(frozen.access_key, frozen.secret_key, self.region, 'es', session_token=frozen.token)
+            self.frozen = frozen
+        return self.auth
+
+    def __call__(self, request):
+        return self.get_auth()(request)
+
+# Request signer for all of the clients, created with the first client
+awsauth = None
+
+BulkDeleteChunkSize = 1000 # Most deletes to send in one _bulk request
+SequencerDigits = 18 # Hex digits of the S3 event sequencer that are compared (sequencers are right padded with zeros)
+MaxVersion = 2 ** 63 - 1 # Largest Elasticsearch external version
+DefaultTotalFieldsLimit = 1000 # Default most fields in an index (the Elasticsearch default)
+DefaultIgnoreAbove = 1024 # Longer string values of unmapped attributes are not indexed (but are kept in the _source)
+DefaultPageSize = 1000 # Hits per page when streaming search results
+ScrollTimeout = '2m' # How long a scroll is kept between pages
+ManifestFields = 'manifestFields' # Attribute with the names of the attributes that were set by a manifest row, see manifest.py
+
+# Elasticsearch clients (and their pooled keep-alive connections) by endpoint, reused for the life of the process
+esClients = {}
 
 def putEndpointInConfigFile():
     '''
@@ -48,14 +131,16 @@ def putEndpointInConfigFile():
         python -m esutils putEndpointInConfigFile
     '''
     # Get the es endpoint given the domain name
+    import boto3
+    configs = configutils.load_configs()
     esclient = boto3.client('es')
-    response = esclient.describe_elasticsearch_domain(DomainName=Configs['esDomain'])
+    response = esclient.describe_elasticsearch_domain(DomainName=configs['esDomain'])
 
     endpoint = response['DomainStatus'].get('Endpoint', None)
     import sys
     if endpoint is not None:
-        Configs['esEndpoint'] = response['DomainStatus']['Endpoint']
-        configutils.store_configs(Configs)
+        configs['esEndpoint'] = response['DomainStatus']['Endpoint']
+        configutils.store_configs(configs)
         sys.exit(0)
     else:
         print 'Domain is not yet created. Try again (it may take 10-15 minutes).'
@@ -68,15 +153,109 @@ def makeUniqueId(attributes):
     objectId = '{}/{}'.format(attributes['bucket'], attributes['key'])
     return objectId
 
+def getIndexTemplate(configs, esMajorVersion):
+    '''
+    Return the body of the index template for the habitat indexes.
+
+    The attributes that habitat itself extracts are mapped explicitly, as are the attributes in the esFieldMappings
+    config (attribute name to Elasticsearch type, e.g., {"assayId": "keyword", "runId": "long"}). Unknown string
+    attributes are mapped as keywords (exact match, no analysis) by a dynamic template, and the number of fields is
+    limited by esTotalFieldsLimit so that new metadata keys cannot grow the mapping without bound.
+    Every index that the template applies to is added to ReadAlias.
+    '''
+    loadConfigs()
+    keyword = {'type': 'keyword'}
+    properties = {
+            'region': keyword,
+            'bucket': keyword,
+            'key': keyword,
+            'user': keyword,
+            'sequencer': keyword,
+            'size': {'type': 'long'},
+            'ContentLength': {'type': 'long'},
+            'LastModified': {'type': 'date'}
+            }
+    for (name, fieldType) in configs.get('esFieldMappings', {}).items():
+        properties[name] = {'type': fieldType}
+    mapping = {
+            'dynamic_templates': [
+                {'unmapped_strings': {'match_mapping_type': 'string', 'mapping': {'type': 'keyword', 'ignore_above': DefaultIgnoreAbove}}}
+                ],
+            'properties': properties
+            }
+    template = {
+            'settings': {'index.mapping.total_fields.limit': configs.get('esTotalFieldsLimit', DefaultTotalFieldsLimit)},
+            'mappings': {DocType: mapping},
+            'aliases': {ReadAlias: {}}
+            }
+    if esMajorVersion >= 6:
+        template['index_patterns'] = [HabitatIndex, HabitatIndex + '-*']
+    else:
+        template['template'] = HabitatIndex + '*'
+    return template
+
+def sequencerToVersion(sequencer):
+    '''
+    Convert the sequencer of an S3 event to an Elasticsearch external version.
+
+    For events on the same key, a later event has a greater sequencer once the shorter one is right padded with zeros.
+    The padded sequencer is a 72 bit number whose leading bits are zero in practice. Values that do not fit in the
+    63 bits that an external version can hold are capped, so such events all get the same version (and the last one
+    written wins).
+
+    Return: version, or None if there is no sequencer
+    '''
+    if not sequencer:
+        return None
+    padded = (sequencer + '0' * SequencerDigits)[:SequencerDigits]
+    return min(int(padded, 16), MaxVersion)
+
+def getVersionArgs(attributes):
+    '''
+    Return: the version arguments for an index or delete of the object, so that an event older than the one already
+    applied (by sequencer) is rejected with a version conflict. Empty if the attributes have no sequencer.
+    '''
+    version = sequencerToVersion(attributes.get('sequencer', None))
+    if version is None:
+        return {}
+    return {'version': version, 'version_type': 'external_gte'}
+
+def keepManifestAttributes(attributes, stored):
+    '''
+    Return: the attributes of a full write of a document, with the attributes that a manifest row set on the stored
+    document (stored is its source, or None) put back, so that a later event for the data file does not wipe them.
+    As when the row is merged, the manifest values win.
+    '''
+    if stored is None or ManifestFields not in stored:
+        return attributes
+    kept = dict(attributes)
+    kept.update((name, stored[name]) for name in ['manifest', ManifestFields] + stored[ManifestFields] if name in stored)
+    return kept
+
 def esInit(esEndpoint):
-    ''' Initialize the Elasticsearch object '''
-    es = Elasticsearch(
-            hosts=[{'host': esEndpoint, 'port': 443}],
-            http_auth=awsauth,
-            use_ssl=True,
-            verify_certs=True,
-            connection_class=RequestsHttpConnection
-            )
+    '''
+    Return the Elasticsearch object for the endpoint.
+
+    The object is created on first use and then reused for the life of the process (e.g., across warm Lambda
+    invocations) so that the TLS connection is kept alive instead of being set up again on every call.
+    The configs and elasticsearch are loaded with the first client.
+    '''
+    global awsauth
+    loadConfigs()
+    es = esClients.get(esEndpoint, None)
+    if es is None:
+        loadElasticsearch()
+        if awsauth is None:
+            import secret
+            awsauth = RefreshingAWS4Auth(getattr(secret, 'AWS_DEFAULT_REGION', Configs['region']))
+        es = Elasticsearch(
+                hosts=[{'host': esEndpoint, 'port': 443}],
+                http_auth=awsauth,
+                use_ssl=True,
+                verify_certs=True,
+                connection_class=RequestsHttpConnection
+                )
+        esClients[esEndpoint] = es
     return es
 
 def indexAttributes(attributes, esEndpoint):
@@ -84,6 +263,8 @@ def indexAttributes(attributes, esEndpoint):
     Store the provided attributes into the elasticsearch index
 
     At present, does not require index to be unique and will overrite and create a new version.
+    If the attributes have the sequencer of the S3 event, it is used as an external version so that a stale event does
+    not overwrite a newer one. A stale event counts as success.
 
     Return: objectId on success, None otherwise
     '''
@@ -91,17 +272,27 @@ def indexAttributes(attributes, esEndpoint):
 
     es = esInit(esEndpoint)
 
-    logging.debug('esinfo:')
-    logging.debug(es.info())
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        # es.info() is a round trip to the cluster, so only make it when it will be logged
+        logging.debug('esinfo:')
+        logging.debug(es.info())
 
     try:
-        res = es.index(index=HabitatIndex, doc_type=DocType, id=objectId, body=attributes)
+        index = HabitatIndex
+        if RolloverConfigs is not None:
+            index = locateDocuments([objectId], es).get(objectId, HabitatIndex)
+        stored = getManifestSources([objectId], {objectId: index}, es).get(objectId, None)
+        res = es.index(index=index, doc_type=DocType, id=objectId, body=keepManifestAttributes(attributes, stored),
+                **getVersionArgs(attributes))
         if res is None or res.get('created', None) is None:
             logging.debug('Problem creating index for objectId {}'.format(objectId))
             logging.debug(res)
             return None
         else:
             return objectId
+    except ConflictError:
+        logging.info('Skipping stale event for objectId {}'.format(objectId))
+        return objectId
     except Exception as e:
         # TODO KLR: This is not quite right. How should I do this?
         logging.error('HTTP Status: %d', e.info['status'])
@@ -109,21 +300,270 @@ def indexAttributes(attributes, esEndpoint):
         logging.error('Error creating index for objectId {}'.format(objectId))
         return None
 
+def bulkIndexAttributes(attributesList, esEndpoint):
+    '''
+    Store a list of attribute dictionaries into the elasticsearch index with a single _bulk request.
+
+    As with indexAttributes, existing documents are overwritten and a new version is created, unless the sequencer
+    shows that the document is from an older event than the one already indexed (HTTP 409), which counts as success.
+    The attributes that a manifest row set on a document are kept (see keepManifestAttributes).
+    With esRollover, new documents go to the write alias and existing documents are updated in the index that holds
+    them, so there is only ever one document per object across the rolled over indexes.
+
+    Return: list of objectId (or None on failure) in the same order as attributesList
+    '''
+    if len(attributesList) == 0:
+        return []
+
+    objectIds = [makeUniqueId(attributes) for attributes in attributesList]
+    es = esInit(esEndpoint)
+
+    try:
+        located = locateDocuments(objectIds, es) if RolloverConfigs is not None else {}
+        stored = getManifestSources(objectIds, located, es)
+        body = []
+        for (objectId, attributes) in zip(objectIds, attributesList):
+            action = {'_index': located.get(objectId, HabitatIndex), '_type': DocType, '_id': objectId}
+            action.update(getVersionArgs(attributes))
+            body.append({'index': action})
+            body.append(keepManifestAttributes(attributes, stored.get(objectId, None)))
+        res = es.bulk(body=body)
+    except Exception as e:
+        logging.error(e)
+        logging.error('Error in bulk index request for {} objects'.format(len(objectIds)))
+        return [None] * len(objectIds)
+
+    results = []
+    for (objectId, item) in zip(objectIds, res['items']):
+        status = item['index'].get('status', 500)
+        if 200 <= status < 300 or status == 409:
+            results.append(objectId)
+        else:
+            logging.error('Error creating index for objectId {}. HTTP Status: {}'.format(objectId, status))
+            logging.error('Error detail: ' + json.dumps(item['index'].get('error', None)))
+            results.append(None)
+    return results
+
+def bulkMergeAttributes(attributesList, esEndpoint):
+    '''
+    Merge a list of attribute dictionaries into their documents with a single _bulk request of partial updates,
+    creating the documents that are not indexed yet (doc_as_upsert), e.g., for the rows of a manifest.
+
+    The other attributes of an existing document are kept. There is no sequencer, so the update is not versioned
+    externally: Elasticsearch adds one to the version of the document, which the sequencer of any later event for
+    the object is still at least, so that event is not rejected as stale.
+
+    Return: list of objectId (or None on failure) in the same order as attributesList
+    '''
+    if len(attributesList) == 0:
+        return []
+
+    objectIds = [makeUniqueId(attributes) for attributes in attributesList]
+    es = esInit(esEndpoint)
+
+    try:
+        located = locateDocuments(objectIds, es) if RolloverConfigs is not None else {}
+        body = []
+        for (objectId, attributes) in zip(objectIds, attributesList):
+            body.append({'update': {'_index': located.get(objectId, HabitatIndex), '_type': DocType, '_id': objectId}})
+            body.append({'doc': attributes, 'doc_as_upsert': True})
+        res = es.bulk(body=body)
+    except Exception as e:
+        logging.error(e)
+        logging.error('Error in bulk update request for {} objects'.format(len(objectIds)))
+        return [None] * len(objectIds)
+
+    results = []
+    for (objectId, item) in zip(objectIds, res['items']):
+        status = item['update'].get('status', 500)
+        if 200 <= status < 300:
+            results.append(objectId)
+        else:
+            logging.error('Error updating objectId {}. HTTP Status: {}'.format(objectId, status))
+            logging.error('Error detail: ' + json.dumps(item['update'].get('error', None)))
+            results.append(None)
+    return results
+
+def bulkDeleteAttributes(attributesList, esEndpoint, chunkSize=BulkDeleteChunkSize):
+    '''
+    Remove the documents for a list of attribute dictionaries (only bucket and key are needed) from the index
+    with _bulk requests of up to chunkSize deletes each, e.g., for the bursts of removals from lifecycle expirations.
+
+    A document that is not in the index (HTTP 404) counts as removed. As for bulkIndexAttributes, the sequencer (if any)
+    is used as an external version, so a stale removal (HTTP 409) does not remove a newer document and counts as success.
+
+    Return: list of objectId (or None on failure) in the same order as attributesList
+    '''
+    objectIds = [makeUniqueId(attributes) for attributes in attributesList]
+    es = esInit(esEndpoint)
+
+    results = []
+    for start in range(0, len(objectIds), chunkSize):
+        chunk = objectIds[start:start + chunkSize]
+        try:
+            located = locateDocuments(chunk, es) if RolloverConfigs is not None else {}
+            body = []
+            for (objectId, attributes) in zip(chunk, attributesList[start:start + chunkSize]):
+                action = {'_index': located.get(objectId, HabitatIndex), '_type': DocType, '_id': objectId}
+                action.update(getVersionArgs(attributes))
+                body.append({'delete': action})
+            res = es.bulk(body=body)
+        except Exception as e:
+            logging.error(e)
+            logging.error('Error in bulk delete request for {} objects'.format(len(chunk)))
+            results.extend([None] * len(chunk))
+            continue
+
+        for (objectId, item) in zip(chunk, res['items']):
+            status = item['delete'].get('status', 500)
+            if 200 <= status < 300 or status in (404, 409):
+                results.append(objectId)
+            else:
+                logging.error('Error deleting objectId {}. HTTP Status: {}'.format(objectId, status))
+                logging.error('Error detail: ' + json.dumps(item['delete'].get('error', None)))
+                results.append(None)
+    return results
+
+def locateDocuments(objectIds, es):
+    '''
+    With esRollover, a document stays in the index it was first written to, so find which of the rolled over
+    indexes hold the objectIds (one search).
+
+    Return: dictionary of objectId to index name for the objectIds that are indexed
+    '''
+    if len(objectIds) == 0:
+        return {}
+    body = {'query': {'ids': {'values': objectIds}}, '_source': False, 'size': len(objectIds)}
+    res = es.search(index=ReadAlias, body=body)
+    return dict((hit['_id'], hit['_index']) for hit in res['hits']['hits'])
+
+def getManifestSources(objectIds, located, es):
+    '''
+    With manifests (manifestPrefix), get the stored documents of the objectIds (in the indexes given by located, as
+    from locateDocuments) with one real time mget, for keepManifestAttributes. Without manifests, there are none.
+
+    Return: dictionary of objectId to source for the documents that have attributes from a manifest
+    '''
+    if not Configs.get('manifestPrefix', '') or len(objectIds) == 0:
+        return {}
+    docs = [{'_index': located.get(objectId, HabitatIndex), '_type': DocType, '_id': objectId} for objectId in objectIds]
+    res = es.mget(body={'docs': docs})
+    return dict((doc['_id'], doc['_source']) for doc in res['docs'] if doc.get('found', False) and ManifestFields in doc['_source'])
+
 def getById(objectId, esEndpoint):
     ''' Get the item with id objectId '''
     es = esInit(esEndpoint)
-    res = es.get(index=HabitatIndex, doc_type=DocType, id=objectId)
+    index = HabitatIndex
+    if RolloverConfigs is not None:
+        index = locateDocuments([objectId], es).get(objectId, HabitatIndex)
+    res = es.get(index=index, doc_type=DocType, id=objectId)
     return res
 
-def queryAll(esIndex, esEndpoint):
-    ''' A debug function to see what's in the index '''
+def createIndex():
+    '''
+    Put the habitat index template and create the first index. With esRollover, the first index is
+    <esHabitatIndex>-000001 behind the esHabitatIndex write alias. Otherwise it is esHabitatIndex itself.
+    Does nothing more than update the template if the index already exists.
+
+    Usage:
+        python -m esutils createIndex
+    '''
+    import sys
+    es = esInit(loadConfigs()['esEndpoint'])
+    esMajorVersion = int(es.info()['version']['number'].split('.')[0])
+    es.indices.put_template(name=HabitatIndex, body=getIndexTemplate(Configs, esMajorVersion))
+    if es.indices.exists_alias(name=HabitatIndex) or es.indices.exists(index=HabitatIndex):
+        print 'Index template updated. It applies to indexes created from now on.'
+        sys.exit(0)
+    if RolloverConfigs is not None:
+        es.indices.create(index=HabitatIndex + '-000001', body={'aliases': {HabitatIndex: {}}})
+    else:
+        es.indices.create(index=HabitatIndex)
+    print 'Index created.'
+    sys.exit(0)
+
+def rolloverIndex():
+    '''
+    Roll the write alias over to a new index if the current one has reached any of the esRollover conditions
+    (maxSize, e.g., "50gb", maxAge, e.g., "30d", maxDocs). Run periodically, e.g., from cron.
+
+    Usage:
+        python -m esutils rolloverIndex
+    '''
+    import sys
+    loadConfigs()
+    if RolloverConfigs is None:
+        print 'esRollover is not configured.'
+        sys.exit(1)
+    conditionNames = {'maxSize': 'max_size', 'maxAge': 'max_age', 'maxDocs': 'max_docs'}
+    conditions = dict((conditionNames[name], value) for (name, value) in RolloverConfigs.items() if name in conditionNames)
+    es = esInit(Configs['esEndpoint'])
+    res = es.indices.rollover(alias=HabitatIndex, body={'conditions': conditions})
+    if res.get('rolled_over', False):
+        print 'Rolled over from {} to {}'.format(res['old_index'], res['new_index'])
+    else:
+        print 'No rollover needed. Current index is ' + res['old_index']
+    sys.exit(0)
+
+def searchHits(query, esEndpoint, pageSize=DefaultPageSize, sliceId=None, maxSlices=None, sort=None, fields=None, esIndex=None):
+    '''
+    Generator over all of the hits for query (an Elasticsearch query clause such as {'term': {'assayId': 'a1234'}},
+    or None for all documents), fetched lazily a page of pageSize hits at a time so memory use does not grow with
+    the size of the result set.
+
+    Without a sort, the hits are fetched with a scroll in index order. To pull a huge result set with several
+    workers in parallel, give each worker a different sliceId (0 to maxSlices - 1) of the same maxSlices.
+    With a sort (a list as for the search sort), the hits are fetched in that order with search_after. The sort
+    must end with a field that is unique per document (e.g., {'_uid': 'asc'}) so that no hit is skipped.
+    fields optionally limits the _source fields returned.
+
+    Yields: hit dictionaries (with _id and _source)
+    '''
+    if sort is not None and maxSlices is not None:
+        raise ValueError('Slicing is only supported without a sort')
+    loadConfigs()
+    if esIndex is None:
+        esIndex = ReadIndex
+    body = {'query': query if query is not None else {'match_all': {}}, 'size': pageSize}
+    if fields is not None:
+        body['_source'] = fields
+
     es = esInit(esEndpoint)
+    if sort is not None:
+        body['sort'] = sort
+        while True:
+            hits = es.search(index=esIndex, body=body)['hits']['hits']
+            for hit in hits:
+                yield hit
+            if len(hits) < pageSize:
+                return
+            body['search_after'] = hits[-1]['sort']
+
+    body['sort'] = ['_doc'] # The cheapest order to scroll in
+    if maxSlices is not None:
+        body['slice'] = {'id': sliceId, 'max': maxSlices}
+    res = es.search(index=esIndex, body=body, scroll=ScrollTimeout)
+    scrollId = res.get('_scroll_id', None)
+    try:
+        while len(res['hits']['hits']) > 0:
+            for hit in res['hits']['hits']:
+                yield hit
+            res = es.scroll(scroll_id=scrollId, scroll=ScrollTimeout)
+            scrollId = res.get('_scroll_id', scrollId)
+    finally:
+        if scrollId is not None:
+            try:
+                es.clear_scroll(scroll_id=scrollId)
+            except Exception as e:
+                logging.warning('Could not clear scroll: {}'.format(e)) # It expires after ScrollTimeout anyway
 
-    res = es.search(index=esIndex, body={"query": {"match_all": {}}})
-    print("Got %d Hits:" % res['hits']['total'])
-    for hit in res['hits']['hits']:
+def queryAll(esIndex, esEndpoint):
+    ''' A debug function to see what's in the index '''
+    count = 0
+    for hit in searchHits(None, esEndpoint, esIndex=esIndex):
         print json.dumps(hit, indent=4)
-        #print("%(timestamp)s %(author)s: %(text)s" % hit["_source"])
+        count += 1
+    print("Got %d Hits" % count)
 
 def getcli():
     '''
@@ -141,49 +581,6 @@ def getcli():
     exit(0)
 
 
-#############
-# unittests #
-#############
-class TestController(unittest.TestCase):
-    def setUp(self):
-        self.esEndpoint = Configs['esEndpoint']
-
-    def test_putEndpointInConfigFile(self):
-        putEndpointInConfigFile()
-        print 'Manually inspect sanity of endpoint value...'
-        print 'Endpoint = ', Configs['esEndpoint']
-
-    def test_queryAll(self):
-        queryAll(HabitatIndex, self.esEndpoint)
-
-    def test_indexAttributes(self):
-        ''' Simple test of unique insert of a new index '''
-        from time import gmtime, strftime
-        key = strftime("%Y-%m-%dT%H:%M:%S", gmtime())
-        attributes = {
-                'region': 'us-east-1',
-                'bucket': 'mybucket',
-                'key': key
-                }
-        objectId = indexAttributes(attributes, self.esEndpoint)
-        print 'ObjectId:', objectId
-        self.assertIsNotNone(objectId, 'Could not insert into index')
-
-        result = getById(objectId, self.esEndpoint)
-        expected = {
-                u'_type': DocType,
-                u'_source': attributes,
-                u'_index': HabitatIndex,
-                u'_version': 1,
-                u'found': True,
-                u'_id': objectId
-                }
-        self.assertEqual(result, expected, 'Verification fetch did not match expected result')
-
-def AllModuleTests():
-    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
-    return unittest.TestSuite([suite1])
-
 ########
 # MAIN #
 ########
@@ -192,4 +589,6 @@ if __name__ == '__main__':
     logLevel = logging.INFO
     logging.basicConfig(format=logFormat, level=logLevel)
 
+    # Runs the function named on the command line, e.g., python -m esutils createIndex
+    import unittest
     unittest.main()
@@ -1,7 +1,7 @@
 '''
 File: filenamemeta.py
 
-Extract the meta data from a file name
+Extract the meta data from a file name, optionally routing each file name to one of several regexes
 
 Author: Ken Robbins, March 2016
 
@@ -20,7 +20,8 @@ Author: Ken Robbins, March 2016
    limitations under the License.
 '''
 
-import unittest
+import logging
+import json
 import re
 
 def get_attributes_from_filename(fname, regex):
@@ -48,7 +49,7 @@ def get_attributes_from_filename(fname, regex):
         Dictionary of match key/values where the keys are the names from the named groups in the regex
         None if no matches
     '''
-    p = re.compile(regex)
+    p = compile_regex(regex)
     m = p.search(fname)
     if m is None:
         return None
@@ -56,55 +57,156 @@ def get_attributes_from_filename(fname, regex):
         return m.groupdict()
 
 
-#############
-# unittests #
-#############
-class TestController(unittest.TestCase):
-    def setUp(self):
-        pass
-
-    def test_get_attributes_from_filename(self):
-        ''' Happy path test case '''
-        fname = 'a1234-15-imager_1234567890.tif'
-        regex = '^(?P<assayId>\w+)-(?P<runId>\d+)-\w+.tif$'
-        attributes = get_attributes_from_filename(fname, regex)
-        expected = {
-                'assayId': 'a1234',
-                'runId': '15'
-                }
-        self.assertEqual(attributes, expected, 'Attribute dictionaries do not match')
-
-    def test_get_attributes_from_filename_nomatch(self):
-        ''' No matching keys are found '''
-        fname = 'readme.txt'
-        regex = '^(?P<assayId>\w+)-(?P<runId>\d+)-\w+.tif$'
-        attributes = get_attributes_from_filename(fname, regex)
-        self.assertIsNone(attributes, 'Expected None since there should be no matches')
-
-    def test_get_attributes_from_filename_partialmatch_rigid(self):
-        ''' At least one matching key is found, but not all, and regex expects all '''
-        fname = 'a1234-imager_1234567890.tif'
-        regex = '^(?P<assayId>\w+)-(?P<runId>\d+)-\w+.tif$'
-        attributes = get_attributes_from_filename(fname, regex)
-        self.assertIsNone(attributes, 'Expected None since the regex was rigid and expected all matches')
-
-    def test_get_attributes_from_filename_partialmatch_flexible(self):
-        ''' At least one matching key is found, but not all, and regex is okay with just some '''
-        fname = 'a1234-imager_1234567890.tif'
-        regex = '^(?P<assayId>\w+)-((?P<runId>\d+)-)?\w+.tif$'
-        attributes = get_attributes_from_filename(fname, regex)
-        expected = {
-                'assayId': 'a1234',
-                'runId': None
-                }
-        self.assertEqual(attributes, expected, 'Expected some key/values since the regex was flexible')
-
-def AllModuleTests():
-    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
-    return unittest.TestSuite([suite1])
-
-########
-# MAIN #
-########
-if __name__ == '__main__':
-    unittest.main()
+# Compiled patterns by regex string, kept for the life of the process
+compiledRegexes = {}
+
+# Routers by routing configuration, kept for the life of the process
+routers = {}
+
+DefaultMaxFilenameLength = 1024 # The maximum length of an S3 key
+
+def compile_regex(regex, guard=False):
+    '''
+    Return the compiled pattern for regex. Each regex is only compiled once per process.
+
+    If guard is True, raise ValueError if the regex contains a nested quantifier such as (\w+)+ that
+    can lead to catastrophic backtracking.
+    '''
+    if guard and has_nested_quantifier(regex):
+        raise ValueError('Regex has a nested quantifier and may backtrack catastrophically: ' + regex)
+    p = compiledRegexes.get(regex, None)
+    if p is None:
+        p = re.compile(regex)
+        compiledRegexes[regex] = p
+    return p
+
+def has_nested_quantifier(regex):
+    '''
+    Conservative check for a repeated group that itself contains a repeat, e.g., (a+)+ or (\w*-?)*
+
+    Returns: True if such a construct is found
+    '''
+    stack = [] # One entry per open group: True if the group contains a quantifier
+    quantified = False # True if the last closed group contained a quantifier
+    inClass = False
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == '\\':
+            i += 2
+            quantified = False
+            continue
+        if inClass:
+            inClass = (c != ']')
+        elif c == '[':
+            inClass = True
+            quantified = False
+        elif c == '(':
+            stack.append(False)
+        elif c == ')' and len(stack) > 0:
+            quantified = stack.pop()
+            if quantified and len(stack) > 0:
+                stack[-1] = True
+            i += 1
+            continue
+        elif c in '*+{':
+            if quantified:
+                return True
+            if len(stack) > 0:
+                stack[-1] = True
+        quantified = False
+        i += 1
+    return False
+
+class FilenameRouter(object):
+    '''
+    Ordered routing table of filename regexes.
+
+    Each route is a dictionary with a 'regex' and optionally a key 'prefix' and/or 'suffix'.
+    A key is only matched against the regexes of the routes whose prefix and suffix it has (routes with
+    neither apply to every key). Candidates are found with dictionary lookups (one per distinct prefix or
+    suffix length) rather than by trying every regex, and are tried in table order. The first match wins.
+
+    If guard is True, regexes with nested quantifiers are rejected when the router is built
+    and keys longer than maxKeyLength are not matched at all.
+    '''
+    def __init__(self, routes, guard=False, maxKeyLength=DefaultMaxFilenameLength):
+        self.routes = []
+        self.byPrefix = {}
+        self.bySuffix = {}
+        self.anyRoutes = []
+        self.guard = guard
+        self.maxKeyLength = maxKeyLength
+
+        for (order, route) in enumerate(routes):
+            prefix = route.get('prefix', '')
+            suffix = route.get('suffix', '')
+            self.routes.append((prefix, suffix, compile_regex(route['regex'], guard)))
+            if len(prefix) > 0:
+                self.byPrefix.setdefault(prefix, []).append(order)
+            elif len(suffix) > 0:
+                self.bySuffix.setdefault(suffix, []).append(order)
+            else:
+                self.anyRoutes.append(order)
+
+        self.prefixLengths = sorted(set(len(prefix) for prefix in self.byPrefix))
+        self.suffixLengths = sorted(set(len(suffix) for suffix in self.bySuffix))
+
+    def get_candidates(self, key):
+        ''' Return the routes that apply to key, in table order '''
+        orders = list(self.anyRoutes)
+        for n in self.prefixLengths:
+            orders.extend(self.byPrefix.get(key[:n], []))
+        for n in self.suffixLengths:
+            orders.extend(self.bySuffix.get(key[-n:], []))
+        orders.sort()
+
+        candidates = []
+        for order in orders:
+            (prefix, suffix, p) = self.routes[order]
+            if key.endswith(suffix): # The prefix (if any) is already known to match
+                candidates.append(p)
+        return candidates
+
+    def get_attributes(self, key):
+        '''
+        Returns:
+            Dictionary of match key/values from the first matching route (see get_attributes_from_filename)
+            None if no route matches
+        '''
+        if self.guard and len(key) > self.maxKeyLength:
+            logging.warning('Key is too long to match against filename regexes: ' + key[:self.maxKeyLength] + '...')
+            return None
+
+        for p in self.get_candidates(key):
+            m = p.search(key)
+            if m is not None:
+                return m.groupdict()
+        return None
+
+def get_router(configs):
+    '''
+    Return the FilenameRouter for the configs, or None if no file name processing is configured.
+
+    The routes are the dataFilenameRoutes list followed by dataFilenameRegex (if set) as a catch-all route.
+    dataFilenameRegexGuard and dataFilenameMaxLength enable and tune the backtracking guard.
+    Routers are built once per distinct configuration. For compiled configs (configutils.ConfigSnapshot), the router
+    built by the compiler is returned directly.
+    '''
+    if hasattr(configs, 'router'):
+        return configs.router
+    routes = list(configs.get('dataFilenameRoutes', []))
+    dataFilenameRegex = configs.get('dataFilenameRegex', '')
+    if len(dataFilenameRegex) > 0:
+        routes.append({'regex': dataFilenameRegex})
+    if len(routes) == 0:
+        return None
+
+    guard = configs.get('dataFilenameRegexGuard', False)
+    maxKeyLength = configs.get('dataFilenameMaxLength', DefaultMaxFilenameLength)
+    routerKey = json.dumps([routes, guard, maxKeyLength], sort_keys=True)
+    router = routers.get(routerKey, None)
+    if router is None:
+        router = FilenameRouter(routes, guard, maxKeyLength)
+        routers[routerKey] = router
+    return router
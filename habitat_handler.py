@@ -24,10 +24,14 @@ Author: Ken Robbins, March 2016
 '''
 
 import logging
-import unittest
 import json
 import metadata
+import esutils
+import indexbackend
 import configutils
+import retryqueue
+import manifest
+import metrics
 
 Debug = True
 
@@ -36,124 +40,122 @@ logLevel = logging.INFO
 logging.basicConfig(format=logFormat, level=logLevel)
 logging.info('Loading lambda function habitat_handler...')
 
+# Compile and validate the configs (importing the parser plugins) at cold start rather than while handling an event
+configutils.get_configs()
+
 
 def event_handler(event, context):
+    '''
+    Handle every s3 record in the event. All of the extracted attributes are indexed with a single bulk request.
+
+    Returns:
+        For an event with a single record: objectId on success, False if no attributes could be extracted,
+        None if indexing failed.
+        For an event with several records: a list with one such result per record, in record order.
+    '''
     logging.info('Received s3 object event... ')
-    logging.debug('Event = ' + json.dumps(event, indent=4))
-
-    configs = configutils.load_configs()
+    if Debug and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('Event = ' + json.dumps(event, indent=4))
 
-    attributes = metadata.get_attributes(event, configs)
-    if attributes is None:
-        logging.error('get_attributes returned None. Nothing will be indexed')
-        return False
+    configs = configutils.get_configs()
 
-    objectId = metadata.save_attributes(attributes, configs['esEndpoint'])
-    if objectId is not None:
-        logging.info('Successfully handled s3 object created/updated event. objectID=' + objectId)
-        return objectId
+    results = handle_records(metadata.get_s3_records(event), configs)
+    if len(results) == 1:
+        return results[0]
     else:
-        logging.error('save_attributes returned an error. Indexing may not be complete.')
-        return None
-
-#############
-# unittests #
-#############
-class TestController(unittest.TestCase):
-    def setUp(self):
-        self.configs = configutils.load_configs()
-        self.bucket = self.configs['bucket']
-
-    def test_handler(self):
-        event = {
-          "Records": [
-            {
-              "eventVersion": "2.0",
-              "eventTime": "1970-01-01T00:00:00.000Z",
-              "requestParameters": {
-                "sourceIPAddress": "127.0.0.1"
-              },
-              "s3": {
-                "configurationId": "testConfigRule",
-                "object": {
-                  "eTag": "0123456789abcdef0123456789abcdef",
-                  "sequencer": "0A1B2C3D4E5F678901",
-                  "key": "data/unittest-a1234-15-imager_1234567890.tif",
-                  "size": 1024
-                },
-                "bucket": {
-                  "arn": "arn:aws:s3:::"+self.bucket,
-                  "name": self.bucket,
-                  "ownerIdentity": {
-                    "principalId": "EXAMPLE"
-                  }
-                },
-                "s3SchemaVersion": "1.0"
-              },
-              "responseElements": {
-                "x-amz-id-2": "EXAMPLE123/5678abcdefghijklambdaisawesome/mnopqrstuvwxyzABCDEFGH",
-                "x-amz-request-id": "EXAMPLE123456789"
-              },
-              "awsRegion": "us-east-1",
-              "eventName": "ObjectCreated:Put",
-              "userIdentity": {
-                "principalId": "aPrincipalId"
-              },
-              "eventSource": "aws:s3"
-            }
-          ]
-        }
-
-        # Get the existing version if already indexed
-        # objectId creation assumes a lot and is therefore brittle
-        import esutils
-        objectId = self.bucket + '/data/unittest-a1234-15-imager_1234567890.tif'
-        result = esutils.getById(objectId, self.configs['esEndpoint'])
-        if result is not None:
-            version = result['_version'] + 1
+        return results
+
+def handle_records(records, configs, partitions=1):
+    '''
+    Extract the attributes for the s3 event records (partitioned by key across partitions threads, see
+    metadata.get_attributes_for_records) and index them all with a single bulk request.
+    Attributes that fail to index are queued for retry if indexRetry is configured (see retryqueue).
+
+    Records for removed objects (deletes and lifecycle expirations) remove the objects' documents from the index
+    with bulk requests instead.
+
+    Records for created manifests (keys under manifestPrefix) write the documents of all of the data files listed
+    in the manifest instead (see manifest.index_manifest). Their result is the manifest's objectId if every row
+    was indexed.
+
+    The records for the same key are coalesced so that only the latest one (by S3 event sequencer, or the last one
+    in the batch if there is no sequencer) is extracted and written. The other records get the same result.
+    The sequencer is also used as the document version, so an event older than the one already indexed is rejected
+    by the index (see esutils.getVersionArgs).
+
+    Returns: list with one result per record, in record order: objectId on success (a metadata.QueuedId if the
+    write failed but was queued for retry, which counts as handled), False if no attributes could be extracted,
+    None if indexing (or removal) failed.
+    '''
+    metrics.start(configs)
+    latest = {} # Position of the latest record for each key
+    for (i, record) in enumerate(records):
+        recordKey = get_record_key(record)
+        if recordKey not in latest or get_record_order(record) >= get_record_order(records[latest[recordKey]]):
+            latest[recordKey] = i
+    createdPositions = []
+    removedPositions = []
+    manifestPositions = []
+    for i in sorted(latest.values()):
+        if metadata.is_removal_record(records[i]):
+            removedPositions.append(i)
+        elif manifest.is_manifest_record(records[i], configs):
+            manifestPositions.append(i)
+        else:
+            createdPositions.append(i)
+    if len(latest) < len(records):
+        logging.info('Coalesced {} records into {}'.format(len(records), len(latest)))
+    results = [None] * len(records)
+
+    with metrics.timer('extract'):
+        attributesList = metadata.get_attributes_for_records([records[i] for i in createdPositions], configs, partitions)
+    objectIds = metadata.save_attributes_batch(attributesList, indexbackend.get_backend(configs), retryqueue.get_retry_queue(configs))
+    for (i, attributes, objectId) in zip(createdPositions, attributesList, objectIds):
+        if attributes is None:
+            logging.error('get_attributes returned None. Nothing will be indexed')
+            results[i] = False
+        elif isinstance(objectId, metadata.QueuedId):
+            logging.warning('Index write failed and was queued for retry. objectID=' + objectId)
+            results[i] = objectId
+        elif objectId is not None:
+            logging.info('Successfully handled s3 object created/updated event. objectID=' + objectId)
+            results[i] = objectId
+        else:
+            logging.error('save_attributes returned an error. Indexing may not be complete. key=' + attributes['key'])
+
+    for i in manifestPositions:
+        manifestAttributes = metadata.get_attributes_from_record(records[i])
+        counts = manifest.index_manifest(metadata.get_s3(), manifestAttributes, configs, indexbackend.get_backend(configs),
+                retryqueue.get_retry_queue(configs))
+        if counts is None or counts['failed'] > 0:
+            logging.error('Manifest was not completely indexed. key=' + manifestAttributes['key'])
+        elif counts['indexed'] + counts['queued'] == 0:
+            logging.error('Manifest has no rows to index. key=' + manifestAttributes['key'])
+            results[i] = False
+        else:
+            results[i] = esutils.makeUniqueId(manifestAttributes)
+
+    removedList = [metadata.get_removed_attributes(records[i]) for i in removedPositions]
+    objectIds = metadata.delete_attributes_batch(removedList, indexbackend.get_backend(configs))
+    for (i, attributes, objectId) in zip(removedPositions, removedList, objectIds):
+        if objectId is not None:
+            results[i] = objectId
         else:
-            version = 1
-
-        # Do the actual test
-        objectId = event_handler(event, None)
-        self.assertIsNotNone(objectId, 'event_handler failed')
-
-        # Check the results
-        result = esutils.getById(objectId, self.configs['esEndpoint'])
-        expected = {
-                u'_type': u'habitat-testtype',
-                u'_source': {
-                    u'bodykey2': u'value2',
-                    u'bodykey1': u'value1',
-                    's3meta1': u'metaValue1',
-                    's3meta2': u'metaValue2',
-                    u'LastModified': 'DUMMY_LASTMODIFIED',
-                    u'ContentLength': 115,
-                    u'runId': u'15',
-                    u'bucket': self.bucket,
-                    u'user': u'aPrincipalId',
-                    u'key': u'data/unittest-a1234-15-imager_1234567890.tif',
-                    u'region': u'us-east-1',
-                    u'assayId': u'a1234',
-                    u'size': 1024
-                    },
-                u'_index': u'habitatunittest',
-                u'_version': version,
-                u'found': True,
-                u'_id': self.bucket + '/data/unittest-a1234-15-imager_1234567890.tif'
-                }
-
-        source = result['_source']
-        self.assertIsNotNone(source.get('LastModified', None), 'Missing the LastModified attribute')
-        result['_source']['LastModified'] = 'DUMMY_LASTMODIFIED'
-        self.assertEqual(result, expected, 'Get from ES did not match what was expected')
-
-def AllModuleTests():
-    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
-    return unittest.TestSuite([suite1])
-
-########
-# MAIN #
-########
-if __name__ == '__main__':
-    unittest.main()
+            logging.error('Could not remove the document for removed object. key=' + attributes['key'])
+    if len(removedPositions) > 0:
+        logging.info('Removed {} of {} documents'.format(len([r for r in objectIds if r]), len(removedPositions)))
+
+    for (i, record) in enumerate(records):
+        results[i] = results[latest[get_record_key(record)]]
+
+    logging.info('Handled {} of {} records successfully'.format(len([r for r in results if r]), len(results)))
+    metrics.emit(records=len(records), extracted=len(createdPositions), removed=len(removedPositions), manifests=len(manifestPositions),
+            failed=len([r for r in results if not r]))
+    return results
+
+def get_record_key(record):
+    return (record['s3']['bucket']['name'], record['s3']['object']['key'])
+
+def get_record_order(record):
+    ''' Sequencers compare as strings once right padded to the same length (records without one sort first) '''
+    return record['s3']['object'].get('sequencer', '').upper().ljust(esutils.SequencerDigits, '0')
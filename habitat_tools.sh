@@ -28,22 +28,15 @@
 # If I need a package, install in the local directory using: pip install <package> -t .
 # and make sure to add it to the zip below. 
 
-# Load configuration
-region=`python configutils.py region`
-bucket=`python configutils.py bucket`
-awsAccountId=`python configutils.py awsAccountId`
-metafileMode=`python configutils.py metafileMode`
-daysBeforeIA=`python configutils.py daysBeforeIA`
-daysBeforeGlacier=`python configutils.py daysBeforeGlacier`
-daysBeforeExpire=`python configutils.py daysBeforeExpire`
-esDomain=`python configutils.py esDomain`
-awsAccountId=`python configutils.py awsAccountId`
+# Load configuration (validated and compiled once, see configutils.compile_configs)
+shellConfigs=`python configutils.py --shell` || exit 1
+eval "$shellConfigs"
 
 # Locally defined configuration
 functionName="habitatHandler-${bucket}"
 zipFile="lambda_deployment.zip"
 filesToDeploy="habitat_handler.py esutils.py metadata.py filenamemeta.py objectmeta.py configutils.py \
-    metafile.py defaultMetafileParser.py defaultDataBodyParser.py habitatconfig.json \
+    metafile.py defaultMetafileParser.py defaultDataBodyParser.py pluginregistry.py messagequeue.py retryqueue.py indexbackend.py sqlitebackend.py metrics.py manifest.py habitatconfig.json \
     secret.py elasticsearch requests urllib3 requests_aws4auth"
 lambdaEventHandler="habitat_handler.event_handler"
 unittestTif="unittest-sampledata.tif"
@@ -54,28 +47,52 @@ unittestCustom="unittest-samplemetadata.custom"
 # Utility functions
 make_zip()
 {
+    # Ship compiled modules so that they are not compiled on every cold start, and leave out the tests
     rm $zipFile
     chmod -R +r $filesToDeploy
-    zip -r $zipFile $filesToDeploy
+    # Compile with python2 (the Lambda runtime). The top level modules are listed as .py files, so add their .pyc files too.
+    python2 -m compileall -q $filesToDeploy
+    compiledFiles=""
+    for f in $filesToDeploy
+    do
+        case $f in
+            *.py) compiledFiles="$compiledFiles ${f%.py}.pyc" ;;
+        esac
+    done
+    zip -r $zipFile $filesToDeploy $compiledFiles -x '*/tests/*' '*/test/*' 'test_*'
 }
 
 add_bucket_notification()
 {
     # In the future, we could add a suffix filter too, but I think that it may just be simpler
     # to just say that anything in /data is a data file to be handled.
+    # Removals are always for the data files (whatever the metafileMode) so that their documents are removed from the index.
 
-    if [ $metafileMode = "disable" ]
-    then
-        prefix="data/"
-    elif [ $metafileMode = "written_first" ]
-    then
-        prefix="data/"
-    elif [ $metafileMode = "written_last" ]
+    # notificationPrefix is the data/ or meta/ prefix (metafilePairing) by metafileMode, as compiled by configutils
+    prefix="$notificationPrefix"
+
+    # Created manifests (manifestPrefix, which is never under the data or meta prefix) are sent to the handler too
+    manifestNotification=""
+    if [ -n "$manifestNotificationPrefix" ]
     then
-        prefix="meta/"
-    else
-        echo "ERROR in config file. Valid values for metafileMode are: none, written_first, written_last"
-        exit 1
+        manifestNotification=$(cat << EOF
+      ,{
+        "Id": "notifyId_3",
+        "LambdaFunctionArn": "arn:aws:lambda:${region}:${awsAccountId}:function:${functionName}",
+        "Events": ["s3:ObjectCreated:*"],
+        "Filter": {
+            "Key": {
+                "FilterRules": [
+                    {
+                        "Name": "prefix",
+                        "Value": "${manifestNotificationPrefix}"
+                    }
+                ]
+            }
+        }
+      }
+EOF
+)
     fi
 
     notifyFile="notification.json"
@@ -96,7 +113,23 @@ add_bucket_notification()
                 ]
             }
         }
+      },
+      {
+        "Id": "notifyId_2",
+        "LambdaFunctionArn": "arn:aws:lambda:${region}:${awsAccountId}:function:${functionName}",
+        "Events": ["s3:ObjectRemoved:*", "s3:LifecycleExpiration:*"],
+        "Filter": {
+            "Key": {
+                "FilterRules": [
+                    {
+                        "Name": "prefix",
+                        "Value": "${dataPrefix}"
+                    }
+                ]
+            }
+        }
       }
+      ${manifestNotification}
     ]
 }
 EOF
@@ -114,35 +147,14 @@ add_bucket_tags()
 
 add_bucket_lifecycle()
 {
-    # TODO KLR: If any config values are 0 or missing, omit that section from the JSON
-    # Perhaps I should create a python utility to do this instead of cramming it into bash syntax
+    # The rules are compiled by configutils from daysBeforeIA, daysBeforeGlacier and daysBeforeExpire (0 or missing omits a step)
+    if [ -z "$lifecycleConfiguration" ]
+    then
+        echo "No daysBeforeIA, daysBeforeGlacier or daysBeforeExpire in the config file. Skipping the bucket lifecycle."
+        return
+    fi
     lifecycleFile="lifecycle.json"
-    cat > $lifecycleFile << EOF
-{
-  "Rules": [
-      {
-          "ID": "lifecycle_id1",
-          "Prefix": "",
-          "Status": "Enabled",
-
-          "Transitions": [
-            {
-              "Days": ${daysBeforeIA},
-              "StorageClass": "STANDARD_IA"
-            },
-            {
-              "Days": ${daysBeforeGlacier},
-              "StorageClass": "GLACIER"
-            }
-          ],
-
-          "Expiration": {
-              "Days": ${daysBeforeExpire}
-          }
-      }
-  ]
-}
-EOF
+    echo "$lifecycleConfiguration" > $lifecycleFile
     aws s3api put-bucket-lifecycle-configuration --bucket $bucket --lifecycle-configuration  file://${lifecycleFile}
 }
 
@@ -282,6 +294,14 @@ case ${option} in
         done 
       ;; 
 
+    createindex) echo "Creating the ElasticSearch index template and index"
+        python -m esutils createIndex
+      ;;
+
+    rolloverindex) echo "Rolling the ElasticSearch write alias over to a new index if needed (run periodically when esRollover is set)"
+        python -m esutils rolloverIndex
+      ;;
+
     updateesdomain) echo "Updating ElasticSearch domain"
         echo "*** Not completely implemented yet"
         # TODO KLR: flesh out
@@ -318,6 +338,11 @@ case ${option} in
         python -m esutils getcli $objectId
       ;; 
 
+    backfill) echo "Indexing the objects already in the bucket (resumes from backfill_checkpoint.json if present)..."
+        shift
+        python -m backfill "$@"
+      ;;
+
     deleteall) echo "*** About to delete everything!!! ***"
         echo "*** Proceeding will delete:"
         echo "    !!! S3 bucket $bucket and all of its contents !!!"
@@ -343,8 +368,9 @@ case ${option} in
       echo "  Commands:"
       echo "    createcode | updatecode | updatecodeconfig | publishcode"
       echo "    createbucket | updatebucket"
-      echo "    createesdomain | updateesdomain"
+      echo "    createesdomain | updateesdomain | createindex | rolloverindex"
       echo "    testdata | testmeta"
+      echo "    backfill [--prefix data/] [--listers 8] [--workers 32] [--restart] [--from-shadow]"
       echo "    deleteall" 
       echo "  Typical sequence: createesdomain, <wait 15 minutes for domain to be created>, createcode, createbucket, testdata"
       exit 1
@@ -0,0 +1,124 @@
+'''
+File: indexbackend.py
+
+The index that habitat stores the extracted attributes in, behind one interface so that the backend can be chosen
+by configuration:
+    elasticsearch: the AWS Elasticsearch Service (esutils). The default.
+    sqlite: an embedded SQLite database file (sqlitebackend), for small or single-application habitats that do
+            not need a cluster, and for benchmarking the pipeline offline.
+
+Configured with:
+    "indexBackend": "elasticsearch" | "sqlite",
+    "sqlitePath": "<path of the SQLite database file>"
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import logging
+import json
+import esutils
+
+class IndexBackend(object):
+    '''
+    Interface of an index backend. Documents are identified by esutils.makeUniqueId of their attributes.
+
+    Writes follow the Elasticsearch semantics of esutils: a document carrying the sequencer of its S3 event is
+    not overwritten (or removed) by an older event, and a stale write counts as success. A full write keeps the
+    attributes that a manifest row merged into the document (see esutils.keepManifestAttributes).
+    '''
+    def index(self, attributes):
+        ''' Returns: objectId on success, None otherwise '''
+        raise NotImplementedError()
+
+    def bulk_index(self, attributesList):
+        ''' Returns: list of objectId (or None on failure) in the same order as attributesList '''
+        raise NotImplementedError()
+
+    def bulk_merge(self, attributesList):
+        '''
+        Merge each of attributesList into its document (creating it if there is none), keeping the other attributes
+        and the version of the document. Returns: list of objectId (or None on failure) in the same order as attributesList
+        '''
+        raise NotImplementedError()
+
+    def get(self, objectId):
+        ''' Returns: the document as a dictionary with _id and _source, or None if there is none '''
+        raise NotImplementedError()
+
+    def search(self, query, pageSize=esutils.DefaultPageSize, sliceId=None, maxSlices=None, sort=None, fields=None):
+        ''' Generator over all of the hits for query (an Elasticsearch query clause). See esutils.searchHits. '''
+        raise NotImplementedError()
+
+    def bulk_delete(self, attributesList):
+        ''' Returns: list of objectId (or None on failure) in the same order as attributesList. Missing documents count as removed. '''
+        raise NotImplementedError()
+
+class ElasticsearchBackend(IndexBackend):
+    ''' The AWS Elasticsearch Service at esEndpoint '''
+    def __init__(self, esEndpoint):
+        self.esEndpoint = esEndpoint
+
+    def index(self, attributes):
+        return esutils.indexAttributes(attributes, self.esEndpoint)
+
+    def bulk_index(self, attributesList):
+        return esutils.bulkIndexAttributes(attributesList, self.esEndpoint)
+
+    def bulk_merge(self, attributesList):
+        return esutils.bulkMergeAttributes(attributesList, self.esEndpoint)
+
+    def get(self, objectId):
+        try:
+            return esutils.getById(objectId, self.esEndpoint)
+        except esutils.NotFoundError:
+            return None
+
+    def search(self, query, pageSize=esutils.DefaultPageSize, sliceId=None, maxSlices=None, sort=None, fields=None):
+        return esutils.searchHits(query, self.esEndpoint, pageSize, sliceId, maxSlices, sort, fields)
+
+    def bulk_delete(self, attributesList):
+        return esutils.bulkDeleteAttributes(attributesList, self.esEndpoint)
+
+# Backends by configuration, kept for the life of the process
+backends = {}
+
+def get_backend(configs):
+    ''' Return the IndexBackend configured by indexBackend, creating it on first use '''
+    backendType = configs.get('indexBackend', 'elasticsearch')
+    if backendType == 'sqlite':
+        backendKey = (backendType, configs.get('sqlitePath', 'habitat.db'))
+    elif backendType == 'elasticsearch':
+        backendKey = (backendType, configs['esEndpoint'])
+    else:
+        raise ValueError('Unknown indexBackend: ' + backendType)
+
+    backend = backends.get(backendKey, None)
+    if backend is None:
+        if backendType == 'sqlite':
+            import sqlitebackend # Only imported (with sqlite3) when it is configured
+            backend = sqlitebackend.SqliteBackend(backendKey[1], configs.get('esFieldMappings', {}).keys())
+        else:
+            backend = ElasticsearchBackend(backendKey[1])
+        backends[backendKey] = backend
+    return backend
+
+def as_backend(backend):
+    ''' Return backend, or an ElasticsearchBackend if backend is an Elasticsearch endpoint (as callers used to pass) '''
+    if isinstance(backend, basestring):
+        backendKey = ('elasticsearch', backend)
+        if backendKey not in backends:
+            backends[backendKey] = ElasticsearchBackend(backend)
+        return backends[backendKey]
+    return backend
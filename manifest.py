@@ -0,0 +1,221 @@
+'''
+File: manifest.py
+
+Register many data files from one uploaded manifest file instead of one companion metadata file per data file.
+
+A manifest is a CSV (with a header row), TSV (with a header row) or JSONL (one json object per line) file under
+manifestPrefix, optionally gzipped (.csv.gz, ...). Each row describes one data file: its key is in the manifestKeyColumn
+column (by default key) and the other non-empty columns are its attributes, e.g.:
+
+    key,assayId,runId,operator
+    data/run15/plate1.tif,a1234,15,"Smith, J."
+    data/run15/plate2.tif,a1234,15,"Smith, J."
+
+When the manifest is created, the attributes of the row (plus those from the file name regexes, see filenamemeta) are
+merged into the documents of all of the listed data files with bulk requests of manifestBatchSize rows, so the
+attributes from the data file's own events are kept, and the documents of data files not indexed yet are created. The
+names of the row's attributes are kept in manifestFields, so that a later event for the data file (or a backfill) keeps
+them too. The data files themselves are not read, so there is no S3 request per row. The manifest is streamed: it is read a chunk at a
+time and only one batch of rows is held in memory, so its size is not limited by the Lambda memory. Quoted fields
+(including ones with embedded delimiters and newlines) are parsed by the csv module.
+
+Rows that cannot be parsed or have no key are skipped with a warning.
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import itertools
+import logging
+import urllib
+import zlib
+import json
+import csv
+import esutils
+import filenamemeta
+import metadata
+import metrics
+
+DefaultKeyColumn = 'key'
+DefaultBatchSize = 500 # Rows per bulk request
+ReadChunkBytes = 1024 * 1024 # Bytes per read of the manifest body
+Utf8Bom = '\xef\xbb\xbf'
+
+def is_manifest_record(record, configs):
+    ''' Returns: True if the s3 event record is for a manifest (under manifestPrefix, if it is configured) '''
+    manifestPrefix = configs.get('manifestPrefix', '')
+    return len(manifestPrefix) > 0 and urllib.unquote_plus(record['s3']['object']['key']).decode('utf8').startswith(manifestPrefix)
+
+def get_format(key):
+    ''' Returns: (format, gzipped) for the manifest key by its extension: csv (the default), tsv or jsonl '''
+    gzipped = key.endswith('.gz')
+    if gzipped:
+        key = key[:-len('.gz')]
+    extension = key[key.rfind('.') + 1:].lower()
+    if extension in ('jsonl', 'ndjson'):
+        return ('jsonl', gzipped)
+    if extension in ('tsv', 'tab'):
+        return ('tsv', gzipped)
+    return ('csv', gzipped)
+
+def iter_chunks(body, gzipped=False, chunkBytes=ReadChunkBytes):
+    ''' Generator over the (decompressed) data of body (anything with read(nbytes)) a chunk at a time '''
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    while True:
+        chunk = body.read(chunkBytes)
+        if not chunk:
+            break
+        metrics.count('s3BytesRead', len(chunk))
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        yield chunk
+    if decompressor is not None:
+        yield decompressor.flush()
+
+def iter_lines(chunks):
+    ''' Generator over the lines (with their line endings) of the data in chunks, without the UTF-8 byte order mark '''
+    pending = ''
+    first = True
+    for chunk in chunks:
+        if first and chunk:
+            if chunk.startswith(Utf8Bom):
+                chunk = chunk[len(Utf8Bom):]
+            first = False
+        lines = (pending + chunk).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if pending:
+        yield pending
+
+def decode(value):
+    return value.strip().decode('utf8')
+
+def iter_rows(lines, manifestFormat):
+    '''
+    Generator over the rows of the manifest lines as (line number, dictionary of the column values, or None if the
+    row could not be parsed). Blank lines are skipped.
+    '''
+    if manifestFormat == 'jsonl':
+        for (i, line) in enumerate(lines, 1):
+            if len(line.strip()) == 0:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield (i, row if isinstance(row, dict) else None)
+        return
+
+    reader = csv.reader(lines, delimiter='\t' if manifestFormat == 'tsv' else ',', skipinitialspace=True)
+    header = None
+    for cells in reader:
+        if len(cells) == 0:
+            continue
+        if header is None:
+            header = [decode(cell) for cell in cells]
+            continue
+        if len(cells) > len(header):
+            yield (reader.line_num, None)
+        else:
+            yield (reader.line_num, dict(itertools.izip(header, (decode(cell) for cell in cells))))
+
+def get_row_attributes(row, manifestAttributes, keyColumn, router):
+    '''
+    Returns: the attributes of the data file described by the row (None if it has no key): the bucket and region of
+    the manifest, the key, the manifest key, the file name regex attributes, the non-empty row values and the names
+    of those values (manifestFields)
+    '''
+    key = row.get(keyColumn, None)
+    if not key:
+        return None
+    attributes = {
+            'region': manifestAttributes['region'],
+            'bucket': manifestAttributes['bucket'],
+            'user': manifestAttributes['user'],
+            'manifest': manifestAttributes['key']
+            }
+    if router is not None:
+        with metrics.timer('filename'):
+            keyAttributes = router.get_attributes(key)
+        if keyAttributes is not None:
+            attributes.update(keyAttributes)
+    values = dict((name, value) for (name, value) in row.items() if value not in ('', None) and name != keyColumn)
+    attributes.update(values)
+    attributes[esutils.ManifestFields] = sorted(values)
+    attributes['key'] = key
+    return attributes
+
+def index_rows(rows, manifestAttributes, configs, backend, retryQueue=None):
+    '''
+    Merge the manifest rows (see iter_rows) into their documents with one bulk request per manifestBatchSize rows.
+    Rows that fail to index are put on retryQueue, if given.
+
+    Returns: dictionary of counts: rows, indexed, queued (for retry), failed (to index, and not queued) and skipped
+    (could not be parsed, or no key)
+    '''
+    keyColumn = configs.get('manifestKeyColumn', DefaultKeyColumn)
+    batchSize = configs.get('manifestBatchSize', DefaultBatchSize)
+    router = filenamemeta.get_router(configs)
+    counts = {'rows': 0, 'indexed': 0, 'queued': 0, 'failed': 0, 'skipped': 0}
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batchSize))
+        if len(batch) == 0:
+            break
+        attributesList = []
+        for (lineNumber, row) in batch:
+            attributes = get_row_attributes(row, manifestAttributes, keyColumn, router) if row is not None else None
+            if attributes is None:
+                logging.warning('Skipping manifest {} line {}: cannot parse it or it has no {}'.format(manifestAttributes['key'], lineNumber, keyColumn))
+                counts['skipped'] += 1
+            else:
+                attributesList.append(attributes)
+        objectIds = metadata.save_attributes_batch(attributesList, backend, retryQueue, merge=True)
+        counts['rows'] += len(batch)
+        counts['indexed'] += len([objectId for objectId in objectIds if objectId is not None and not isinstance(objectId, metadata.QueuedId)])
+        counts['queued'] += len([objectId for objectId in objectIds if isinstance(objectId, metadata.QueuedId)])
+        counts['failed'] += len([objectId for objectId in objectIds if objectId is None])
+        metrics.count('manifestRows', len(batch))
+    return counts
+
+def index_manifest(s3, manifestAttributes, configs, backend, retryQueue=None):
+    '''
+    Stream the manifest object (manifestAttributes are those of its event record, see metadata.get_attributes_from_record)
+    and write the documents for all of its rows (see index_rows).
+
+    Returns: the counts from index_rows, or None if the manifest could not be read
+    '''
+    bucket = manifestAttributes['bucket']
+    key = manifestAttributes['key']
+    (manifestFormat, gzipped) = get_format(key)
+    logging.info('Indexing the rows of {} manifest {}...'.format(manifestFormat, key))
+    try:
+        metrics.count('s3Requests')
+        body = s3.get_object(Bucket=bucket, Key=key)['Body']
+    except Exception as e:
+        logging.error(e)
+        logging.error('Error getting manifest {} from bucket {}.'.format(key, bucket))
+        return None
+
+    with metrics.timer('manifest'):
+        rows = iter_rows(iter_lines(iter_chunks(body, gzipped)), manifestFormat)
+        try:
+            counts = index_rows(rows, manifestAttributes, configs, backend, retryQueue)
+        except (csv.Error, zlib.error, UnicodeDecodeError) as e:
+            logging.error(e)
+            logging.error('Error reading manifest {} from bucket {}. The rows before the error were indexed.'.format(key, bucket))
+            return None
+    logging.info('Manifest {}: {rows} rows, {indexed} indexed, {queued} queued for retry, {failed} failed, {skipped} skipped'.format(key, **counts))
+    return counts
@@ -0,0 +1,101 @@
+'''
+File: messagequeue.py
+
+Message queues used by the ingest worker and the index retry subsystem: SQS, and an in-process stand-in for SQS
+(LocalQueue) for testing or for running without AWS.
+
+Messages are dictionaries with an 'id', a 'receipt' (used to delete the message) and a 'body' (a string).
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import logging
+import threading
+import json
+import time
+
+SqsMaxMessages = 10 # Most messages that SQS returns from one receive or deletes in one batch
+SqsMaxDelaySeconds = 900
+
+class SqsQueue(object):
+    ''' An SQS queue '''
+    def __init__(self, queueUrl, sqs=None):
+        self.queueUrl = queueUrl
+        if sqs is None:
+            import boto3
+            sqs = boto3.client('sqs')
+        self.sqs = sqs
+
+    def send(self, body, delaySeconds=0):
+        ''' Send a message that will not be received for delaySeconds (at most 900) '''
+        self.sqs.send_message(QueueUrl=self.queueUrl, MessageBody=body,
+                DelaySeconds=int(min(delaySeconds, SqsMaxDelaySeconds)))
+
+    def receive(self, maxMessages, waitSeconds):
+        ''' Long-poll for up to maxMessages (at most 10) messages, waiting up to waitSeconds for the first one '''
+        response = self.sqs.receive_message(QueueUrl=self.queueUrl, MaxNumberOfMessages=min(maxMessages, SqsMaxMessages),
+                WaitTimeSeconds=waitSeconds)
+        return [{'id': message['MessageId'], 'receipt': message['ReceiptHandle'], 'body': message['Body']}
+                for message in response.get('Messages', [])]
+
+    def delete(self, messages):
+        for start in range(0, len(messages), SqsMaxMessages):
+            entries = [{'Id': str(i), 'ReceiptHandle': message['receipt']}
+                    for (i, message) in enumerate(messages[start:start + SqsMaxMessages])]
+            response = self.sqs.delete_message_batch(QueueUrl=self.queueUrl, Entries=entries)
+            for failure in response.get('Failed', []):
+                logging.error('Could not delete message: ' + json.dumps(failure))
+
+class LocalQueue(object):
+    '''
+    In-process stand-in for SQS with the same interface as SqsQueue.
+
+    As with SQS, received messages are hidden until they are deleted or until visibilityTimeout seconds have
+    passed, after which they are received again.
+    '''
+    def __init__(self, visibilityTimeout=30):
+        self.visibilityTimeout = visibilityTimeout
+        self.condition = threading.Condition()
+        self.messages = [] # [message, visibleAfter] in send order
+        self.nextId = 0
+
+    def send(self, body, delaySeconds=0):
+        with self.condition:
+            self.messages.append([{'id': str(self.nextId), 'receipt': str(self.nextId), 'body': body}, time.time() + delaySeconds])
+            self.nextId += 1
+            self.condition.notify_all()
+
+    def receive(self, maxMessages, waitSeconds):
+        deadline = time.time() + waitSeconds
+        with self.condition:
+            while True:
+                now = time.time()
+                received = []
+                for entry in self.messages:
+                    if entry[1] <= now and len(received) < min(maxMessages, SqsMaxMessages):
+                        entry[1] = now + self.visibilityTimeout
+                        received.append(entry[0])
+                if len(received) > 0 or now >= deadline:
+                    return received
+                nextVisible = min([deadline] + [entry[1] for entry in self.messages])
+                self.condition.wait(max(nextVisible - now, 0.001))
+
+    def delete(self, messages):
+        receipts = set(message['receipt'] for message in messages)
+        with self.condition:
+            self.messages = [entry for entry in self.messages if entry[0]['receipt'] not in receipts]
+
+    def __len__(self):
+        return len(self.messages)
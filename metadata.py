@@ -29,18 +29,37 @@ Author: Ken Robbins, March 2016
 '''
 
 import logging
-import unittest
+import threading
 import json
 import urllib
-import boto3
+import zlib
 import esutils
+import indexbackend
 import filenamemeta
 import objectmeta
 import metafile
+import pluginregistry
+import metrics
+from multiprocessing.pool import ThreadPool
 
 Debug = True
 
-s3 = boto3.client('s3')
+# S3 client, created on first use (see get_s3) so that importing metadata does not import boto3
+s3 = None
+
+# Thread pool for fetching metadata sources concurrently, created on first use and grown with the number of
+# concurrent callers (e.g., record partitions or backfill workers), see run_sources
+sourcePool = None
+sourcePoolSize = 0
+sourceCallers = 0
+DefaultSourceThreads = 4
+
+# Thread pool for extracting the attributes of partitions of records in parallel, created on first use
+recordPool = None
+recordPoolSize = 0
+
+# Guards the creation (and growth) of the thread pools, which may be asked for by several threads at once
+poolLock = threading.Lock()
 
 '''
     # TODO KLR: Optionally save attributes on the S3 object itself
@@ -53,49 +72,142 @@ s3 = boto3.client('s3')
 '''
 
 
+def get_s3():
+    ''' Return the S3 client for the process, creating it on first use '''
+    global s3
+    if s3 is None:
+        import boto3
+        s3 = boto3.client('s3')
+    return s3
+
 def get_attributes(event, configs):
     '''
     Use various methods, guided by configuration parameters, to extract meta data about the file.
     event is an event passed to a Lambda function in response to an s3 create or update action.
     configs is a dictionary of configs
 
+    Only the first record in the event is used. See get_attributes_batch() to handle all records.
+
     Returns: dictionary with key/value pairs
     '''
     # Event extracted attributes
     attributes = get_attributes_from_event(event)
+    return extract_attributes(attributes, configs)
+
+def get_attributes_batch(event, configs):
+    '''
+    Extract attributes for every s3 record in the event (see get_s3_records for the supported envelopes).
+    A failure on one record does not prevent the remaining records from being handled.
+
+    Returns: list of attribute dictionaries in record order. An entry is None if extraction failed for that record.
+    '''
+    return get_attributes_for_records(get_s3_records(event), configs)
+
+def get_attributes_for_records(records, configs, partitions=1):
+    '''
+    Extract attributes for every s3 record in records.
+
+    If partitions > 1, the records are hashed by key into that many partitions which are handled in parallel.
+    Records within a partition (and so all of the records for any one key) are handled in order.
+
+    Returns: list of attribute dictionaries in record order. An entry is None if extraction failed for that record.
+    '''
+    global recordPool, recordPoolSize
+    resolver = metafile.CompanionResolver(get_s3(), configs) # Shared so that companion lookups are cached across the batch
+    def extract(positions):
+        results = []
+        for i in positions:
+            try:
+                attributes = get_attributes_from_record(records[i])
+                results.append(extract_attributes(attributes, configs, resolver))
+            except Exception as e:
+                logging.error(e)
+                logging.error('Error extracting attributes for record: ' + json.dumps(records[i].get('s3', {}).get('object', {})))
+                results.append(None)
+        return results
+
+    if partitions <= 1 or len(records) <= 1:
+        return extract(range(len(records)))
+
+    partitionPositions = [[] for n in range(partitions)]
+    for (i, record) in enumerate(records):
+        recordKey = record['s3']['bucket']['name'] + '/' + record['s3']['object']['key']
+        partitionPositions[zlib.crc32(recordKey.encode('utf8')) % partitions].append(i)
+    partitionPositions = [positions for positions in partitionPositions if len(positions) > 0]
+
+    with poolLock:
+        if recordPool is None or recordPoolSize < partitions:
+            if recordPool is not None:
+                recordPool.close()
+            recordPool = ThreadPool(partitions)
+            recordPoolSize = partitions
+        pending = recordPool.map_async(extract, partitionPositions, chunksize=1) # Submitted before the pool can be closed
+    attributesList = [None] * len(records)
+    for (positions, results) in zip(partitionPositions, pending.get()):
+        for (i, attributes) in zip(positions, results):
+            attributesList[i] = attributes
+    return attributesList
+
+def extract_attributes(attributes, configs, resolver=None):
+    '''
+    Add the attributes from all of the configured sources to the attributes already extracted from the event.
+    attributes must contain at least the bucket and key of the object. It is updated in place.
+
+    In written_last mode the event is for the companion metadata file, so the key (and size) attributes are
+    replaced with those of the data file it describes.
+    resolver is the metafile.CompanionResolver to use. Pass the same one for all of the events in a batch.
+
+    Returns: dictionary with key/value pairs
+    '''
     bucket = attributes['bucket']
     key = attributes['key']
-    parts = key.split('/')
-    if len(parts) >= 2:
-        prefix = parts[0] # Expect to be 'data' or 'meta'
 
     # Companion metadata file extracted attributes
     metafileFormat = configs.get('metafileFormat', 'json') # One of  "json", "csv", "custom"
     metafileParserModule = configs.get('metafileParserModule', None) # Consider empty string the same as None
     metafileMode = configs.get('metafileMode', 'disable') # One of "disable", "written_first", "written_last"
+    if metafileMode != 'disable' and resolver is None:
+        resolver = metafile.CompanionResolver(get_s3(), configs)
+    sources = []
+    if metafileMode == 'written_first':
+        sources.append((metrics.timed('metafile', metafile.get_attributes_from_companion), (resolver, bucket, key, metafileParserModule)))
+    elif metafileMode == 'written_last':
+        sources.append((metrics.timed('metafile', metafile.get_attributes_from_metadatafile), (get_s3(), bucket, key, metafileFormat, metafileParserModule)))
+        found = resolver.find_datafile(bucket, key)
+        if found is not None:
+            (key, attributes['size']) = found
+            attributes['key'] = key
+        attributes.pop('sequencer', None) # Orders the events for the metadata file, not for the data file
+
+    # S3 object attributes (head and/or body)
+    inspectHead = configs.get('inspectS3head', False)
+    getMetadataFromS3Object = configs.get('getMetadataFromObject', False)
+    dataMaxBodyBytes = configs.get('dataBodyParserMaxBytes', 0)
+    dataPlugin = configs.get('dataBodyParserModule', '')
+    registry = pluginregistry.get_registry(configs)
+    sources.append((metrics.timed('s3object', objectmeta.get_attributes_from_object), (get_s3(), bucket, key,
+            inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, dataPlugin, registry)))
+
+    # The S3 sources each need their own round trip, so run them concurrently
+    results = run_sources(sources, configs)
     if metafileMode != 'disable':
-        metafileAttributes = metafile.get_attributes_from_metadatafile(s3, bucket, key, metafileFormat, metafileParserModule)
+        metafileAttributes = results.pop(0)
         if metafileAttributes is not None:
             attributes.update(metafileAttributes)
         else:
             pass # Silently ignore no matches for now
 
     # Filename extracted attributes
-    dataFilenameRegex = configs.get('dataFilenameRegex', '')
-    if len(dataFilenameRegex) > 0:
-        key_attributes = filenamemeta.get_attributes_from_filename(key, dataFilenameRegex)
+    router = filenamemeta.get_router(configs)
+    if router is not None:
+        with metrics.timer('filename'):
+            key_attributes = router.get_attributes(key)
         if key_attributes is not None:
             attributes.update(key_attributes)
         else:
             pass # Silently ignore no filename matches for now
 
-    # S3 object attributes (head and/or body)
-    inspectHead = configs.get('inspectS3head', False)
-    getMetadataFromS3Object = configs.get('getMetadataFromObject', False)
-    dataMaxBodyBytes = configs.get('dataBodyParserMaxBytes', 0)
-    dataPlugin = configs.get('dataBodyParserModule', '')
-    s3attributes = objectmeta.get_attributes_from_object(s3, bucket, key,
-            inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, dataPlugin)
+    s3attributes = results.pop(0)
     if s3attributes is not None:
             attributes.update(s3attributes)
     else:
@@ -103,35 +215,177 @@ def get_attributes(event, configs):
  
     return attributes
 
-def save_attributes(attributes, esEndpoint):
+def run_sources(sources, configs):
+    '''
+    Run the (function, args) pairs in sources concurrently on a process-wide thread pool. The last one runs on the
+    calling thread. The pool has metadataSourceThreads threads, or more when more callers run sources at once (e.g.,
+    record partitions or backfill workers), so that the sources of concurrent callers do not wait on each other.
+
+    Returns: list of the results in the same order as sources, regardless of the order in which they complete
+    '''
+    global sourcePool, sourcePoolSize, sourceCallers
+    if len(sources) <= 1:
+        return [function(*args) for (function, args) in sources]
+
+    with poolLock:
+        sourceCallers += 1
+        size = max(configs.get('metadataSourceThreads', DefaultSourceThreads), sourceCallers * (len(sources) - 1))
+        if sourcePool is None or sourcePoolSize < size:
+            if sourcePool is not None:
+                sourcePool.close() # Its queued sources still run
+            sourcePool = ThreadPool(size)
+            sourcePoolSize = size
+        pending = [sourcePool.apply_async(function, args) for (function, args) in sources[:-1]]
+    try:
+        (function, args) = sources[-1]
+        last = function(*args)
+        return [result.get() for result in pending] + [last]
+    finally:
+        with poolLock:
+            sourceCallers -= 1
+
+class QueuedId(unicode):
+    '''
+    The objectId of a document that failed to index but was put on the retry queue, so the retryqueue Drainer will
+    write it. It is a (true) objectId so that callers count it as handled and do not redeliver the event as well
+    (e.g., QueueWorker deletes its message). Use isinstance to tell it apart from a written document.
+    '''
+    pass
+
+def save_attributes(attributes, backend, retryQueue=None):
     '''
     Store the extracted attributes into a search index.
-    In the future we could also save values to a database, but I think that ElasticSearch
-    seems to solve most needs so far.
+    backend is the index backend (see indexbackend.get_backend), or an Elasticsearch endpoint.
+    If indexing fails and a retryQueue (see retryqueue.get_retry_queue) is given, the attributes are put on it
+    to be indexed later.
 
-    Returns: objectId on success, None otherwise
+    Returns: objectId on success, a QueuedId if it was queued for retry, None otherwise
     '''
-    if Debug:
-        logging.info('Attributes: ' + str(attributes))
+    if Debug and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('Attributes: ' + str(attributes))
 
-    objectId = esutils.indexAttributes(attributes, esEndpoint)
+    with metrics.timer('indexWrite'):
+        objectId = indexbackend.as_backend(backend).index(attributes)
     if objectId is None:
-        logging.error('TODO KLR: Decide what to do when index fails. Perhaps write to a queue that is is connected to SNS?')
-        return None
+        return queue_for_retry(attributes, retryQueue)
     else:
         return objectId
 
+def save_attributes_batch(attributesList, backend, retryQueue=None, merge=False):
+    '''
+    Store a list of extracted attributes into the search index with a single bulk request.
+    With merge, they are merged into the existing documents instead (see IndexBackend.bulk_merge).
+    None entries (failed extractions) are skipped and reported as failures.
+    Attributes that fail to index are put on retryQueue, if given.
+
+    Returns: list of objectId (a QueuedId if queued for retry, or None on failure) in the same order as attributesList
+    '''
+    results = [None] * len(attributesList)
+    positions = [i for i, attributes in enumerate(attributesList) if attributes is not None]
+    if len(positions) == 0:
+        return results
+
+    if Debug and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('Attributes batch: ' + str([attributesList[i] for i in positions]))
+
+    with metrics.timer('indexWrite'):
+        backend = indexbackend.as_backend(backend)
+        objectIds = (backend.bulk_merge if merge else backend.bulk_index)([attributesList[i] for i in positions])
+    for (i, objectId) in zip(positions, objectIds):
+        results[i] = objectId if objectId is not None else queue_for_retry(attributesList[i], retryQueue)
+    return results
+
+def queue_for_retry(attributes, retryQueue):
+    ''' Returns: the QueuedId of the attributes if they were put on retryQueue, None otherwise '''
+    if retryQueue is None:
+        logging.error('Index failed and no indexRetry is configured. key=' + attributes['key'])
+        return None
+    try:
+        retryQueue.put(attributes, error='Index write failed')
+        logging.warning('Index failed. Queued for retry. key=' + attributes['key'])
+        return QueuedId(esutils.makeUniqueId(attributes))
+    except Exception as e:
+        logging.error(e)
+        logging.error('Index failed and could not be queued for retry. key=' + attributes['key'])
+        return None
+
+def get_s3_records(event):
+    '''
+    Return the list of s3 event records contained in the event.
+
+    Handles events delivered directly by S3 as well as S3 events fanned in through SNS (Sns.Message)
+    or SQS (body), including S3 -> SNS -> SQS. Records without an s3 section (e.g., s3:TestEvent) are dropped.
+    '''
+    records = []
+    for record in event.get('Records', []):
+        if 's3' in record:
+            records.append(record)
+        elif 'Sns' in record:
+            records.extend(get_s3_records(json.loads(record['Sns']['Message'])))
+        elif 'body' in record:
+            body = json.loads(record['body'])
+            if 'Message' in body and 'Records' not in body:
+                body = json.loads(body['Message']) # SNS envelope delivered through SQS
+            records.extend(get_s3_records(body))
+    return records
+
+def is_removal_record(record):
+    '''
+    Returns: True if the s3 event record is for an object that was removed (deleted, or expired by a lifecycle rule)
+    rather than created or updated
+    '''
+    eventName = record.get('eventName', '')
+    return eventName.startswith('ObjectRemoved:') or eventName.startswith('LifecycleExpiration:')
+
+def get_removed_attributes(record):
+    '''
+    Extract the attributes identifying the object of a removal event record (removal records have no size)
+
+    Return a new dict with the attributes inserted
+    '''
+    attributes = {
+            'region': record['awsRegion'],
+            'bucket': record['s3']['bucket']['name'],
+            'key': urllib.unquote_plus(record['s3']['object']['key']).decode('utf8')
+            }
+    sequencer = record['s3']['object'].get('sequencer', None)
+    if sequencer:
+        attributes['sequencer'] = sequencer
+    return attributes
+
+def delete_attributes_batch(attributesList, backend):
+    '''
+    Remove the documents for the objects identified by attributesList (see get_removed_attributes) from the
+    search index with bulk requests.
+
+    Returns: list of objectId (or None on failure) in the same order as attributesList
+    '''
+    if len(attributesList) == 0:
+        return []
+    if Debug and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('Removing: ' + str([attributes['key'] for attributes in attributesList]))
+    with metrics.timer('indexDelete'):
+        return indexbackend.as_backend(backend).bulk_delete(attributesList)
+
 def get_attributes_from_event(event):
     '''
-    Extract attributes from the event that we want to index
+    Extract attributes from the first record of the event that we want to index
 
     Return a new dict with the attributes inserted
     '''
-    region = event['Records'][0]['awsRegion']
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.unquote_plus(event['Records'][0]['s3']['object']['key']).decode('utf8')
-    user = event['Records'][0]['userIdentity']['principalId']
-    size = event['Records'][0]['s3']['object']['size']
+    return get_attributes_from_record(get_s3_records(event)[0])
+
+def get_attributes_from_record(record):
+    '''
+    Extract attributes from a single s3 event record that we want to index
+
+    Return a new dict with the attributes inserted
+    '''
+    region = record['awsRegion']
+    bucket = record['s3']['bucket']['name']
+    key = urllib.unquote_plus(record['s3']['object']['key']).decode('utf8')
+    user = record['userIdentity']['principalId']
+    size = record['s3']['object']['size']
 
     attributes = {
             'region': region,
@@ -140,130 +394,10 @@ def get_attributes_from_event(event):
             'user': user,
             'size': size, # Keep this or rely on ContentLength?
             }
+    sequencer = record['s3']['object'].get('sequencer', None)
+    if sequencer:
+        attributes['sequencer'] = sequencer # Orders the events for the key (see esutils.sequencerToVersion)
     # We should use the eventName ('s3:ObjectCreated:' prefix) and current time
     # to a CreatedTime since that is otherwise lost
 
     return attributes
-
-
-#############
-# unittests #
-#############
-class TestController(unittest.TestCase):
-    def setUp(self):
-        import configutils
-        self.configs = configutils.load_configs()
-
-        ''' Assumes that a test file has been uploaded and matches the expected name and content '''
-        self.region = self.configs['region']
-        self.bucket = self.configs['bucket']
-        self.assayId = 'a1234'
-        self.runId = '15'
-        self.key = 'data/unittest-{}-{}-imager_1234567890.tif'.format(self.assayId, self.runId)
-        self.user = 'aPrincipalId'
-        self.contentLength = 115
-        self.size = 1024
-
-        self.event = {
-          "Records": [
-            {
-              "eventVersion": "2.0",
-              "eventTime": "1970-01-01T00:00:00.000Z",
-              "requestParameters": {
-                "sourceIPAddress": "127.0.0.1"
-              },
-              "s3": {
-                "configurationId": "testConfigRule",
-                "object": {
-                  "eTag": "0123456789abcdef0123456789abcdef",
-                  "sequencer": "0A1B2C3D4E5F678901",
-                  "key": self.key,
-                  "size": self.size
-                },
-                "bucket": {
-                  "arn": "arn:aws:s3:::" + self.bucket,
-                  "name": self.bucket,
-                  "ownerIdentity": {
-                    "principalId": "EXAMPLE"
-                  }
-                },
-                "s3SchemaVersion": "1.0"
-              },
-              "responseElements": {
-                "x-amz-id-2": "EXAMPLE123/5678abcdefghijklambdaisawesome/mnopqrstuvwxyzABCDEFGH",
-                "x-amz-request-id": "EXAMPLE123456789"
-              },
-              "awsRegion": self.region,
-              "eventName": "ObjectCreated:Put",
-              "userIdentity": {
-                "principalId": self.user
-              },
-              "eventSource": "aws:s3"
-            }
-          ]
-        }
-
-        self.expected_head_attributes = {
-                'LastModified': '2016-03-26T16:14:13+00:00',
-                'ContentLength': self.contentLength
-                }
-
-        self.expected_event_attributes = {
-                'region': self.region,
-                'bucket': self.bucket,
-                'user': self.user,
-                'key': self.key,
-                'size': self.size
-                }
-
-        self.expected_body_attributes = {
-                'bodykey1': 'value1',
-                'bodykey2': 'value2'
-                }
-
-        self.expected_filename_attributes = {
-                'assayId': self.assayId,
-                'runId': self.runId
-                }
-
-        self.expected_s3meta_attributes = {
-                's3meta1': 'metaValue1',
-                's3meta2': 'metaValue2'
-                }
-
-        self.expected_attributes = {}
-        self.expected_attributes.update(self.expected_event_attributes)
-        self.expected_attributes.update(self.expected_head_attributes)
-        self.expected_attributes.update(self.expected_s3meta_attributes)
-        self.expected_attributes.update(self.expected_body_attributes)
-        self.expected_attributes.update(self.expected_filename_attributes)
-
-    def test_get_all_attributes(self):
-        attributes = get_attributes(self.event, self.configs)
-        self.assertIsNotNone(attributes.get('LastModified', None), 'Missing the LastModified attribute')
-        attributes['LastModified'] = '2016-03-26T16:14:13+00:00'
-        self.assertEqual(attributes, self.expected_attributes, 'Attribute dictionaries do not match')
-
-    def test_get_attributes_from_event(self):
-        attributes = get_attributes_from_event(self.event)
-        self.assertEqual(attributes, self.expected_event_attributes, 'Event dictionaries do not match')
-
-    def test_save_attributes(self):
-        expectedObjectId = '{}/{}'.format(self.bucket, self.key)
-        objectId = save_attributes(self.expected_attributes, self.configs['esEndpoint'])
-        print 'Object ID:', str(objectId)
-        self.assertEqual(objectId, expectedObjectId, 'Object Ids do not match')
-
-def AllModuleTests():
-    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
-    return unittest.TestSuite([suite1])
-        
-########
-# MAIN #
-########
-if __name__ == '__main__':
-    logFormat = '%(levelname)s:%(asctime)s:HABITAT:%(module)s-%(lineno)d: %(message)s'
-    logLevel = logging.INFO
-    logging.basicConfig(format=logFormat, level=logLevel)
-
-    unittest.main()
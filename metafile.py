@@ -21,10 +21,13 @@ Author: Ken Robbins, March 2016
    limitations under the License.
 '''
 
-import unittest
 import logging
-import boto3
+import botocore.exceptions
 import json
+import pluginregistry
+import metrics
+
+DatafileMaxKeys = 100 # The most keys listed (in one LIST) to find the data file of a metadata file
 
 def get_attributes_from_metadatafile(s3, bucket, key, metafileFormat, metafileParserModule):
     '''
@@ -39,6 +42,27 @@ def get_attributes_from_metadatafile(s3, bucket, key, metafileFormat, metafilePa
     if data is None:
         return None
 
+    return parse_metafile_data(data, metafileFormat, metafileParserModule)
+
+def get_attributes_from_companion(resolver, bucket, dataKey, metafileParserModule):
+    '''
+    Extract attributes from the companion metadata file of the data file dataKey, found using resolver
+    (a CompanionResolver). The format is determined by the extension of the companion that is found.
+
+    Returns:
+        Dictionary of matched key/values extracted according to the various options
+        Dictionary may be empty if no matches are found
+        None if there is no companion metadata file or on error
+    '''
+    found = resolver.get_metafile_data(bucket, dataKey)
+    if found is None:
+        return None
+
+    (data, metafileFormat) = found
+    return parse_metafile_data(data, metafileFormat, metafileParserModule)
+
+def parse_metafile_data(data, metafileFormat, metafileParserModule):
+    ''' Interpret data according to metafileFormat (one of "json", "csv", "custom") '''
     if metafileFormat == 'json':
         attributes = get_attributes_as_json(data)
     elif metafileFormat == 'csv':
@@ -48,6 +72,27 @@ def get_attributes_from_metadatafile(s3, bucket, key, metafileFormat, metafilePa
 
     return attributes
 
+def format_metafile_data(attributes, metafileFormat):
+    '''
+    The inverse of parse_metafile_data for the json and csv formats: write attributes as a metadata file body.
+    For csv, the values must not contain the characters that get_attributes_as_csv cannot read back (a comma,
+    a double quote or a line break).
+
+    Returns: (data, content type)
+    Raises: ValueError for the custom format, or attributes that cannot be written as csv
+    '''
+    if metafileFormat == 'json':
+        return (json.dumps(attributes), 'application/json')
+    if metafileFormat == 'csv':
+        names = sorted(attributes)
+        cells = names + [unicode(attributes[name]) for name in names]
+        for cell in cells:
+            if any(c in cell for c in ',"\r\n') or cell != cell.strip():
+                raise ValueError('Cannot write {!r} to a csv metadata file'.format(cell))
+        data = u','.join(names) + u'\n' + u','.join(cells[len(names):])
+        return (data.encode('utf8'), 'text/csv')
+    raise ValueError('Cannot write a {} metadata file'.format(metafileFormat))
+
 def get_attributes_as_json(data):
     ''' Interpret data as a json document (as a string) '''
     return json.loads(data)
@@ -85,7 +130,7 @@ def get_attributes_using_custom(data, plugin):
     '''
     logging.info('About to run custom metadata parser: ' + plugin)
     try:
-        parsermodule = __import__(plugin)
+        parsermodule = pluginregistry.load_plugin(plugin)
         attributes = parsermodule.parsebody(data)
         return attributes
     except:
@@ -107,6 +152,8 @@ def get_body_data_from_object(s3, bucket, key):
 
         response = s3.get_object(Bucket=bucket, Key=key)
         body = response['Body'].read()
+        metrics.count('s3Requests')
+        metrics.count('s3BytesRead', len(body))
 
         return body
     except Exception as e:
@@ -115,86 +162,118 @@ def get_body_data_from_object(s3, bucket, key):
         return None
 
 
-#############
-# unittests #
-#############
-class TestController(unittest.TestCase):
-    def setUp(self):
-        import configutils
-        self.configs = configutils.load_configs()
-
-        self.bucket = self.configs['bucket']
-        self.keyBase = 'meta/unittest-a1234-15-imager_1234567890.'
-        self.json_expected = {
-                'json1': 'jsonValue1',
-                'json2': 'jsonValue2'
-                }
-        self.csv_expected = {
-                'csv1': 'csvValue1',
-                'csv2': 'csvValue2',
-                'csv3': 'csvValue3'
-                }
-        self.custom_expected = {
-                'custom1': 'customValue1',
-                'custom2': 'customValue2'
-                }
-        self.plugin = 'defaultMetafileParser'
-
-    def test_get_body_data_from_object(self):
-        s3 = boto3.client('s3')
-        data = get_body_data_from_object(s3, self.bucket, self.keyBase + 'json')
-        expected = '''{
-    "json1": "jsonValue1",
-    "json2": "jsonValue2"
-}
-'''
-        self.assertEqual(data, expected, 'Body data does not match expectation')
+class CompanionResolver(object):
+    '''
+    Pairs data files with their companion metadata files, e.g., data/run1/foo.tif with meta/run1/foo.json
 
-    def test_get_attributes_as_json(self):
-        data = json.dumps(self.json_expected)
-        attributes = get_attributes_as_json(data)
-        self.assertEqual(attributes, self.json_expected, 'Attribute dictionaries do not match')
+    The companion of a data file has the same path after the prefix (metafilePairing dataPrefix and metaPrefix,
+    by default data/ and meta/) with the data file extension replaced by one of the metafileExtensions
+    (by default just the metafileFormat). The first extension in the list that exists wins.
 
-    def test_get_attributes_as_csv(self):
-        data = '''csv1,"csv2", csv3
-csvValue1,"csvValue2", csvValue3'''
-        attributes = get_attributes_as_csv(data)
-        self.assertEqual(attributes, self.csv_expected, 'Attribute dictionaries do not match')
-
-    def test_get_attributes_using_custom(self):
-        data = '''custom1=customValue1
-custom2=customValue2'''
-        attributes = get_attributes_using_custom(data, self.plugin)
-        self.assertEqual(attributes, self.custom_expected, 'Attribute dictionaries do not match')
-
-    def test_get_attributes_from_metadatafile_json(self):
-        ''' Test the json file format case '''
-        s3 = boto3.client('s3')
-        attributes = get_attributes_from_metadatafile(s3, self.bucket, self.keyBase + 'json', 'json', None)
-        self.assertEqual(attributes, self.json_expected, 'Attribute dictionaries do not match')
-        
-    def test_get_attributes_from_metadatafile_csv(self):
-        ''' Test the csv file format case '''
-        s3 = boto3.client('s3')
-        attributes = get_attributes_from_metadatafile(s3, self.bucket, self.keyBase + 'csv', 'csv', None)
-        self.assertEqual(attributes, self.csv_expected, 'Attribute dictionaries do not match')
-        
-    def test_get_attributes_from_metadatafile_custom(self):
-        ''' Test the custom file format case '''
-        s3 = boto3.client('s3')
-        attributes = get_attributes_from_metadatafile(s3, self.bucket, self.keyBase + 'custom', 'custom', self.plugin)
-        self.assertEqual(attributes, self.custom_expected, 'Attribute dictionaries do not match')
-
-def AllModuleTests():
-    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
-    return unittest.TestSuite([suite1])
-
-########
-# MAIN #
-########
-if __name__ == '__main__':
-    logFormat = '%(levelname)s:%(asctime)s:HABITAT:%(module)s-%(lineno)d: %(message)s'
-    logLevel = logging.INFO
-    logging.basicConfig(format=logFormat, level=logLevel)
-
-    unittest.main()
+    When there are several candidate keys, they are all probed with a single prefix LIST rather than a GET per
+    candidate. Use one resolver per batch of events: LIST results and missing keys are cached by the resolver, so
+    no prefix or key is probed twice within the batch.
+    '''
+    def __init__(self, s3, configs):
+        self.s3 = s3
+        pairing = configs.get('metafilePairing', {})
+        self.dataPrefix = pairing.get('dataPrefix', 'data/')
+        self.metaPrefix = pairing.get('metaPrefix', 'meta/')
+        metafileFormat = configs.get('metafileFormat', 'json')
+        self.extensions = configs.get('metafileExtensions', [metafileFormat])
+        if 'metafileExtensions' in configs:
+            self.formats = [extension if extension in ('json', 'csv') else 'custom' for extension in self.extensions]
+        else:
+            self.formats = [metafileFormat]
+        self.listings = {} # (bucket, prefix) -> {key: size}
+        self.missing = set() # (bucket, key) known not to exist
+
+    def get_stem(self, key, prefix):
+        ''' Return the key without prefix and without its extension, or None if key does not start with prefix '''
+        if not key.startswith(prefix):
+            return None
+        name = key[len(prefix):]
+        dot = name.rfind('.')
+        if dot > name.rfind('/'):
+            name = name[:dot]
+        return name
+
+    def list_prefix(self, bucket, prefix, maxKeys=None):
+        '''
+        Returns: dictionary of key to size for the objects starting with prefix (cached), leaving out the keys with a
+        further / after the prefix. If maxKeys is given, only the first page of at most maxKeys keys is listed.
+        '''
+        listing = self.listings.get((bucket, prefix), None)
+        if listing is None:
+            listing = {}
+            if maxKeys is not None:
+                pages = [self.s3.list_objects_v2(Bucket=bucket, Prefix=prefix, Delimiter='/', MaxKeys=maxKeys)]
+            else:
+                pages = self.s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix, Delimiter='/')
+            for page in pages:
+                for item in page.get('Contents', []):
+                    listing[item['Key']] = item['Size']
+            self.listings[(bucket, prefix)] = listing
+        return listing
+
+    def get_metafile_data(self, bucket, dataKey):
+        '''
+        Find and read the companion metadata file for dataKey.
+
+        Returns: (data, metafileFormat) or None if there is no companion
+        '''
+        stem = self.get_stem(dataKey, self.dataPrefix)
+        if stem is None:
+            return None
+        candidates = [(self.metaPrefix + stem + '.' + extension, metafileFormat)
+                for (extension, metafileFormat) in zip(self.extensions, self.formats)]
+
+        if len(candidates) > 1:
+            listing = self.list_prefix(bucket, self.metaPrefix + stem + '.')
+            candidates = [candidate for candidate in candidates if candidate[0] in listing]
+
+        for (metaKey, metafileFormat) in candidates:
+            if (bucket, metaKey) in self.missing:
+                continue
+            try:
+                logging.info('Getting metadata object for bucket {} and key {}...'.format(bucket, metaKey))
+                response = self.s3.get_object(Bucket=bucket, Key=metaKey)
+                data = response['Body'].read()
+                metrics.count('s3Requests')
+                metrics.count('s3BytesRead', len(data))
+                return (data, metafileFormat)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                    logging.error(e)
+                    logging.error('Error getting object {} from bucket {}.'.format(metaKey, bucket))
+                    return None
+                self.missing.add((bucket, metaKey))
+        logging.info('No companion metadata file found for key ' + dataKey)
+        return None
+
+    def find_datafile(self, bucket, metaKey):
+        '''
+        Find the data file that metaKey is the companion metadata file for, with one LIST of the keys that are the
+        stem with an extension (at most DatafileMaxKeys of them, in the same directory). A data file without an
+        extension is looked for with a HEAD if there is none.
+
+        Returns: (dataKey, size) or None if there is no such data file
+        '''
+        stem = self.get_stem(metaKey, self.metaPrefix)
+        if stem is None:
+            return None
+        listing = self.list_prefix(bucket, self.dataPrefix + stem + '.', DatafileMaxKeys)
+        matches = sorted(key for key in listing if self.get_stem(key, self.dataPrefix) == stem)
+        if len(matches) == 0:
+            try:
+                metrics.count('s3Requests')
+                response = self.s3.head_object(Bucket=bucket, Key=self.dataPrefix + stem)
+                return (self.dataPrefix + stem, response['ContentLength'])
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                    logging.error(e)
+            logging.warning('No data file found for metadata file ' + metaKey)
+            return None
+        if len(matches) > 1:
+            logging.warning('Several data files found for metadata file {}. Using {}'.format(metaKey, matches[0]))
+        return (matches[0], listing[matches[0]])
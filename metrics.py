@@ -0,0 +1,113 @@
+'''
+File: metrics.py
+
+Lightweight per-stage timings and counters for the indexing pipeline, emitted as structured JSON metric lines.
+
+A batch of records (one Lambda invocation, or one batch of a queue worker) is sampled with probability
+metricsSampleRate (0, the default, disables metrics). For a sampled batch, the wall time of each stage (the
+companion metadata file, the object head and body, the file name regexes, the index write) and counters such as the
+bytes read from S3 are accumulated across all of the threads handling the batch, and then written to stdout as a
+single JSON line, e.g.:
+
+    {"metric": "habitat", "records": 10, "stages": {"indexWrite": {"count": 1, "ms": 21.3, "maxMs": 21.3}, ...},
+     "counters": {"s3BytesRead": 400, "s3Requests": 10}}
+
+On Lambda, stdout goes to CloudWatch Logs, where metric filters can match on the fields. For a batch that is not
+sampled, the timers and counters do nothing.
+
+Usage:
+    metrics.start(configs)
+    with metrics.timer('indexWrite'):
+        ...
+    metrics.count('s3BytesRead', len(data))
+    metrics.emit(records=len(records))
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import contextlib
+import threading
+import random
+import json
+import time
+import sys
+
+lock = threading.Lock()
+sampled = False # Whether the current batch is sampled
+stages = {} # stage -> [count, total seconds, max seconds]
+counters = {}
+
+def start(configs):
+    ''' Start a batch, sampling it with probability metricsSampleRate. Returns: True if the batch is sampled '''
+    global sampled
+    sampleRate = configs.get('metricsSampleRate', 0)
+    with lock:
+        stages.clear()
+        counters.clear()
+        sampled = sampleRate > 0 and random.random() < sampleRate
+    return sampled
+
+def add_time(stage, seconds):
+    with lock:
+        entry = stages.setdefault(stage, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+@contextlib.contextmanager
+def timer(stage):
+    ''' Time the block as stage (if the batch is sampled) '''
+    if not sampled:
+        yield
+        return
+    startTime = time.time()
+    try:
+        yield
+    finally:
+        add_time(stage, time.time() - startTime)
+
+def timed(stage, function):
+    ''' Returns: function wrapped in a timer for stage '''
+    def call(*args):
+        with timer(stage):
+            return function(*args)
+    return call
+
+def count(name, value=1):
+    ''' Add value to the counter name (if the batch is sampled) '''
+    if not sampled:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+def get_record(dimensions):
+    ''' Returns: the metric record for the batch so far, with the dimensions (e.g., the number of records) added '''
+    with lock:
+        record = {'metric': 'habitat', 'time': time.time(), 'counters': dict(counters),
+                'stages': dict((stage, {'count': entry[0], 'ms': round(entry[1] * 1000, 3), 'maxMs': round(entry[2] * 1000, 3)})
+                        for (stage, entry) in stages.items())}
+    record.update(dimensions)
+    return record
+
+def emit(**dimensions):
+    ''' End the batch, writing its metric line to stdout if it is sampled. Returns: the record, or None if not sampled '''
+    global sampled
+    if not sampled:
+        return None
+    record = get_record(dimensions)
+    sampled = False
+    sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+    sys.stdout.flush()
+    return record
@@ -21,11 +21,16 @@ Author: Ken Robbins, March 2016
    limitations under the License.
 '''
 
-import unittest
 import logging
-import boto3
+import botocore.exceptions
+import pluginregistry
+import metrics
 
-def get_attributes_from_object(s3, bucket, key, inspectHead, getMetadataFromS3Object, maxBodyBytes, plugin):
+# S3 user metadata key that marks the user metadata of an object as a complete shadow copy of the metadata that
+# cannot be derived from the key or head (i.e., no body parsing or companion metadata file is needed). Set by the upload client.
+ShadowMarker = 'habitat-shadow'
+
+def get_attributes_from_object(s3, bucket, key, inspectHead, getMetadataFromS3Object, maxBodyBytes, plugin, registry=None):
     '''
     Extract metadata attributes from the s3 object.
     
@@ -33,13 +38,24 @@ def get_attributes_from_object(s3, bucket, key, inspectHead, getMetadataFromS3Ob
     Only extract values from head if inspectHead is True.
     Only extract value from the Metadata field of the S3 object if getMetadataFromS3Object is True.
 
-    When parsing the body of a file, only read and as far as needed up to maxBodyBytes.
+    When parsing the body of a file, only the first maxBodyBytes are fetched (with an HTTP Range request).
     Then runs a custom function on that data to return a dictionary of key/values.
     plugin is the name of the Python module to execute on the body.
     The module must contain a function called parsebody:
          attributes = parsebody(body)
     where body is a string containing the data to be parsed and attributes is a Dict()
     of key/value pairs. The values can be arbitrary.
+    If parsebody needs more of the file it may raise pluginregistry.NeedMoreData, and it is called again
+    with a longer body. Alternatively, the module may contain a function called parseranges:
+         attributes = parseranges(body)
+    where body is a RangedBody that the plugin uses to read whatever ranges (including the tail) it needs.
+
+    If body parsing is enabled, the head fields come from the same ranged response so no separate HEAD is made.
+
+    If registry (a pluginregistry.PluginRegistry) is provided, it selects the plugin and maxBodyBytes for the
+    object instead and the maxBodyBytes and plugin arguments are ignored. If no route matches the key but the
+    registry routes by content type, a HEAD gets the content type to select the route, and the body is only read
+    if one matches.
 
     s3 is an existing boto3 client object created from: s3 = boto3.client('s3')
 
@@ -51,15 +67,30 @@ def get_attributes_from_object(s3, bucket, key, inspectHead, getMetadataFromS3Ob
     try:
         logging.info('Getting object for bucket {} and key {}...'.format(bucket, key))
 
-        if maxBodyBytes > 0:
-            response = s3.get_object(Bucket=bucket, Key=key)
-        elif inspectHead or getMetadataFromS3Object:
+        response = None
+        if registry is not None:
+            route = registry.select(key)
+            if route is None and registry.has_content_type_routes():
+                metrics.count('s3Requests')
+                response = s3.head_object(Bucket=bucket, Key=key)
+                route = registry.select(key, response.get('ContentType', None))
+        elif maxBodyBytes > 0:
+            route = pluginregistry.ParserRoute(plugin, maxBodyBytes)
+        else:
+            route = None
+
+        body = None
+        if route is not None:
+            body = RangedBody(s3, bucket, key, route.maxBytes)
+            response = body.head
+        elif response is None and (inspectHead or getMetadataFromS3Object):
+            metrics.count('s3Requests')
             response = s3.head_object(Bucket=bucket, Key=key)
 
         attributes = {}
 
-        if maxBodyBytes > 0:
-            get_body_attributes_from_s3Response(response, maxBodyBytes, plugin, attributes)
+        if route is not None:
+            get_body_attributes_from_ranges(body, route, attributes)
 
         if inspectHead or getMetadataFromS3Object:
             get_head_attributes_from_s3Response(response, attributes, inspectHead, getMetadataFromS3Object)
@@ -70,21 +101,96 @@ def get_attributes_from_object(s3, bucket, key, inspectHead, getMetadataFromS3Ob
         logging.error('Error getting object {} from bucket {}.'.format(key, bucket))
         return None
 
-def get_body_attributes_from_s3Response(s3Response, maxBodyBytes, plugin, attributes):
+def get_body_attributes_from_ranges(body, route, attributes):
     '''
-    Read the specified number of bytes from the body and update attributes in place.
-    Use the custom plugin to parse the content of the body
+    Run the route's custom plugin on the body (a RangedBody) and update attributes in place.
+
+    parsebody plugins are given the first route.maxBytes bytes. Each time the plugin raises NeedMoreData, the
+    read is grown (to the requested size or else doubled) until the end of the object or route.limitBytes.
     '''
     try:
-        body = s3Response['Body'].read(maxBodyBytes)
-        logging.info('About to run custom data body parser: ' + plugin)
-        parsermodule = __import__(plugin)
-        body_attributes = parsermodule.parsebody(body)
+        logging.info('About to run custom data body parser: ' + route.plugin)
+        parsermodule = pluginregistry.load_plugin(route.plugin)
+        if hasattr(parsermodule, 'parseranges'):
+            body_attributes = parsermodule.parseranges(body)
+        else:
+            nbytes = route.maxBytes
+            while True:
+                try:
+                    body_attributes = parsermodule.parsebody(body.read_prefix(nbytes))
+                    break
+                except pluginregistry.NeedMoreData as e:
+                    if nbytes >= body.size or nbytes >= route.limitBytes:
+                        logging.warning('Body parser needs more than {} bytes. Giving up.'.format(nbytes))
+                        raise
+                    nbytes = min(max(e.nbytes or 0, nbytes * 2), route.limitBytes)
         attributes.update(body_attributes)
     except:
         logging.error('Problem during read() or parsing of S3 object body')
         raise
 
+class RangedBody(object):
+    '''
+    Reads byte ranges of an S3 object on demand with HTTP Range GETs instead of downloading the whole object.
+
+    The first range (the first firstBytes of the object) is fetched when the RangedBody is created. Its response
+    also supplies the head fields (head), with ContentLength set to the full object size rather than the range size.
+    '''
+    def __init__(self, s3, bucket, key, firstBytes):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.bytesRead = 0
+        self.prefix = ''
+        try:
+            response = self.get_range('bytes=0-{}'.format(firstBytes - 1))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidRange':
+                raise
+            # Ranges are not satisfiable for an empty object
+            response = s3.head_object(Bucket=bucket, Key=key)
+            response['Body'] = None
+
+        if response.get('ContentRange', None) is not None:
+            self.size = int(response['ContentRange'].split('/')[-1])
+        else:
+            self.size = response['ContentLength']
+        if response['Body'] is not None:
+            self.prefix = self.read_response(response)
+        response['ContentLength'] = self.size
+        self.head = response
+
+    def get_range(self, byteRange):
+        metrics.count('s3Requests')
+        return self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=byteRange)
+
+    def read_response(self, response):
+        data = response['Body'].read()
+        self.bytesRead += len(data)
+        metrics.count('s3BytesRead', len(data))
+        return data
+
+    def read_prefix(self, nbytes):
+        ''' Return the first nbytes of the object, only fetching the bytes not already read '''
+        if nbytes > len(self.prefix) and len(self.prefix) < self.size:
+            self.prefix += self.read_range(len(self.prefix), nbytes - 1)
+        return self.prefix[:nbytes]
+
+    def read_range(self, start, end):
+        ''' Return bytes start through end (inclusive, as in HTTP) of the object '''
+        end = min(end, self.size - 1)
+        if start > end:
+            return ''
+        if end < len(self.prefix):
+            return self.prefix[start:end + 1]
+        return self.read_response(self.get_range('bytes={}-{}'.format(start, end)))
+
+    def read_tail(self, nbytes):
+        ''' Return the last nbytes of the object '''
+        if nbytes <= 0:
+            return ''
+        return self.read_range(max(0, self.size - nbytes), self.size - 1)
+
 def get_head_attributes_from_s3Response(s3Response, attributes, inspectHead, getMetadataFromS3Object):
     ''' Grab the selected attributes and update the attributes dictionary in place '''
     head_attributes = {}
@@ -95,113 +201,19 @@ def get_head_attributes_from_s3Response(s3Response, attributes, inspectHead, get
         attributes.update(head_attributes)
 
     if getMetadataFromS3Object:
-        attributes.update(s3Response['Metadata'])
-
-
-#############
-# unittests #
-#############
-class TestController(unittest.TestCase):
-    def setUp(self):
-        import configutils
-        self.configs = configutils.load_configs()
-        self.bucket = self.configs['bucket']
-        self.key = 'data/unittest-a1234-15-imager_1234567890.tif'
-        self.body_expected = {
-                'bodykey1': 'value1',
-                'bodykey2': 'value2'
-                }
-        self.head_expected = {
-                'LastModified': 'DUMMY LASTMODIFIED',
-                'ContentLength': 115
-                }
-        self.s3meta_expected = {
-                's3meta1': 'metaValue1',
-                's3meta2': 'metaValue2'
-                }
-
-    def test_get_no_attributes_from_object(self):
-        s3 = boto3.client('s3')
-        inspectHead = False
-        getMetadataFromS3Object = False
-        dataMaxBodyBytes = 0
-        attributes = get_attributes_from_object(s3, self.bucket, self.key,
-                inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, None)
-        expected = {}
-        self.assertEqual(attributes, expected, 'Attribute dictionaries do not match')
-
-    def test_get_just_head_attributes_from_object(self):
-        s3 = boto3.client('s3')
-        inspectHead = True
-        getMetadataFromS3Object = False
-        dataMaxBodyBytes = 0
-        attributes = get_attributes_from_object(s3, self.bucket, self.key,
-                inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, None)
-        self.assertIsNotNone(attributes.get('LastModified', None), 'Missing the LastModified attribute')
-        attributes['LastModified'] = 'DUMMY LASTMODIFIED'
-        self.assertEqual(attributes, self.head_expected, 'Attribute dictionaries do not match')
-
-    def test_get_just_s3meta_attributes_from_object(self):
-        s3 = boto3.client('s3')
-        inspectHead = False
-        getMetadataFromS3Object = True
-        dataMaxBodyBytes = 0
-        attributes = get_attributes_from_object(s3, self.bucket, self.key,
-                inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, None)
-        self.assertEqual(attributes, self.s3meta_expected, 'Attribute dictionaries do not match')
-
-    def test_get_head_and_s3meta_attributes_from_object(self):
-        s3 = boto3.client('s3')
-        inspectHead = True
-        getMetadataFromS3Object = True
-        dataMaxBodyBytes = 0
-        attributes = get_attributes_from_object(s3, self.bucket, self.key,
-                inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, None)
-        self.assertIsNotNone(attributes.get('LastModified', None), 'Missing the LastModified attribute')
-        attributes['LastModified'] = 'DUMMY LASTMODIFIED'
-        expected = {}
-        expected.update(self.head_expected)
-        expected.update(self.s3meta_expected)
-        self.assertEqual(attributes, expected, 'Attribute dictionaries do not match')
-
-    def test_get_just_body_attributes_from_object(self):
-        s3 = boto3.client('s3')
-        inspectHead = False
-        getMetadataFromS3Object = False
-        dataMaxBodyBytes = 40
-        dataPlugin = 'defaultDataBodyParser'
-        attributes = get_attributes_from_object(s3, self.bucket, self.key,
-                inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, dataPlugin)
-        self.assertEqual(attributes, self.body_expected, 'Attribute dictionaries do not match')
-
-    def test_get_all_attributes_from_object(self):
-        s3 = boto3.client('s3')
-        inspectHead = True
-        getMetadataFromS3Object = True
-        dataMaxBodyBytes = 40
-        dataPlugin = 'defaultDataBodyParser'
-        attributes = get_attributes_from_object(s3, self.bucket, self.key,
-                inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, dataPlugin)
-        print '\n\nAttributes:'
-        print attributes
-        self.assertIsNotNone(attributes.get('LastModified', None), 'Missing the LastModified attribute')
-        attributes['LastModified'] = 'DUMMY LASTMODIFIED'
-        expected = {}
-        expected.update(self.body_expected)
-        expected.update(self.head_expected)
-        expected.update(self.s3meta_expected)
-        self.assertEqual(attributes, expected, 'Attribute dictionaries do not match')
-
-def AllModuleTests():
-    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
-    return unittest.TestSuite([suite1])
-
-########
-# MAIN #
-########
-if __name__ == '__main__':
-    logFormat = '%(levelname)s:%(asctime)s:HABITAT:%(module)s-%(lineno)d: %(message)s'
-    logLevel = logging.INFO
-    logging.basicConfig(format=logFormat, level=logLevel)
-
-    unittest.main()
+        attributes.update((name, value) for (name, value) in s3Response['Metadata'].items() if name != ShadowMarker)
+
+def get_attributes_from_shadow(s3, bucket, key, inspectHead):
+    '''
+    Extract the attributes from the head of the s3 object alone, if its user metadata is a shadow copy (see ShadowMarker).
+
+    Returns:
+        Dictionary of the head (if inspectHead) and user metadata attributes
+        None if the object has no shadow copy
+    '''
+    response = s3.head_object(Bucket=bucket, Key=key)
+    if ShadowMarker not in response.get('Metadata', {}):
+        return None
+    attributes = {}
+    get_head_attributes_from_s3Response(response, attributes, inspectHead, True)
+    return attributes
@@ -0,0 +1,152 @@
+'''
+File: pluginregistry.py
+
+Registry of the custom parser plugins for data file bodies and companion metadata files.
+
+Plugins are imported once per process (normally at cold start) instead of on every event.
+Data file bodies are routed to a parser by key prefix, key suffix and/or content type so that
+several file types can be handled by one habitat and so that no body bytes are read for files
+that have no parser.
+
+A plugin module must contain a function called parsebody:
+     attributes = parsebody(body)
+A body parser plugin may also declare how many bytes from the start of the file it needs:
+     MAX_BODY_BYTES = <number of bytes>
+and may raise NeedMoreData from parsebody to be called again with more of the file.
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import logging
+import json
+
+DefaultLimitBytes = 8 * 1024 * 1024 # Most that a body parser may grow its read to
+
+class NeedMoreData(Exception):
+    '''
+    Raised by a parsebody plugin when the body it was given is too short to parse.
+    nbytes is the total number of bytes it needs, or None to just get more.
+    '''
+    def __init__(self, nbytes=None):
+        Exception.__init__(self, 'Body parser needs more data ({} bytes)'.format(nbytes))
+        self.nbytes = nbytes
+
+# Imported plugin modules by name, kept for the life of the process
+loadedPlugins = {}
+
+# Registries by routing configuration, kept for the life of the process
+registries = {}
+
+def load_plugin(name):
+    ''' Import the named plugin module (only the first time it is needed) and return it '''
+    module = loadedPlugins.get(name, None)
+    if module is None:
+        logging.info('Loading parser plugin: ' + name)
+        module = __import__(name)
+        loadedPlugins[name] = module
+    return module
+
+class ParserRoute(object):
+    '''
+    A body parser plugin and the objects it applies to.
+
+    Any of prefix, suffix and contentType may be empty, in which case it matches everything.
+    maxBytes is the number of bytes to read from the start of the body for the parser.
+    limitBytes is the most that the read may grow to if the parser raises NeedMoreData.
+    '''
+    def __init__(self, plugin, maxBytes, prefix='', suffix='', contentType='', limitBytes=DefaultLimitBytes):
+        self.plugin = plugin
+        self.maxBytes = maxBytes
+        self.limitBytes = max(limitBytes, maxBytes)
+        self.prefix = prefix
+        self.suffix = suffix
+        self.contentType = contentType
+
+    def matches(self, key, contentType):
+        ''' contentType may be None if it is not known yet, in which case only routes without a contentType match '''
+        if not (key.startswith(self.prefix) and key.endswith(self.suffix)):
+            return False
+        if len(self.contentType) > 0:
+            return contentType is not None and contentType.split(';')[0].strip() == self.contentType
+        return True
+
+class PluginRegistry(object):
+    '''
+    Ordered table of body parser routes. The first matching route wins.
+
+    Each route is a dictionary with a 'module' and optionally 'prefix', 'suffix', 'contentType' and 'maxBytes'.
+    If maxBytes is omitted, the MAX_BODY_BYTES declared by the plugin module is used, and otherwise defaultMaxBytes.
+    A route may also set 'limitBytes', which defaults to defaultLimitBytes.
+    All plugin modules are imported when the registry is built.
+    '''
+    def __init__(self, routes, defaultMaxBytes=0, defaultLimitBytes=DefaultLimitBytes):
+        self.routes = []
+        for route in routes:
+            module = load_plugin(route['module'])
+            maxBytes = route.get('maxBytes', getattr(module, 'MAX_BODY_BYTES', defaultMaxBytes))
+            if maxBytes <= 0:
+                logging.warning('Ignoring body parser {} since it does not read any bytes'.format(route['module']))
+                continue
+            self.routes.append(ParserRoute(route['module'], maxBytes,
+                    route.get('prefix', ''), route.get('suffix', ''), route.get('contentType', ''),
+                    route.get('limitBytes', defaultLimitBytes)))
+        self.contentTypeBytes = max([0] + [route.maxBytes for route in self.routes if len(route.contentType) > 0])
+
+    def select(self, key, contentType=None):
+        '''
+        Returns: the first ParserRoute that applies to the object, or None if the body should not be parsed
+
+        If contentType is None, routes that need a content type are skipped. Use has_content_type_routes()
+        to decide whether it is worth getting the content type (from the head) and selecting again.
+        '''
+        for route in self.routes:
+            if route.matches(key, contentType):
+                return route
+        return None
+
+    def has_content_type_routes(self):
+        return self.contentTypeBytes > 0
+
+def get_registry(configs):
+    '''
+    Return the PluginRegistry for the configs. Registries are built (and their plugins imported) once per
+    distinct configuration.
+
+    The routes are the dataBodyParsers list followed by dataBodyParserModule (if set and dataBodyParserMaxBytes > 0)
+    as a catch-all route. For compiled configs (configutils.ConfigSnapshot), the registry built by the compiler is
+    returned directly.
+    '''
+    if hasattr(configs, 'registry'):
+        return configs.registry
+    routes = list(configs.get('dataBodyParsers', []))
+    dataPlugin = configs.get('dataBodyParserModule', '')
+    dataMaxBodyBytes = configs.get('dataBodyParserMaxBytes', 0)
+    if len(dataPlugin) > 0 and dataMaxBodyBytes > 0:
+        routes.append({'module': dataPlugin, 'maxBytes': dataMaxBodyBytes})
+
+    limitBytes = configs.get('dataBodyParserLimitBytes', DefaultLimitBytes)
+    registryKey = json.dumps([routes, limitBytes], sort_keys=True)
+    registry = registries.get(registryKey, None)
+    if registry is None:
+        registry = PluginRegistry(routes, defaultLimitBytes=limitBytes)
+        registries[registryKey] = registry
+    return registry
+
+def preload(configs):
+    ''' Import all of the plugins named in the configs. Call at cold start to keep imports off the event path. '''
+    get_registry(configs)
+    metafileParserModule = configs.get('metafileParserModule', None)
+    if configs.get('metafileMode', 'disable') != 'disable' and metafileParserModule:
+        load_plugin(metafileParserModule)
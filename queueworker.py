@@ -0,0 +1,167 @@
+'''
+File: queueworker.py
+
+Long-running ingest worker that consumes S3 event notifications from a queue, as an alternative to invoking
+the Lambda function once per S3 event.
+
+The bucket notifications are sent to an SQS queue (directly or through SNS). The worker long-polls the queue,
+collects messages into batches, extracts the attributes of the records in a batch in parallel (hashing keys to
+partitions so that the records for any one key are handled in order) and indexes the whole batch with one bulk
+request, reusing its S3 and Elasticsearch connections from batch to batch. A message is only deleted from the
+queue once every record in it has been indexed. Otherwise it becomes visible again and is retried.
+
+messagequeue.LocalQueue is an in-process stand-in for SQS for testing.
+
+Usage:
+    python -m queueworker --queue-url <SQS queue URL> [--batch-size 100] [--partitions 8] [--wait 20]
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import logging
+import argparse
+import json
+import time
+import configutils
+import messagequeue
+import metadata
+import habitat_handler
+
+class QueueWorker(object):
+    '''
+    Receives batches of up to batchSize messages from queue (a messagequeue.SqsQueue or LocalQueue) and indexes their records.
+
+    A batch is handed off as soon as it is full or when a receive comes back empty after waiting waitSeconds,
+    so records are never held back for long when the queue is quiet.
+    '''
+    def __init__(self, queue, configs, batchSize=100, partitions=8, waitSeconds=20):
+        self.queue = queue
+        self.configs = configs
+        self.batchSize = batchSize
+        self.partitions = partitions
+        self.waitSeconds = waitSeconds
+        self.stopped = False
+
+    def receive_batch(self):
+        messages = self.queue.receive(self.batchSize, self.waitSeconds)
+        while 0 < len(messages) < self.batchSize:
+            more = self.queue.receive(self.batchSize - len(messages), 0)
+            if len(more) == 0:
+                break
+            messages.extend(more)
+        return messages
+
+    def run_once(self):
+        '''
+        Receive, index and delete one batch of messages.
+
+        Returns: (number of messages received, number of messages deleted)
+        '''
+        messages = self.receive_batch()
+        if len(messages) == 0:
+            return (0, 0)
+
+        records = []
+        owners = [] # Index into messages for each record
+        failedMessages = set()
+        for (i, message) in enumerate(messages):
+            try:
+                messageRecords = metadata.get_s3_records({'Records': [{'body': message['body']}]})
+            except Exception as e:
+                logging.error(e)
+                logging.error('Could not parse message {}. It will not be deleted.'.format(message['id']))
+                failedMessages.add(i)
+                continue
+            records.extend(messageRecords)
+            owners.extend([i] * len(messageRecords))
+
+        results = habitat_handler.handle_records(records, self.configs, self.partitions)
+        for (i, result) in zip(owners, results):
+            if not result:
+                failedMessages.add(i)
+
+        done = [message for (i, message) in enumerate(messages) if i not in failedMessages]
+        if len(done) > 0:
+            self.queue.delete(done)
+        logging.info('Indexed {} records. Deleted {} of {} messages.'.format(len(records), len(done), len(messages)))
+        return (len(messages), len(done))
+
+    def run(self):
+        ''' Process batches until stop() is called '''
+        while not self.stopped:
+            try:
+                self.run_once()
+            except Exception as e:
+                # Undeleted messages will be received again once their visibility timeout expires
+                logging.error(e)
+                logging.error('Error processing batch')
+                time.sleep(1)
+
+    def stop(self):
+        self.stopped = True
+
+def main():
+    parser = argparse.ArgumentParser(description='Index S3 event notifications received from an SQS queue')
+    parser.add_argument('--queue-url', required=True, help='URL of the SQS queue receiving the bucket notifications')
+    parser.add_argument('--batch-size', type=int, default=100, help='Most messages to index in one bulk request')
+    parser.add_argument('--partitions', type=int, default=8, help='Number of partitions of keys to extract in parallel')
+    parser.add_argument('--wait', type=int, default=20, help='Seconds to long-poll for messages (at most 20)')
+    args = parser.parse_args()
+
+    worker = QueueWorker(messagequeue.SqsQueue(args.queue_url), configutils.get_configs(), args.batch_size, args.partitions, args.wait)
+    worker.run()
+
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        self.configs = configutils.load_configs()
+        self.bucket = self.configs['bucket']
+        self.key = 'data/unittest-a1234-15-imager_1234567890.tif'
+
+    def make_message(self, key):
+        return json.dumps({'Records': [{
+            'awsRegion': self.configs['region'],
+            'eventName': 'ObjectCreated:Put',
+            'userIdentity': {'principalId': 'aPrincipalId'},
+            's3': {'object': {'key': key, 'size': 1024}, 'bucket': {'name': self.bucket}}
+            }]})
+
+    def test_run_once(self):
+        ''' Messages are deleted once indexed, and a message with an unindexable record is kept '''
+        queue = messagequeue.LocalQueue()
+        for n in range(3):
+            queue.send(self.make_message(self.key))
+        queue.send('not json')
+        worker = QueueWorker(queue, self.configs, batchSize=10, partitions=2, waitSeconds=0)
+        self.assertEqual(worker.run_once(), (4, 3), 'Expected every message but the bad one to be deleted')
+        self.assertEqual(len(queue), 1)
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    logFormat = '%(levelname)s:%(asctime)s:HABITAT:%(module)s-%(lineno)d: %(message)s'
+    logLevel = logging.INFO
+    logging.basicConfig(format=logFormat, level=logLevel)
+
+    main()
@@ -0,0 +1,318 @@
+'''
+File: retryqueue.py
+
+Durable retry of index writes that failed (e.g., when Elasticsearch is throttling during a peak).
+
+Attribute documents that could not be indexed are put on a retry queue instead of being dropped.
+The queue is either a local directory (FileRetryQueue) or a message queue such as SQS (MessageRetryQueue).
+A Drainer re-submits the queued documents with bulk requests, backing off exponentially (with jitter) between
+attempts. Documents that still fail after maxAttempts are moved to a dead-letter store where they can be inspected
+(and re-queued once the problem is fixed).
+
+Configured with the indexRetry config (omit to disable):
+    "indexRetry": {
+        "queue": "file" | "sqs",
+        "path": "<directory for the file queue>",
+        "queueUrl": "<SQS queue URL>",
+        "deadLetterPath": "<directory for dead letters>",
+        "deadLetterQueueUrl": "<SQS queue URL for dead letters. Used instead of deadLetterPath if set>",
+        "maxAttempts": 8
+    }
+
+Usage:
+    python -m retryqueue drain          # Drain the retry queue until it is empty
+    python -m retryqueue deadletters    # Print the dead letters
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import logging
+import datetime
+import random
+import shutil
+import uuid
+import json
+import time
+import os
+import sys
+import configutils
+import esutils
+import messagequeue
+import indexbackend
+
+DefaultMaxAttempts = 8
+DefaultBaseDelay = 1.0 # Seconds
+DefaultMaxDelay = 900.0 # Seconds (the most that SQS can delay a message)
+
+def serialize_value(value):
+    ''' json default for the values that may be in attributes (e.g., LastModified from the S3 head) '''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError('Cannot serialize {!r}'.format(value))
+
+def write_file(fileName, data):
+    ''' Write the file atomically (write to a temporary file and rename) so it is never seen half written '''
+    tmpFileName = fileName + '.tmp'
+    with open(tmpFileName, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmpFileName, fileName)
+
+class FileRetryQueue(object):
+    '''
+    Retry queue kept in a local directory, one json file per document.
+
+    File names start with the time of the next attempt, so the entries that are due are found by sorting.
+    Only one Drainer should drain a directory at a time.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def put(self, attributes, attempts=0, delaySeconds=0, error=None):
+        entry = {'attributes': attributes, 'attempts': attempts, 'error': error}
+        fileName = '{:017.6f}-{}.json'.format(time.time() + delaySeconds, uuid.uuid4().hex)
+        write_file(os.path.join(self.directory, fileName), json.dumps(entry, default=serialize_value))
+
+    def receive(self, maxEntries):
+        ''' Returns: up to maxEntries entries that are due, oldest first '''
+        now = time.time()
+        entries = []
+        for fileName in sorted(os.listdir(self.directory)):
+            if not fileName.endswith('.json') or len(entries) >= maxEntries:
+                continue
+            if float(fileName.split('-')[0]) > now:
+                break
+            with open(os.path.join(self.directory, fileName), 'r') as f:
+                entry = json.loads(f.read())
+            entry['id'] = fileName
+            entries.append(entry)
+        return entries
+
+    def delete(self, entries):
+        for entry in entries:
+            os.remove(os.path.join(self.directory, entry['id']))
+
+    def retry(self, entry, delaySeconds, error=None):
+        ''' Put the entry back for another attempt after delaySeconds '''
+        self.put(entry['attributes'], entry['attempts'] + 1, delaySeconds, error)
+        self.delete([entry])
+
+    def __len__(self):
+        return len([fileName for fileName in os.listdir(self.directory) if fileName.endswith('.json')])
+
+class MessageRetryQueue(object):
+    ''' Retry queue kept in a messagequeue.SqsQueue (or LocalQueue), one message per document '''
+    def __init__(self, queue):
+        self.queue = queue
+
+    def put(self, attributes, attempts=0, delaySeconds=0, error=None):
+        entry = {'attributes': attributes, 'attempts': attempts, 'error': error}
+        self.queue.send(json.dumps(entry, default=serialize_value), delaySeconds)
+
+    def receive(self, maxEntries):
+        entries = []
+        while len(entries) < maxEntries:
+            messages = self.queue.receive(maxEntries - len(entries), 0)
+            if len(messages) == 0:
+                break
+            for message in messages:
+                entry = json.loads(message['body'])
+                entry['message'] = message
+                entries.append(entry)
+        return entries
+
+    def delete(self, entries):
+        self.queue.delete([entry['message'] for entry in entries])
+
+    def retry(self, entry, delaySeconds, error=None):
+        self.put(entry['attributes'], entry['attempts'] + 1, delaySeconds, error)
+        self.delete([entry])
+
+class FileDeadLetterStore(object):
+    ''' Dead letters kept in a local directory, one json file per document '''
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def put(self, entry):
+        entry = {'attributes': entry['attributes'], 'attempts': entry['attempts'], 'error': entry.get('error', None)}
+        fileName = '{:017.6f}-{}.json'.format(time.time(), uuid.uuid4().hex)
+        write_file(os.path.join(self.directory, fileName), json.dumps(entry, default=serialize_value, indent=4))
+
+    def list_entries(self):
+        entries = []
+        for fileName in sorted(os.listdir(self.directory)):
+            if fileName.endswith('.json'):
+                with open(os.path.join(self.directory, fileName), 'r') as f:
+                    entry = json.loads(f.read())
+                entry['id'] = fileName
+                entries.append(entry)
+        return entries
+
+    def delete(self, entries):
+        for entry in entries:
+            os.remove(os.path.join(self.directory, entry['id']))
+
+class MessageDeadLetterStore(object):
+    ''' Dead letters sent to a messagequeue.SqsQueue (or LocalQueue), e.g., for inspection in the SQS console '''
+    def __init__(self, queue):
+        self.queue = queue
+
+    def put(self, entry):
+        entry = {'attributes': entry['attributes'], 'attempts': entry['attempts'], 'error': entry.get('error', None)}
+        self.queue.send(json.dumps(entry, default=serialize_value))
+
+class Drainer(object):
+    '''
+    Re-submits the documents on retryQueue to the index with bulk requests of up to batchSize.
+
+    After a failed attempt, a document is retried after a random delay of up to baseDelay * 2^attempts seconds
+    (capped at maxDelay). After maxAttempts failed attempts it is moved to deadLetterStore.
+    '''
+    def __init__(self, retryQueue, deadLetterStore, backend, maxAttempts=DefaultMaxAttempts,
+            baseDelay=DefaultBaseDelay, maxDelay=DefaultMaxDelay, batchSize=100):
+        self.retryQueue = retryQueue
+        self.deadLetterStore = deadLetterStore
+        self.backend = indexbackend.as_backend(backend)
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.batchSize = batchSize
+
+    def get_delay(self, attempts):
+        ''' Exponential backoff with full jitter '''
+        return random.uniform(0, min(self.maxDelay, self.baseDelay * (2 ** attempts)))
+
+    def drain_once(self):
+        '''
+        Re-submit one batch of the entries that are due.
+
+        Returns: (number of entries received, number indexed, number dead-lettered)
+        '''
+        entries = self.retryQueue.receive(self.batchSize)
+        if len(entries) == 0:
+            return (0, 0, 0)
+
+        # Manifest rows (see manifest.py) are merged into their documents, as when they were first written
+        objectIds = [None] * len(entries)
+        for merge in (False, True):
+            positions = [i for (i, entry) in enumerate(entries) if (esutils.ManifestFields in entry['attributes']) == merge]
+            if len(positions) > 0:
+                write = self.backend.bulk_merge if merge else self.backend.bulk_index
+                for (i, objectId) in zip(positions, write([entries[i]['attributes'] for i in positions])):
+                    objectIds[i] = objectId
+        indexed = []
+        deadLettered = 0
+        for (entry, objectId) in zip(entries, objectIds):
+            if objectId is not None:
+                indexed.append(entry)
+            elif entry['attempts'] + 1 >= self.maxAttempts:
+                logging.error('Giving up on indexing {} after {} attempts'.format(entry['attributes'].get('key', None), entry['attempts'] + 1))
+                entry['attempts'] += 1
+                self.deadLetterStore.put(entry)
+                self.retryQueue.delete([entry])
+                deadLettered += 1
+            else:
+                self.retryQueue.retry(entry, self.get_delay(entry['attempts'] + 1), 'Index write failed')
+        if len(indexed) > 0:
+            self.retryQueue.delete(indexed)
+        logging.info('Retried {} documents. Indexed: {} Dead-lettered: {}'.format(len(entries), len(indexed), deadLettered))
+        return (len(entries), len(indexed), deadLettered)
+
+    def drain(self):
+        ''' Drain until no entries are due. Returns: (total indexed, total dead-lettered) '''
+        (totalIndexed, totalDeadLettered) = (0, 0)
+        while True:
+            (received, indexed, deadLettered) = self.drain_once()
+            if received == 0:
+                return (totalIndexed, totalDeadLettered)
+            totalIndexed += indexed
+            totalDeadLettered += deadLettered
+
+# Retry queues and dead-letter stores by configuration, kept for the life of the process
+retryQueues = {}
+
+def get_retry_queue(configs):
+    ''' Returns: the retry queue configured by indexRetry, or None if indexRetry is not configured '''
+    retryConfigs = configs.get('indexRetry', None)
+    if retryConfigs is None:
+        return None
+    queueKey = json.dumps(retryConfigs, sort_keys=True)
+    retryQueue = retryQueues.get(queueKey, None)
+    if retryQueue is None:
+        if retryConfigs.get('queue', 'file') == 'sqs':
+            retryQueue = MessageRetryQueue(messagequeue.SqsQueue(retryConfigs['queueUrl']))
+        else:
+            retryQueue = FileRetryQueue(retryConfigs.get('path', 'habitat_retry'))
+        retryQueues[queueKey] = retryQueue
+    return retryQueue
+
+def get_dead_letter_store(configs):
+    retryConfigs = configs.get('indexRetry', {})
+    if retryConfigs.get('deadLetterQueueUrl', None):
+        return MessageDeadLetterStore(messagequeue.SqsQueue(retryConfigs['deadLetterQueueUrl']))
+    return FileDeadLetterStore(retryConfigs.get('deadLetterPath', 'habitat_deadletter'))
+
+def get_drainer(configs):
+    retryConfigs = configs.get('indexRetry', {})
+    return Drainer(get_retry_queue(configs), get_dead_letter_store(configs), indexbackend.get_backend(configs),
+            retryConfigs.get('maxAttempts', DefaultMaxAttempts))
+
+def drain_handler(event, context):
+    '''
+    Lambda entry point to drain an SQS retry queue, e.g., on a schedule.
+
+    Returns: (total indexed, total dead-lettered)
+    '''
+    return get_drainer(configutils.get_configs()).drain()
+
+def main():
+    usage = 'Usage: python -m retryqueue drain | deadletters'
+    if len(sys.argv) != 2:
+        print usage
+        sys.exit(1)
+
+    configs = configutils.load_configs()
+    if configs.get('indexRetry', None) is None:
+        print 'indexRetry is not configured'
+        sys.exit(1)
+
+    if sys.argv[1] == 'drain':
+        (indexed, deadLettered) = get_drainer(configs).drain()
+        print 'Indexed: {} Dead-lettered: {}'.format(indexed, deadLettered)
+    elif sys.argv[1] == 'deadletters':
+        deadLetterStore = get_dead_letter_store(configs)
+        if not isinstance(deadLetterStore, FileDeadLetterStore):
+            print 'Dead letters are in SQS queue ' + configs['indexRetry']['deadLetterQueueUrl']
+            sys.exit(1)
+        print json.dumps(deadLetterStore.list_entries(), indent=4)
+    else:
+        print usage
+        sys.exit(1)
+
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    logFormat = '%(levelname)s:%(asctime)s:HABITAT:%(module)s-%(lineno)d: %(message)s'
+    logLevel = logging.INFO
+    logging.basicConfig(format=logFormat, level=logLevel)
+
+    main()
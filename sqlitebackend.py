@@ -0,0 +1,272 @@
+'''
+File: sqlitebackend.py
+
+Index backend (see indexbackend) that keeps the habitat documents in an embedded SQLite database file.
+
+Each document is stored as json with its id (esutils.makeUniqueId) and version (from the S3 event sequencer).
+Searches take the same Elasticsearch query clauses as esutils.searchHits, for the subset of the query DSL that
+habitat clients use: match_all, ids, term, terms, range, prefix, exists, match, multi_match, query_string and bool.
+Exact queries are evaluated with the JSON1 functions, using expression indexes on the key and the esFieldMappings
+attributes. Text queries (match, multi_match, query_string) use a full text (FTS5 or FTS4) index of all of the
+attribute values of a document, whichever field they name.
+
+If the SQLite library was built without JSON1, json_extract is provided in Python instead (no indexes), and without
+FTS, text queries fall back to a substring match.
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import logging
+import datetime
+import threading
+import sqlite3
+import json
+import re
+import esutils
+
+FieldNameRegex = re.compile(r'^[\w.@-]+$')
+
+def json_default(value):
+    ''' json default for the values that may be in attributes (e.g., LastModified from the S3 head) '''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError('Cannot serialize {!r}'.format(value))
+
+def python_json_extract(source, path):
+    ''' Stand-in for the JSON1 json_extract for the '$."<field>"' paths that are used here '''
+    value = json.loads(source).get(path[3:-1], None)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+def field_expression(field):
+    ''' Returns: the SQL expression for the value of the attribute field (inlined so that expression indexes apply) '''
+    if not FieldNameRegex.match(field):
+        raise ValueError('Unsupported field name: ' + field)
+    return "json_extract(source, '$.\"{}\"')".format(field)
+
+def get_text(attributes):
+    ''' Returns: all of the attribute values as text for the full text index '''
+    return ' '.join(unicode(value) for value in attributes.values() if not isinstance(value, (dict, list)))
+
+class SqliteBackend(object):
+    '''
+    Documents in the SQLite database at path (':memory:' for a private in-memory database).
+    indexedFields are the attributes to create expression indexes for, in addition to the key.
+
+    One connection is shared by all threads, with writes made one bulk request per transaction.
+    '''
+    def __init__(self, path, indexedFields=()):
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        if path != ':memory:':
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+        try:
+            self.connection.execute("SELECT json_extract('{}', '$.a')")
+            self.json1 = True
+        except sqlite3.OperationalError:
+            logging.warning('SQLite has no JSON1 support. Queries will scan every document.')
+            self.connection.create_function('json_extract', 2, python_json_extract)
+            self.json1 = False
+
+        self.connection.execute('CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, version INTEGER, source TEXT NOT NULL)')
+        self.fts = None
+        for fts in ('fts5', 'fts4'):
+            try:
+                self.connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS documents_text USING {}(text)'.format(fts))
+                self.fts = fts
+                break
+            except sqlite3.OperationalError:
+                continue
+        if self.fts is None:
+            logging.warning('SQLite has no full text search support. Text queries will scan every document.')
+        if self.json1:
+            for field in ['key'] + sorted(indexedFields):
+                indexName = 'documents_' + re.sub(r'\W', '_', field)
+                self.connection.execute('CREATE INDEX IF NOT EXISTS {} ON documents ({})'.format(indexName, field_expression(field)))
+
+    def write(self, cursor, objectId, attributes):
+        ''' Insert or update one document unless it is stale. Returns: True if written or stale '''
+        version = esutils.sequencerToVersion(attributes.get('sequencer', None))
+        row = cursor.execute('SELECT rowid, version, source FROM documents WHERE id = ?', (objectId,)).fetchone()
+        if row is not None and version is not None and row['version'] is not None and version < row['version']:
+            logging.info('Skipping stale event for objectId {}'.format(objectId))
+            return True
+        if row is not None:
+            attributes = esutils.keepManifestAttributes(attributes, json.loads(row['source']))
+        self.store(cursor, row, objectId, version, attributes)
+        return True
+
+    def merge(self, cursor, objectId, attributes):
+        ''' Merge the attributes into the document (or insert it), keeping its other attributes and version. Returns: True '''
+        row = cursor.execute('SELECT rowid, version, source FROM documents WHERE id = ?', (objectId,)).fetchone()
+        if row is None:
+            self.store(cursor, None, objectId, None, attributes)
+        else:
+            merged = json.loads(row['source'])
+            merged.update(attributes)
+            self.store(cursor, row, objectId, row['version'], merged)
+        return True
+
+    def store(self, cursor, row, objectId, version, attributes):
+        ''' Insert the document (row is None) or replace the one in row, and its full text '''
+        source = json.dumps(attributes, default=json_default)
+        if row is None:
+            rowid = cursor.execute('INSERT INTO documents (id, version, source) VALUES (?, ?, ?)', (objectId, version, source)).lastrowid
+        else:
+            rowid = row['rowid']
+            cursor.execute('UPDATE documents SET version = ?, source = ? WHERE rowid = ?', (version, source, rowid))
+            if self.fts is not None:
+                cursor.execute('DELETE FROM documents_text WHERE rowid = ?', (rowid,))
+        if self.fts is not None:
+            cursor.execute('INSERT INTO documents_text (rowid, text) VALUES (?, ?)', (rowid, get_text(attributes)))
+
+    def remove(self, cursor, objectId, attributes):
+        ''' Remove one document unless the removal is stale. Returns: True '''
+        version = esutils.sequencerToVersion(attributes.get('sequencer', None))
+        row = cursor.execute('SELECT rowid, version FROM documents WHERE id = ?', (objectId,)).fetchone()
+        if row is None:
+            return True
+        if version is not None and row['version'] is not None and version < row['version']:
+            logging.info('Skipping stale removal for objectId {}'.format(objectId))
+            return True
+        cursor.execute('DELETE FROM documents WHERE rowid = ?', (row['rowid'],))
+        if self.fts is not None:
+            cursor.execute('DELETE FROM documents_text WHERE rowid = ?', (row['rowid'],))
+        return True
+
+    def apply(self, operation, attributesList):
+        ''' Apply operation (write, merge or remove) to each of attributesList in one transaction '''
+        objectIds = [esutils.makeUniqueId(attributes) for attributes in attributesList]
+        with self.lock:
+            cursor = self.connection.cursor()
+            try:
+                cursor.execute('BEGIN')
+                for (objectId, attributes) in zip(objectIds, attributesList):
+                    operation(cursor, objectId, attributes)
+                cursor.execute('COMMIT')
+                return objectIds
+            except Exception as e:
+                cursor.execute('ROLLBACK')
+                logging.error(e)
+                logging.error('Error writing {} documents to {}'.format(len(objectIds), self.path))
+                return [None] * len(objectIds)
+
+    def index(self, attributes):
+        return self.apply(self.write, [attributes])[0]
+
+    def bulk_index(self, attributesList):
+        return self.apply(self.write, attributesList)
+
+    def bulk_merge(self, attributesList):
+        return self.apply(self.merge, attributesList)
+
+    def bulk_delete(self, attributesList):
+        return self.apply(self.remove, attributesList)
+
+    def get(self, objectId):
+        with self.lock:
+            row = self.connection.execute('SELECT id, version, source FROM documents WHERE id = ?', (objectId,)).fetchone()
+        if row is None:
+            return None
+        return {'_id': row['id'], '_version': row['version'], '_source': json.loads(row['source']), 'found': True}
+
+    def get_condition(self, query):
+        ''' Translate an Elasticsearch query clause. Returns: (SQL condition, parameters) '''
+        (queryType, clause) = query.items()[0]
+        if queryType == 'match_all':
+            return ('1', [])
+        if queryType == 'ids':
+            values = clause['values']
+            return ('id IN ({})'.format(', '.join('?' * len(values))) if values else '0', list(values))
+        if queryType == 'term':
+            (field, value) = clause.items()[0]
+            if isinstance(value, dict):
+                value = value['value']
+            return ('{} = ?'.format(field_expression(field)), [value])
+        if queryType == 'terms':
+            (field, values) = clause.items()[0]
+            return ('{} IN ({})'.format(field_expression(field), ', '.join('?' * len(values))) if values else '0', list(values))
+        if queryType == 'range':
+            (field, bounds) = clause.items()[0]
+            operators = {'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+            conditions = ['{} {} ?'.format(field_expression(field), operators[name]) for name in sorted(bounds) if name in operators]
+            return (' AND '.join(conditions) or '1', [bounds[name] for name in sorted(bounds) if name in operators])
+        if queryType == 'prefix':
+            (field, value) = clause.items()[0]
+            if isinstance(value, dict):
+                value = value['value']
+            escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            return ("{} LIKE ? ESCAPE '\\'".format(field_expression(field)), [escaped + '%'])
+        if queryType == 'exists':
+            return ('{} IS NOT NULL'.format(field_expression(clause['field'])), [])
+        if queryType in ('match', 'multi_match', 'query_string'):
+            if queryType == 'match':
+                text = clause.values()[0]
+                if isinstance(text, dict):
+                    text = text['query']
+            else:
+                text = clause['query']
+            if self.fts is not None:
+                terms = ' '.join('"{}"'.format(term.replace('"', '""')) for term in unicode(text).split())
+                return ('rowid IN (SELECT rowid FROM documents_text WHERE documents_text MATCH ?)', [terms])
+            return ('source LIKE ?', ['%' + unicode(text) + '%'])
+        if queryType == 'bool':
+            conditions = []
+            params = []
+            for occur in ('must', 'filter', 'must_not', 'should'):
+                clauses = clause.get(occur, [])
+                if isinstance(clauses, dict):
+                    clauses = [clauses]
+                translated = [self.get_condition(subquery) for subquery in clauses]
+                if len(translated) == 0:
+                    continue
+                for (condition, conditionParams) in translated:
+                    params.extend(conditionParams)
+                if occur == 'must_not':
+                    conditions.extend('NOT ({})'.format(condition) for (condition, conditionParams) in translated)
+                elif occur == 'should':
+                    conditions.append('(' + ' OR '.join('({})'.format(condition) for (condition, conditionParams) in translated) + ')')
+                else:
+                    conditions.extend('({})'.format(condition) for (condition, conditionParams) in translated)
+            return (' AND '.join(conditions) or '1', params)
+        raise ValueError('Unsupported query for the SQLite backend: ' + queryType)
+
+    def search(self, query, pageSize=esutils.DefaultPageSize, sliceId=None, maxSlices=None, sort=None, fields=None):
+        '''
+        Generator over all of the hits for query, in id order, a page of pageSize at a time.
+        Only the default (id) order is supported, so sort must be None or sort by _id/_uid.
+        '''
+        if sort is not None and [sortField.keys()[0] if isinstance(sortField, dict) else sortField for sortField in sort][-1] not in ('_id', '_uid'):
+            raise ValueError('The SQLite backend only sorts by id')
+        (condition, params) = self.get_condition(query if query is not None else {'match_all': {}})
+        if maxSlices is not None:
+            condition = '({}) AND rowid % {} = {}'.format(condition, int(maxSlices), int(sliceId))
+        sql = 'SELECT id, version, source FROM documents WHERE ({}) AND id > ? ORDER BY id LIMIT ?'.format(condition)
+        lastId = ''
+        while True:
+            with self.lock:
+                rows = self.connection.execute(sql, params + [lastId, pageSize]).fetchall()
+            for row in rows:
+                source = json.loads(row['source'])
+                if fields is not None:
+                    source = dict((name, value) for (name, value) in source.items() if name in fields)
+                yield {'_id': row['id'], '_index': self.path, '_version': row['version'], '_source': source}
+            if len(rows) < pageSize:
+                return
+            lastId = rows[-1]['id']
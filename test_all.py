@@ -32,41 +32,74 @@ To run:
     python test_all.py > test.out
     This will send unittest output to console and stdout (print statements that are part of tests) to test.out
 
-Each module to be included should include the following pattern:
+Each module to be included should include the following pattern (for the modules that are deployed to Lambda, in a
+separate test_<module>.py so that the test code is not deployed or imported with the module):
 def AllModuleTests():
     suite1 = unittest.TestLoader().loadTestsFromTestCase(nameOfTestCaseObject1GoesHere)
     suite2 = unittest.TestLoader().loadTestsFromTestCase(nameOfTestCaseObject2GoesHere) # Repeat as necessary
     return unittest.TestSuite([suite1, suite2]) # If only suite1 is defined, can just return suite1 directly
 
 OTHER UNIT TESTING NOTES:
-To test a single module using pyunit, just execute the module since by convention, the unittest is defined for main. E.g.,:
-	python filenamemeta.py
+To test a single module using pyunit, just execute the module (or its test_ module) since by convention, the unittest is defined for main. E.g.,:
+	python test_filenamemeta.py
 
 To test a single test within a test case, follow this pattern:
-        python -m unittest filenamemeta.TestController.test_get_attributes_from_filename
+        python -m unittest test_filenamemeta.TestController.test_get_attributes_from_filename
 '''
 
 # Build the master test suite
 # N.B. that if new modules are created, they will need to be manually added in two places below (import, suites.append)
-import habitat_handler
-import esutils
-import metadata
-import filenamemeta
-import objectmeta
-import metafile
-import defaultMetafileParser
-import defaultDataBodyParser
+import test_habitat_handler
+import test_esutils
+import test_metadata
+import test_filenamemeta
+import test_objectmeta
+import test_metafile
+import test_defaultMetafileParser
+import test_defaultDataBodyParser
+import test_pluginregistry
+import backfill
+import queueworker
+import test_messagequeue
+import test_retryqueue
+import presign
+import download
+import upload
+import test_indexbackend
+import test_sqlitebackend
+import watchfolder
+import benchmark
+import test_metrics
+import test_importtime
+import test_configutils
+import test_manifest
 
 fastSuites = []
 slowSuites = []
-fastSuites.append(habitat_handler.AllModuleTests())
-fastSuites.append(esutils.AllModuleTests())
-fastSuites.append(metadata.AllModuleTests())
-fastSuites.append(filenamemeta.AllModuleTests())
-fastSuites.append(objectmeta.AllModuleTests())
-fastSuites.append(metafile.AllModuleTests())
-fastSuites.append(defaultMetafileParser.AllModuleTests())
-fastSuites.append(defaultDataBodyParser.AllModuleTests())
+fastSuites.append(test_habitat_handler.AllModuleTests())
+fastSuites.append(test_esutils.AllModuleTests())
+fastSuites.append(test_metadata.AllModuleTests())
+fastSuites.append(test_filenamemeta.AllModuleTests())
+fastSuites.append(test_objectmeta.AllModuleTests())
+fastSuites.append(test_metafile.AllModuleTests())
+fastSuites.append(test_defaultMetafileParser.AllModuleTests())
+fastSuites.append(test_defaultDataBodyParser.AllModuleTests())
+fastSuites.append(test_pluginregistry.AllModuleTests())
+fastSuites.append(backfill.AllModuleTests())
+fastSuites.append(queueworker.AllModuleTests())
+fastSuites.append(test_messagequeue.AllModuleTests())
+fastSuites.append(test_retryqueue.AllModuleTests())
+fastSuites.append(presign.AllModuleTests())
+fastSuites.append(download.AllModuleTests())
+fastSuites.append(upload.AllModuleTests())
+fastSuites.append(test_indexbackend.AllModuleTests())
+fastSuites.append(test_sqlitebackend.AllModuleTests())
+fastSuites.append(watchfolder.AllModuleTests())
+fastSuites.append(benchmark.AllModuleTests())
+fastSuites.append(test_metrics.AllModuleTests())
+fastSuites.append(test_importtime.AllModuleTests())
+fastSuites.append(test_configutils.AllModuleTests())
+fastSuites.append(test_manifest.AllModuleTests())
 
 # For now everything is in the fast suite. Move later if necessary.
 # slowSuites.append(objectmeta.AllModuleTests())
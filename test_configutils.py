@@ -0,0 +1,174 @@
+'''
+File: test_configutils.py
+
+Unit tests for the config compiler in configutils.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import subprocess
+import json
+import sys
+import configutils
+from configutils import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        self.configs = {
+                'region': 'us-east-1',
+                'bucket': 'habitat-test',
+                'esHabitatIndex': 'habitatunittest',
+                'esDocType': 'habitat-testtype',
+                'dataFilenameRegex': '^data/unittest-(?P<assayId>\\w+)-(?P<runId>\\d+)-\\w+.tif$',
+                'dataBodyParserModule': 'defaultDataBodyParser',
+                'dataBodyParserMaxBytes': 40,
+                'dataBodyParsers': [{'module': 'defaultDataBodyParser', 'suffix': '.tif'}],
+                'metafileMode': 'written_last',
+                'metafilePairing': {'dataPrefix': 'raw/', 'metaPrefix': 'sidecars/'},
+                'daysBeforeIA': 30,
+                'daysBeforeGlacier': 60,
+                'daysBeforeExpire': 90
+                }
+
+    def assertConfigError(self, text):
+        with self.assertRaises(ConfigError) as context:
+            compile_configs(self.configs)
+        self.assertIn(text, str(context.exception))
+
+    def test_compile_configs(self):
+        snapshot = compile_configs(self.configs)
+        self.assertEqual(snapshot['bucket'], 'habitat-test')
+        self.assertEqual(snapshot.router.get_attributes('data/unittest-a1234-15-imager_1.tif'), {'assayId': 'a1234', 'runId': '15'})
+        self.assertEqual(snapshot.registry.select('data/foo.tif').plugin, 'defaultDataBodyParser')
+        self.assertEqual(snapshot.notificationPrefix, 'sidecars/')
+        self.assertEqual(snapshot.dataPrefix, 'raw/')
+        self.assertEqual([transition['StorageClass'] for transition in snapshot.lifecycle['Rules'][0]['Transitions']], ['STANDARD_IA', 'GLACIER'])
+        self.assertEqual(snapshot.lifecycle['Rules'][0]['Expiration'], {'Days': 90})
+
+    def test_compiled_artifacts_are_used(self):
+        ''' The router and registry are looked up from the snapshot rather than rebuilt from the configs '''
+        import filenamemeta
+        import pluginregistry
+        snapshot = compile_configs(self.configs)
+        self.assertIs(filenamemeta.get_router(snapshot), snapshot.router)
+        self.assertIs(pluginregistry.get_registry(snapshot), snapshot.registry)
+
+    def test_snapshot_is_read_only(self):
+        snapshot = compile_configs(self.configs)
+        with self.assertRaises(TypeError):
+            snapshot['bucket'] = 'other'
+        with self.assertRaises(TypeError):
+            snapshot['metafilePairing']['dataPrefix'] = 'other/'
+        self.assertIsInstance(snapshot['dataBodyParsers'], tuple)
+        copy = dict(snapshot)
+        copy['bucket'] = 'other'
+        self.assertEqual(snapshot['bucket'], 'habitat-test')
+
+    def test_missing_key(self):
+        del self.configs['bucket']
+        self.assertConfigError('bucket is missing')
+        self.configs['bucket'] = 'habitat-test'
+        del self.configs['esDocType']
+        self.assertConfigError('esDocType is missing')
+        self.configs['indexBackend'] = 'sqlite'
+        compile_configs(self.configs)
+
+    def test_bad_values(self):
+        self.configs['metafileMode'] = 'none'
+        self.assertConfigError('metafileMode must be one of')
+        self.configs['metafileMode'] = 'disable'
+        self.configs['dataBodyParserMaxBytes'] = '40'
+        self.assertConfigError('dataBodyParserMaxBytes must be an integer')
+        self.configs['dataBodyParserMaxBytes'] = True
+        self.assertConfigError('dataBodyParserMaxBytes must be an integer')
+        self.configs['dataBodyParserMaxBytes'] = 40
+        self.configs['dataFilenameRoutes'] = [{'prefix': 'data/'}]
+        self.assertConfigError('dataFilenameRoutes[0] has no regex')
+
+    def test_bad_regex(self):
+        self.configs['dataFilenameRoutes'] = [{'regex': '^(?P<assayId>\\w+'}]
+        self.assertConfigError('dataFilenameRoutes[0].regex is not a valid regex')
+        self.configs['dataFilenameRoutes'] = [{'regex': '^(\\w+)+$'}]
+        self.configs['dataFilenameRegexGuard'] = True
+        self.assertConfigError('nested quantifier')
+
+    def test_bad_plugin(self):
+        self.configs['dataBodyParsers'] = [{'module': 'noSuchParserModule'}]
+        self.assertConfigError('dataBodyParsers[0].module names a plugin that cannot be imported')
+        self.configs['dataBodyParsers'] = [{'module': 'json'}]
+        self.assertConfigError('names a plugin without parseranges or parsebody')
+        self.configs['dataBodyParsers'] = []
+        self.configs['metafileFormat'] = 'custom'
+        self.assertConfigError('metafileParserModule is missing')
+
+    def test_manifest_prefix(self):
+        ''' The manifests must not overlap the data files (or the meta files, in written_last mode) '''
+        self.configs['manifestPrefix'] = 'manifests/'
+        self.assertEqual(compile_configs(self.configs).manifestNotificationPrefix, 'manifests/')
+        for manifestPrefix in ('raw/', 'raw/manifests/', 'sidecars/', 'r'):
+            self.configs['manifestPrefix'] = manifestPrefix
+            self.assertConfigError('manifestPrefix must not contain, or be under')
+        self.configs['metafileMode'] = 'disable'
+        self.configs['metafilePairing'] = {}
+        self.configs['manifestPrefix'] = 'data/'
+        self.assertConfigError('manifestPrefix must not contain, or be under')
+
+    def test_index_retry(self):
+        ''' An sqs retry queue needs an sqs dead-letter queue too '''
+        self.configs['indexRetry'] = {'queue': 'sqs', 'queueUrl': 'https://sqs.us-east-1.amazonaws.com/123456789012/retry'}
+        self.assertConfigError('indexRetry.deadLetterQueueUrl is missing')
+        self.configs['indexRetry']['deadLetterQueueUrl'] = 'https://sqs.us-east-1.amazonaws.com/123456789012/deadletter'
+        compile_configs(self.configs)
+
+    def test_lifecycle(self):
+        self.configs['daysBeforeGlacier'] = 0
+        del self.configs['daysBeforeIA']
+        rule = compile_configs(self.configs).lifecycle['Rules'][0]
+        self.assertNotIn('Transitions', rule)
+        self.assertEqual(rule['Expiration'], {'Days': 90})
+        self.configs['daysBeforeExpire'] = 0
+        self.assertIsNone(compile_configs(self.configs).lifecycle)
+        self.configs['daysBeforeIA'] = 10
+        self.assertConfigError('daysBeforeIA must be at least')
+        self.configs['daysBeforeIA'] = 60
+        self.configs['daysBeforeGlacier'] = 45
+        self.assertConfigError('daysBeforeGlacier must be more than daysBeforeIA')
+
+    def test_get_configs(self):
+        self.assertIs(get_configs(), get_configs())
+        self.assertIsInstance(get_configs(), ConfigSnapshot)
+
+    def test_shell(self):
+        ''' The assignments are evaluated by sh as habitat_tools.sh does '''
+        script = 'eval "$(\'{}\' configutils.py --shell)" && echo "$bucket|$notificationPrefix|$lifecycleConfiguration"'.format(sys.executable)
+        output = subprocess.check_output(['sh', '-c', script])
+        (bucket, prefix, lifecycle) = output.strip().split('|', 2)
+        self.assertEqual(bucket, load_configs()['bucket'])
+        self.assertIn(prefix, ('data/', 'meta/'))
+        self.assertIn('Rules', json.loads(lifecycle) if lifecycle else {'Rules': None})
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+'''
+File: test_defaultDataBodyParser.py
+
+Unit tests for defaultDataBodyParser.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import defaultDataBodyParser
+from defaultDataBodyParser import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_parsebody(self):
+        ''' Happy path test case '''
+        body = '''
+key1=value1
+key2=value2
+        '''
+        attributes = parsebody(body)
+        expected = {
+                'key1': 'value1',
+                'key2': 'value2'
+                }
+        self.assertEqual(attributes, expected, 'Attribute dictionaries do not match')
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+'''
+File: test_esutils.py
+
+Unit tests for esutils.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import esutils
+esutils.loadConfigs() # The tests use the index names from the config file
+from esutils import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        self.esEndpoint = Configs['esEndpoint']
+
+    def test_putEndpointInConfigFile(self):
+        putEndpointInConfigFile()
+        print 'Manually inspect sanity of endpoint value...'
+        print 'Endpoint = ', configutils.load_configs()['esEndpoint']
+
+    def test_bulkIndexAttributes(self):
+        ''' Index several documents in one bulk request and verify each one '''
+        from time import gmtime, strftime
+        key = strftime("%Y-%m-%dT%H:%M:%S", gmtime())
+        attributesList = [{'region': 'us-east-1', 'bucket': 'mybucket', 'key': key + '-' + str(i)} for i in range(3)]
+        objectIds = bulkIndexAttributes(attributesList, self.esEndpoint)
+        self.assertEqual(objectIds, [makeUniqueId(attributes) for attributes in attributesList], 'Bulk index did not succeed for every object')
+
+        for (objectId, attributes) in zip(objectIds, attributesList):
+            result = getById(objectId, self.esEndpoint)
+            self.assertEqual(result['_source'], attributes, 'Verification fetch did not match expected result')
+
+    def test_bulkDeleteAttributes(self):
+        ''' Indexed documents are removed, and removing a document that is not in the index succeeds '''
+        from time import gmtime, strftime
+        key = strftime("%Y-%m-%dT%H:%M:%S", gmtime())
+        attributesList = [{'region': 'us-east-1', 'bucket': 'mybucket', 'key': key + '-delete-' + str(i)} for i in range(3)]
+        bulkIndexAttributes(attributesList[:2], self.esEndpoint)
+        objectIds = bulkDeleteAttributes(attributesList, self.esEndpoint, chunkSize=2)
+        self.assertEqual(objectIds, [makeUniqueId(attributes) for attributes in attributesList], 'Bulk delete did not succeed for every object')
+
+        es = esInit(self.esEndpoint)
+        for objectId in objectIds:
+            self.assertFalse(es.exists(index=HabitatIndex, doc_type=DocType, id=objectId), 'Document was not removed')
+
+    def test_getIndexTemplate(self):
+        ''' Known attributes and configured attributes are mapped explicitly and unknown strings are keywords '''
+        template = getIndexTemplate({'esFieldMappings': {'runId': 'long'}, 'esTotalFieldsLimit': 200}, 6)
+        mapping = template['mappings'][DocType]
+        self.assertEqual(mapping['properties']['key'], {'type': 'keyword'})
+        self.assertEqual(mapping['properties']['runId'], {'type': 'long'})
+        self.assertEqual(mapping['dynamic_templates'][0]['unmapped_strings']['mapping']['type'], 'keyword')
+        self.assertEqual(template['settings']['index.mapping.total_fields.limit'], 200)
+        self.assertIn(HabitatIndex + '-*', template['index_patterns'])
+        self.assertEqual(getIndexTemplate({}, 5)['template'], HabitatIndex + '*')
+
+    def test_loadConfigs(self):
+        ''' The index names follow the compiled configs of configutils.get_configs when they change '''
+        self.assertIs(loadConfigs(), configutils.get_configs())
+        savedGetConfigs = configutils.get_configs
+        configs = configutils.compile_configs(dict(configutils.load_configs(), esHabitatIndex='habitat-changed', esRollover={}))
+        configutils.get_configs = lambda: configs
+        try:
+            loadConfigs()
+            self.assertEqual((esutils.HabitatIndex, esutils.ReadIndex), ('habitat-changed', 'habitat-changed-all'))
+        finally:
+            configutils.get_configs = savedGetConfigs
+            loadConfigs()
+        self.assertEqual(esutils.HabitatIndex, configutils.get_configs()['esHabitatIndex'])
+
+    def test_sequencerToVersion(self):
+        ''' Later sequencers give greater versions, whatever their lengths '''
+        self.assertLess(sequencerToVersion('0055AED6DCD90281E5'), sequencerToVersion('0055AED6DCD9028200'))
+        self.assertLess(sequencerToVersion('0055AED6DCD902'), sequencerToVersion('0055AED6DCD90281E5'))
+        self.assertEqual(sequencerToVersion('FFFFFFFFFFFFFFFFFF'), MaxVersion)
+        self.assertIsNone(sequencerToVersion(None))
+
+    def test_stale_event(self):
+        ''' An event with an older sequencer does not overwrite the document '''
+        from time import gmtime, strftime
+        key = strftime("%Y-%m-%dT%H:%M:%S", gmtime())
+        newer = {'region': 'us-east-1', 'bucket': 'mybucket', 'key': key, 'sequencer': '0055AED6DCD9028200', 'value': 'newer'}
+        older = {'region': 'us-east-1', 'bucket': 'mybucket', 'key': key, 'sequencer': '0055AED6DCD90281E5', 'value': 'older'}
+        objectId = makeUniqueId(newer)
+        self.assertEqual(bulkIndexAttributes([newer], self.esEndpoint), [objectId])
+        self.assertEqual(bulkIndexAttributes([older], self.esEndpoint), [objectId], 'A stale event should count as success')
+        self.assertEqual(bulkDeleteAttributes([older], self.esEndpoint), [objectId], 'A stale removal should count as success')
+        self.assertEqual(getById(objectId, self.esEndpoint)['_source'], newer, 'Stale event overwrote the document')
+
+    def test_esInit_reuse(self):
+        ''' The client (and its connection pool) is created once per endpoint '''
+        self.assertIs(esInit(self.esEndpoint), esInit(self.esEndpoint), 'Elasticsearch client was not reused')
+
+    def test_searchHits(self):
+        ''' Every hit is returned once across pages, in sorted order, and across slices '''
+        from time import gmtime, strftime
+        runId = strftime("search-%Y%m%dT%H%M%S", gmtime())
+        attributesList = [{'region': 'us-east-1', 'bucket': 'mybucket', 'key': runId + '-' + str(i), 'runId': runId} for i in range(5)]
+        bulkIndexAttributes(attributesList, self.esEndpoint)
+        esInit(self.esEndpoint).indices.refresh(index=ReadIndex)
+        query = {'term': {'runId': runId}}
+        expected = sorted(makeUniqueId(attributes) for attributes in attributesList)
+
+        self.assertEqual(sorted(hit['_id'] for hit in searchHits(query, self.esEndpoint, pageSize=2)), expected, 'Scroll did not return every hit')
+        hits = list(searchHits(query, self.esEndpoint, pageSize=2, sort=[{'_uid': 'asc'}]))
+        self.assertEqual([hit['_id'] for hit in hits], expected, 'search_after did not return every hit in order')
+        sliced = []
+        for sliceId in range(2):
+            sliced.extend(hit['_id'] for hit in searchHits(query, self.esEndpoint, pageSize=2, sliceId=sliceId, maxSlices=2))
+        self.assertEqual(sorted(sliced), expected, 'Slices did not cover every hit exactly once')
+
+    def test_queryAll(self):
+        queryAll(ReadIndex, self.esEndpoint)
+
+    def test_indexAttributes(self):
+        ''' Simple test of unique insert of a new index '''
+        from time import gmtime, strftime
+        key = strftime("%Y-%m-%dT%H:%M:%S", gmtime())
+        attributes = {
+                'region': 'us-east-1',
+                'bucket': 'mybucket',
+                'key': key
+                }
+        objectId = indexAttributes(attributes, self.esEndpoint)
+        print 'ObjectId:', objectId
+        self.assertIsNotNone(objectId, 'Could not insert into index')
+
+        result = getById(objectId, self.esEndpoint)
+        expected = {
+                u'_type': DocType,
+                u'_source': attributes,
+                u'_index': HabitatIndex,
+                u'_version': 1,
+                u'found': True,
+                u'_id': objectId
+                }
+        self.assertEqual(result, expected, 'Verification fetch did not match expected result')
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+'''
+File: test_filenamemeta.py
+
+Unit tests for filenamemeta.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import filenamemeta
+from filenamemeta import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_get_attributes_from_filename(self):
+        ''' Happy path test case '''
+        fname = 'a1234-15-imager_1234567890.tif'
+        regex = '^(?P<assayId>\w+)-(?P<runId>\d+)-\w+.tif$'
+        attributes = get_attributes_from_filename(fname, regex)
+        expected = {
+                'assayId': 'a1234',
+                'runId': '15'
+                }
+        self.assertEqual(attributes, expected, 'Attribute dictionaries do not match')
+
+    def test_get_attributes_from_filename_nomatch(self):
+        ''' No matching keys are found '''
+        fname = 'readme.txt'
+        regex = '^(?P<assayId>\w+)-(?P<runId>\d+)-\w+.tif$'
+        attributes = get_attributes_from_filename(fname, regex)
+        self.assertIsNone(attributes, 'Expected None since there should be no matches')
+
+    def test_get_attributes_from_filename_partialmatch_rigid(self):
+        ''' At least one matching key is found, but not all, and regex expects all '''
+        fname = 'a1234-imager_1234567890.tif'
+        regex = '^(?P<assayId>\w+)-(?P<runId>\d+)-\w+.tif$'
+        attributes = get_attributes_from_filename(fname, regex)
+        self.assertIsNone(attributes, 'Expected None since the regex was rigid and expected all matches')
+
+    def test_get_attributes_from_filename_partialmatch_flexible(self):
+        ''' At least one matching key is found, but not all, and regex is okay with just some '''
+        fname = 'a1234-imager_1234567890.tif'
+        regex = '^(?P<assayId>\w+)-((?P<runId>\d+)-)?\w+.tif$'
+        attributes = get_attributes_from_filename(fname, regex)
+        expected = {
+                'assayId': 'a1234',
+                'runId': None
+                }
+        self.assertEqual(attributes, expected, 'Expected some key/values since the regex was flexible')
+
+    def test_router(self):
+        ''' Keys are dispatched by prefix and suffix and the first matching route wins '''
+        routes = [
+                {'prefix': 'data/imager/', 'regex': '^data/imager/(?P<assayId>\w+)-(?P<runId>\d+)-\w+.tif$'},
+                {'suffix': '.csv', 'regex': '/(?P<plateId>P\d+)_(?P<well>[A-P]\d+).csv$'},
+                {'prefix': 'data/imager/', 'suffix': '.png', 'regex': '/(?P<thumbnail>\w+).png$'},
+                {'regex': '^data/(?P<instrument>\w+)/'}
+                ]
+        router = FilenameRouter(routes)
+        self.assertEqual(router.get_attributes('data/imager/a1234-15-imager_1234567890.tif'),
+                {'assayId': 'a1234', 'runId': '15'}, 'Prefix route did not match')
+        self.assertEqual(router.get_attributes('data/reader/P12_A01.csv'),
+                {'plateId': 'P12', 'well': 'A01'}, 'Suffix route did not match')
+        self.assertEqual(router.get_attributes('data/imager/thumb.png'), {'thumbnail': 'thumb'}, 'Prefix and suffix route did not match')
+        self.assertEqual(router.get_attributes('data/reader/readme.txt'), {'instrument': 'reader'}, 'Catch-all route did not match')
+        self.assertIsNone(router.get_attributes('meta/readme.txt'), 'Expected None since no route should match')
+        self.assertEqual(len(router.get_candidates('data/reader/readme.txt')), 1, 'Only the catch-all route should be a candidate')
+
+    def test_router_guard(self):
+        ''' Regexes that may backtrack catastrophically are rejected when guarded '''
+        self.assertTrue(has_nested_quantifier('^(\w+)+$'))
+        self.assertTrue(has_nested_quantifier('^((a|b)*c)*$'))
+        self.assertFalse(has_nested_quantifier('^(?P<assayId>\w+)-((?P<runId>\d+)-)?\w+.tif$'))
+        self.assertFalse(has_nested_quantifier('^[(+]+\(a+\)+$'))
+        self.assertRaises(ValueError, FilenameRouter, [{'regex': '^(a+)+$'}], True)
+        compile_regex('^(b+)+$')
+        self.assertRaises(ValueError, compile_regex, '^(b+)+$', True) # Even once compiled without the guard
+        router = FilenameRouter([{'regex': '^(?P<name>\w+)'}], True, 10)
+        self.assertIsNone(router.get_attributes('a' * 11), 'Expected None since the key is too long')
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+'''
+File: test_habitat_handler.py
+
+Unit tests for habitat_handler.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import habitat_handler
+from habitat_handler import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        self.configs = configutils.load_configs()
+        self.bucket = self.configs['bucket']
+
+    def test_handler(self):
+        event = {
+          "Records": [
+            {
+              "eventVersion": "2.0",
+              "eventTime": "1970-01-01T00:00:00.000Z",
+              "requestParameters": {
+                "sourceIPAddress": "127.0.0.1"
+              },
+              "s3": {
+                "configurationId": "testConfigRule",
+                "object": {
+                  "eTag": "0123456789abcdef0123456789abcdef",
+                  "sequencer": "0A1B2C3D4E5F678901",
+                  "key": "data/unittest-a1234-15-imager_1234567890.tif",
+                  "size": 1024
+                },
+                "bucket": {
+                  "arn": "arn:aws:s3:::"+self.bucket,
+                  "name": self.bucket,
+                  "ownerIdentity": {
+                    "principalId": "EXAMPLE"
+                  }
+                },
+                "s3SchemaVersion": "1.0"
+              },
+              "responseElements": {
+                "x-amz-id-2": "EXAMPLE123/5678abcdefghijklambdaisawesome/mnopqrstuvwxyzABCDEFGH",
+                "x-amz-request-id": "EXAMPLE123456789"
+              },
+              "awsRegion": "us-east-1",
+              "eventName": "ObjectCreated:Put",
+              "userIdentity": {
+                "principalId": "aPrincipalId"
+              },
+              "eventSource": "aws:s3"
+            }
+          ]
+        }
+
+        # Get the existing version if already indexed
+        # objectId creation assumes a lot and is therefore brittle
+        objectId = self.bucket + '/data/unittest-a1234-15-imager_1234567890.tif'
+        version = esutils.sequencerToVersion('0A1B2C3D4E5F678901') # The sequencer is the external version
+
+        # Do the actual test
+        objectId = event_handler(event, None)
+        self.assertIsNotNone(objectId, 'event_handler failed')
+
+        # Check the results
+        result = esutils.getById(objectId, self.configs['esEndpoint'])
+        expected = {
+                u'_type': u'habitat-testtype',
+                u'_source': {
+                    u'bodykey2': u'value2',
+                    u'bodykey1': u'value1',
+                    's3meta1': u'metaValue1',
+                    's3meta2': u'metaValue2',
+                    u'LastModified': 'DUMMY_LASTMODIFIED',
+                    u'ContentLength': 115,
+                    u'runId': u'15',
+                    u'bucket': self.bucket,
+                    u'user': u'aPrincipalId',
+                    u'key': u'data/unittest-a1234-15-imager_1234567890.tif',
+                    u'region': u'us-east-1',
+                    u'assayId': u'a1234',
+                    u'size': 1024,
+                    u'sequencer': u'0A1B2C3D4E5F678901'
+                    },
+                u'_index': u'habitatunittest',
+                u'_version': version,
+                u'found': True,
+                u'_id': self.bucket + '/data/unittest-a1234-15-imager_1234567890.tif'
+                }
+
+        source = result['_source']
+        self.assertIsNotNone(source.get('LastModified', None), 'Missing the LastModified attribute')
+        result['_source']['LastModified'] = 'DUMMY_LASTMODIFIED'
+        self.assertEqual(result, expected, 'Get from ES did not match what was expected')
+
+    def test_handler_batch(self):
+        ''' Two records in one event are both indexed and reported individually '''
+        def make_record(key):
+            return {
+              "awsRegion": "us-east-1",
+              "eventName": "ObjectCreated:Put",
+              "userIdentity": {"principalId": "aPrincipalId"},
+              "s3": {
+                "object": {"key": key, "size": 1024, "sequencer": "0A1B2C3D4E5F678901"},
+                "bucket": {"name": self.bucket}
+              }
+            }
+        key = 'data/unittest-a1234-15-imager_1234567890.tif'
+        event = {"Records": [make_record(key), make_record(key)]}
+        results = event_handler(event, None)
+        expected = [self.bucket + '/' + key] * 2
+        self.assertEqual(results, expected, 'Batch event_handler did not index every record')
+
+    def test_handler_removed(self):
+        ''' A removal event removes the object's document from the index '''
+        key = 'data/unittest-a1234-15-imager_1234567890.tif'
+        def make_record(eventName):
+            return {
+              "awsRegion": "us-east-1",
+              "eventName": eventName,
+              "userIdentity": {"principalId": "aPrincipalId"},
+              "s3": {
+                "object": {"key": key, "size": 1024, "sequencer": "0A1B2C3D4E5F678901"},
+                "bucket": {"name": self.bucket}
+              }
+            }
+        objectId = self.bucket + '/' + key
+        results = handle_records([make_record('ObjectCreated:Put'), make_record('ObjectRemoved:Delete')], self.configs)
+        self.assertEqual(results, [objectId, objectId], 'Expected the removal to supersede the creation')
+        es = esutils.esInit(self.configs['esEndpoint'])
+        self.assertFalse(es.exists(index=esutils.HabitatIndex, doc_type=esutils.DocType, id=objectId), 'Document was not removed')
+
+        # Restore the document for the other tests
+        self.assertEqual(handle_records([make_record('ObjectCreated:Put')], self.configs), [objectId])
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+'''
+File: test_importtime.py
+
+Import-time budget for the Lambda handler. The import of habitat_handler is part of every cold start, so it is
+measured (in a fresh interpreter, as on a cold start) and must stay within ImportBudgetSeconds. The modules that
+are only needed on some paths (elasticsearch, boto3, sqlite3, ...) must not be imported with it.
+
+Run from the directory with habitatconfig.json, like the other tests.
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import subprocess
+import json
+import sys
+
+ImportBudgetSeconds = 0.2 # Best of ImportRuns imports of habitat_handler
+ImportRuns = 3
+LazyModules = ['elasticsearch', 'requests', 'requests_aws4auth', 'urllib3', 'boto3', 'sqlite3', 'unittest']
+
+MeasureScript = '''
+import json, sys, time
+startTime = time.time()
+import habitat_handler
+seconds = time.time() - startTime
+print json.dumps({'seconds': seconds, 'modules': sorted(name for name in sys.modules if sys.modules[name] is not None)})
+'''
+
+def measure_import():
+    ''' Returns: (seconds, names of the loaded modules) for importing habitat_handler in a fresh interpreter '''
+    output = subprocess.check_output([sys.executable, '-c', MeasureScript])
+    result = json.loads(output.strip().splitlines()[-1])
+    return (result['seconds'], result['modules'])
+
+class TestController(unittest.TestCase):
+    def test_import_budget(self):
+        seconds = min(measure_import()[0] for run in range(ImportRuns))
+        print 'habitat_handler imported in {:.3f} seconds'.format(seconds)
+        self.assertLessEqual(seconds, ImportBudgetSeconds, 'Import of habitat_handler is over budget')
+
+    def test_lazy_modules(self):
+        modules = set(measure_import()[1])
+        self.assertEqual([name for name in LazyModules if name in modules], [], 'Modules imported on the cold start path')
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    unittest.main()
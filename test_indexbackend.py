@@ -0,0 +1,47 @@
+'''
+File: test_indexbackend.py
+
+Unit tests for indexbackend.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import sqlitebackend
+import indexbackend
+from indexbackend import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def test_get_backend(self):
+        configs = {'indexBackend': 'sqlite', 'sqlitePath': ':memory:'}
+        backend = get_backend(configs)
+        self.assertIsInstance(backend, sqlitebackend.SqliteBackend)
+        self.assertIs(get_backend(configs), backend, 'Backend was not reused')
+        self.assertIsInstance(as_backend('search-domain.us-east-1.es.amazonaws.com'), ElasticsearchBackend)
+        self.assertIs(as_backend(backend), backend)
+        self.assertRaises(ValueError, get_backend, {'indexBackend': 'dynamodb'})
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+'''
+File: test_manifest.py
+
+Unit tests for manifest.py (kept out of the module so that they are not deployed or imported with it).
+The manifests are read from an in-memory stand-in for S3 and indexed into an in-memory SQLite backend.
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import StringIO
+import gzip
+import json
+import esutils
+import indexbackend
+import sqlitebackend
+import manifest
+from manifest import *
+
+class ManifestS3(object):
+    ''' Stand-in for the S3 client with the manifest objects by key '''
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key):
+        return {'Body': StringIO.StringIO(self.objects[Key])}
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        self.configs = {
+                'bucket': 'habitat-test',
+                'dataFilenameRegex': '^data/(?P<runId>\\d+)/',
+                'manifestPrefix': 'manifests/',
+                'manifestBatchSize': 2
+                }
+        self.backend = sqlitebackend.SqliteBackend(':memory:')
+        self.manifestAttributes = {'region': 'us-east-1', 'bucket': 'habitat-test', 'key': 'manifests/run15.csv', 'user': 'aPrincipalId'}
+        self.csv = ('\xef\xbb\xbfkey, assayId,operator,note\r\n'
+                'data/15/plate1.tif,a1234,"Smith, J.","two\r\nlines"\r\n'
+                'data/15/plate2.tif,a1234,"Smith, J.",\r\n'
+                '\r\n'
+                ',a1234,no key,\r\n'
+                'data/15/plate3.tif,a1234,,"caf\xc3\xa9"\r\n')
+
+    def get_source(self, key):
+        return self.backend.get(esutils.makeUniqueId({'bucket': 'habitat-test', 'key': key}))['_source']
+
+    def index(self, key, data):
+        self.manifestAttributes['key'] = key
+        return index_manifest(ManifestS3({key: data}), self.manifestAttributes, self.configs, self.backend)
+
+    def test_iter_lines(self):
+        ''' Lines split across chunks are joined, and the byte order mark is dropped '''
+        chunks = iter_chunks(StringIO.StringIO(self.csv), chunkBytes=7)
+        self.assertEqual(''.join(iter_lines(chunks)), self.csv[3:])
+
+    def test_iter_rows(self):
+        rows = list(iter_rows(iter_lines([self.csv[3:]]), 'csv'))
+        self.assertEqual(len(rows), 4, 'Expected the blank line to be skipped')
+        self.assertEqual(rows[0][1], {'key': 'data/15/plate1.tif', 'assayId': 'a1234', 'operator': 'Smith, J.', 'note': 'two\r\nlines'})
+        self.assertEqual(rows[3][1]['note'], u'caf\xe9')
+        tsv = 'key\trunId\ndata/1.tif\t1\ndata/2.tif\t2\textra\n'
+        self.assertEqual(list(iter_rows(iter_lines([tsv]), 'tsv')), [(2, {'key': 'data/1.tif', 'runId': '1'}), (3, None)])
+
+    def test_index_manifest_csv(self):
+        counts = self.index('manifests/run15.csv', self.csv)
+        self.assertEqual(counts, {'rows': 4, 'indexed': 3, 'queued': 0, 'failed': 0, 'skipped': 1})
+        source = self.get_source('data/15/plate1.tif')
+        self.assertEqual(source['operator'], 'Smith, J.')
+        self.assertEqual(source['runId'], '15', 'Expected the file name regex attributes')
+        self.assertEqual(source['manifest'], 'manifests/run15.csv')
+        self.assertNotIn('note', self.get_source('data/15/plate2.tif'), 'Expected empty cells to be left out')
+
+    def test_index_manifest_jsonl(self):
+        data = '{"key": "data/16/a.tif", "runId": 99, "tags": ["x"]}\nnot json\n\n{"assayId": "no key"}\n'
+        counts = self.index('manifests/run16.jsonl.gz', self.gzip(data))
+        self.assertEqual(counts, {'rows': 3, 'indexed': 1, 'queued': 0, 'failed': 0, 'skipped': 2})
+        self.assertEqual(self.get_source('data/16/a.tif')['runId'], 99, 'Expected the row to win over the file name')
+        self.assertEqual(self.get_source('data/16/a.tif')['tags'], ['x'])
+
+    def test_batches(self):
+        ''' One bulk request per manifestBatchSize rows '''
+        calls = []
+        bulkMerge = self.backend.bulk_merge
+        self.backend.bulk_merge = lambda attributesList: calls.append(len(attributesList)) or bulkMerge(attributesList)
+        data = 'key\n' + ''.join('data/17/{}.tif\n'.format(i) for i in range(5))
+        self.assertEqual(self.index('manifests/run17.csv', data)['indexed'], 5)
+        self.assertEqual(calls, [2, 2, 1])
+
+    def test_merge_with_data_event(self):
+        ''' The rows are merged with the documents written by the data file events, in either order, and keep their version '''
+        dataAttributes = {'region': 'us-east-1', 'bucket': 'habitat-test', 'key': 'data/15/plate1.tif', 'user': 'anotherPrincipalId',
+                'ContentLength': 1024, 'runId': '15', 'sequencer': '0055AED6DCD90281E5'}
+        objectId = esutils.makeUniqueId(dataAttributes)
+        self.backend.index(dataAttributes)
+        self.index('manifests/run15.csv', self.csv)
+        document = self.backend.get(objectId)
+        self.assertEqual(document['_version'], esutils.sequencerToVersion('0055AED6DCD90281E5'))
+        self.assertEqual(document['_source']['ContentLength'], 1024, 'Expected the data file attributes to be kept')
+        self.assertEqual(document['_source']['operator'], 'Smith, J.')
+        self.assertEqual(document['_source']['manifestFields'], ['assayId', 'note', 'operator'])
+
+        self.backend.index(dict(dataAttributes, ContentLength=2048, operator='jdoe', sequencer='0055AED6DCD9028200'))
+        source = self.get_source('data/15/plate1.tif')
+        self.assertEqual(source['ContentLength'], 2048)
+        self.assertEqual((source['operator'], source['manifest']), ('Smith, J.', 'manifests/run15.csv'), 'Expected the manifest attributes to be kept')
+        self.assertEqual(self.backend.get(objectId)['_version'], esutils.sequencerToVersion('0055AED6DCD9028200'))
+        self.assertEqual(self.backend.bulk_index([dataAttributes]), [objectId])
+        self.assertEqual(self.get_source('data/15/plate1.tif')['ContentLength'], 2048, 'Expected the older event to stay stale')
+
+    def test_handle_records(self):
+        ''' The handler routes created manifests to index_manifest '''
+        import habitat_handler
+        import metadata
+        configs = dict(self.configs, indexBackend='sqlite', sqlitePath=':memory:')
+        record = {'awsRegion': 'us-east-1', 'eventName': 'ObjectCreated:Put', 'userIdentity': {'principalId': 'aPrincipalId'},
+                's3': {'bucket': {'name': 'habitat-test'}, 'object': {'key': 'manifests/run15.csv', 'size': len(self.csv)}}}
+        savedS3 = metadata.s3
+        metadata.s3 = ManifestS3({'manifests/run15.csv': self.csv})
+        try:
+            self.assertTrue(is_manifest_record(record, configs))
+            self.assertEqual(habitat_handler.handle_records([record], configs), ['habitat-test/manifests/run15.csv'])
+        finally:
+            metadata.s3 = savedS3
+        backend = indexbackend.get_backend(configs)
+        self.assertEqual(backend.get('habitat-test/data/15/plate3.tif')['_source']['note'], u'caf\xe9')
+
+    def gzip(self, data):
+        buffer = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb') as f:
+            f.write(data)
+        return buffer.getvalue()
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+'''
+File: test_messagequeue.py
+
+Unit tests for messagequeue.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import messagequeue
+from messagequeue import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_local_queue(self):
+        ''' Received messages are hidden until the visibility timeout expires '''
+        queue = LocalQueue(visibilityTimeout=0.2)
+        queue.send('one')
+        queue.send('two')
+        self.assertEqual([message['body'] for message in queue.receive(10, 0)], ['one', 'two'])
+        self.assertEqual(queue.receive(10, 0), [], 'Expected in-flight messages to be hidden')
+        time.sleep(0.2)
+        messages = queue.receive(1, 0)
+        self.assertEqual([message['body'] for message in messages], ['one'], 'Expected the message to be visible again')
+        queue.delete(messages)
+        self.assertEqual(len(queue), 1)
+
+    def test_local_queue_delay(self):
+        ''' Delayed messages are not received until the delay has passed '''
+        queue = LocalQueue()
+        queue.send('later', 0.2)
+        self.assertEqual(queue.receive(10, 0), [], 'Expected the delayed message to be hidden')
+        self.assertEqual([message['body'] for message in queue.receive(10, 1)], ['later'])
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+'''
+File: test_metadata.py
+
+Unit tests for metadata.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import logging
+import time
+import metadata
+from metadata import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        import configutils
+        self.configs = configutils.load_configs()
+
+        ''' Assumes that a test file has been uploaded and matches the expected name and content '''
+        self.region = self.configs['region']
+        self.bucket = self.configs['bucket']
+        self.assayId = 'a1234'
+        self.runId = '15'
+        self.key = 'data/unittest-{}-{}-imager_1234567890.tif'.format(self.assayId, self.runId)
+        self.user = 'aPrincipalId'
+        self.contentLength = 115
+        self.size = 1024
+
+        self.event = {
+          "Records": [
+            {
+              "eventVersion": "2.0",
+              "eventTime": "1970-01-01T00:00:00.000Z",
+              "requestParameters": {
+                "sourceIPAddress": "127.0.0.1"
+              },
+              "s3": {
+                "configurationId": "testConfigRule",
+                "object": {
+                  "eTag": "0123456789abcdef0123456789abcdef",
+                  "sequencer": "0A1B2C3D4E5F678901",
+                  "key": self.key,
+                  "size": self.size
+                },
+                "bucket": {
+                  "arn": "arn:aws:s3:::" + self.bucket,
+                  "name": self.bucket,
+                  "ownerIdentity": {
+                    "principalId": "EXAMPLE"
+                  }
+                },
+                "s3SchemaVersion": "1.0"
+              },
+              "responseElements": {
+                "x-amz-id-2": "EXAMPLE123/5678abcdefghijklambdaisawesome/mnopqrstuvwxyzABCDEFGH",
+                "x-amz-request-id": "EXAMPLE123456789"
+              },
+              "awsRegion": self.region,
+              "eventName": "ObjectCreated:Put",
+              "userIdentity": {
+                "principalId": self.user
+              },
+              "eventSource": "aws:s3"
+            }
+          ]
+        }
+
+        self.expected_head_attributes = {
+                'LastModified': '2016-03-26T16:14:13+00:00',
+                'ContentLength': self.contentLength
+                }
+
+        self.expected_event_attributes = {
+                'region': self.region,
+                'bucket': self.bucket,
+                'user': self.user,
+                'key': self.key,
+                'size': self.size,
+                'sequencer': '0A1B2C3D4E5F678901'
+                }
+
+        self.expected_body_attributes = {
+                'bodykey1': 'value1',
+                'bodykey2': 'value2'
+                }
+
+        self.expected_filename_attributes = {
+                'assayId': self.assayId,
+                'runId': self.runId
+                }
+
+        self.expected_s3meta_attributes = {
+                's3meta1': 'metaValue1',
+                's3meta2': 'metaValue2'
+                }
+
+        self.expected_attributes = {}
+        self.expected_attributes.update(self.expected_event_attributes)
+        self.expected_attributes.update(self.expected_head_attributes)
+        self.expected_attributes.update(self.expected_s3meta_attributes)
+        self.expected_attributes.update(self.expected_body_attributes)
+        self.expected_attributes.update(self.expected_filename_attributes)
+
+    def test_get_all_attributes(self):
+        attributes = get_attributes(self.event, self.configs)
+        self.assertIsNotNone(attributes.get('LastModified', None), 'Missing the LastModified attribute')
+        attributes['LastModified'] = '2016-03-26T16:14:13+00:00'
+        self.assertEqual(attributes, self.expected_attributes, 'Attribute dictionaries do not match')
+
+    def test_run_sources(self):
+        ''' Results come back in source order even when the sources finish out of order '''
+        import time
+        def source(value, delay):
+            time.sleep(delay)
+            return value
+        results = run_sources([(source, (1, 0.2)), (source, (2, 0.1)), (source, (3, 0))], self.configs)
+        self.assertEqual(results, [1, 2, 3], 'Results are not in source order')
+
+    def test_run_sources_concurrently(self):
+        ''' Concurrent callers share one source pool, which grows so that their sources do not wait on each other '''
+        from multiprocessing.pool import ThreadPool
+        def source(value, delay):
+            time.sleep(delay)
+            return value
+        configs = dict(self.configs, metadataSourceThreads=1)
+        callers = ThreadPool(8)
+        startTime = time.time()
+        results = callers.map(lambda i: run_sources([(source, (i, 0.2)), (source, (-i, 0))], configs), range(8))
+        callers.close()
+        self.assertEqual(results, [[i, -i] for i in range(8)])
+        self.assertLess(time.time() - startTime, 0.2 * 4, 'Expected the sources of the callers to run concurrently')
+        self.assertGreaterEqual(metadata.sourcePoolSize, 2)
+
+    def test_get_attributes_from_event(self):
+        attributes = get_attributes_from_event(self.event)
+        self.assertEqual(attributes, self.expected_event_attributes, 'Event dictionaries do not match')
+
+    def test_get_s3_records_sns(self):
+        ''' Records fanned in through SNS and SQS are unwrapped '''
+        snsEvent = {'Records': [{'Sns': {'Message': json.dumps(self.event)}}]}
+        sqsEvent = {'Records': [{'body': json.dumps(self.event)}, {'body': json.dumps({'Message': json.dumps(self.event)})}]}
+        self.assertEqual(get_s3_records(snsEvent), self.event['Records'], 'SNS records do not match')
+        self.assertEqual(get_s3_records(sqsEvent), self.event['Records'] * 2, 'SQS records do not match')
+
+    def test_is_removal_record(self):
+        record = dict(self.event['Records'][0])
+        self.assertFalse(is_removal_record(record), 'A created event is not a removal')
+        for eventName in ('ObjectRemoved:Delete', 'ObjectRemoved:DeleteMarkerCreated', 'LifecycleExpiration:Delete'):
+            record['eventName'] = eventName
+            self.assertTrue(is_removal_record(record), eventName + ' is a removal')
+        expected = {'region': 'us-east-1', 'bucket': self.bucket, 'key': self.key, 'sequencer': '0A1B2C3D4E5F678901'}
+        self.assertEqual(get_removed_attributes(record), expected)
+
+    def test_get_attributes_batch(self):
+        event = {'Records': self.event['Records'] * 2}
+        attributesList = get_attributes_batch(event, self.configs)
+        self.assertEqual(len(attributesList), 2, 'Expected one set of attributes per record')
+        for attributes in attributesList:
+            attributes['LastModified'] = '2016-03-26T16:14:13+00:00'
+            self.assertEqual(attributes, self.expected_attributes, 'Attribute dictionaries do not match')
+
+    def test_save_attributes(self):
+        expectedObjectId = '{}/{}'.format(self.bucket, self.key)
+        objectId = save_attributes(self.expected_attributes, self.configs['esEndpoint'])
+        print 'Object ID:', str(objectId)
+        self.assertEqual(objectId, expectedObjectId, 'Object Ids do not match')
+
+    def test_save_attributes_batch(self):
+        expectedObjectId = '{}/{}'.format(self.bucket, self.key)
+        objectIds = save_attributes_batch([self.expected_attributes, None], self.configs['esEndpoint'])
+        self.assertEqual(objectIds, [expectedObjectId, None], 'Object Ids do not match')
+
+    def test_save_attributes_batch_queued(self):
+        ''' Writes that fail but are queued for retry are reported as handled (a QueuedId), others as None '''
+        import retryqueue
+        import messagequeue
+        class FailingBackend(object):
+            def bulk_index(self, attributesList):
+                return [None] * len(attributesList)
+        attributes = {'bucket': 'mybucket', 'key': 'data/a.tif'}
+        retryQueue = retryqueue.MessageRetryQueue(messagequeue.LocalQueue())
+        objectIds = save_attributes_batch([attributes], FailingBackend(), retryQueue)
+        self.assertIsInstance(objectIds[0], QueuedId)
+        self.assertEqual(objectIds[0], 'mybucket/data/a.tif')
+        self.assertEqual(len(retryQueue.receive(10)), 1)
+        self.assertEqual(save_attributes_batch([attributes], FailingBackend()), [None])
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+        
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    logFormat = '%(levelname)s:%(asctime)s:HABITAT:%(module)s-%(lineno)d: %(message)s'
+    logLevel = logging.INFO
+    logging.basicConfig(format=logFormat, level=logLevel)
+
+    unittest.main()
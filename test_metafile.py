@@ -0,0 +1,138 @@
+'''
+File: test_metafile.py
+
+Unit tests for metafile.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import logging
+import boto3
+import metafile
+from metafile import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        import configutils
+        self.configs = configutils.load_configs()
+
+        self.bucket = self.configs['bucket']
+        self.keyBase = 'meta/unittest-a1234-15-imager_1234567890.'
+        self.json_expected = {
+                'json1': 'jsonValue1',
+                'json2': 'jsonValue2'
+                }
+        self.csv_expected = {
+                'csv1': 'csvValue1',
+                'csv2': 'csvValue2',
+                'csv3': 'csvValue3'
+                }
+        self.custom_expected = {
+                'custom1': 'customValue1',
+                'custom2': 'customValue2'
+                }
+        self.plugin = 'defaultMetafileParser'
+
+    def test_get_body_data_from_object(self):
+        s3 = boto3.client('s3')
+        data = get_body_data_from_object(s3, self.bucket, self.keyBase + 'json')
+        expected = '''{
+    "json1": "jsonValue1",
+    "json2": "jsonValue2"
+}
+'''
+        self.assertEqual(data, expected, 'Body data does not match expectation')
+
+    def test_get_attributes_as_json(self):
+        data = json.dumps(self.json_expected)
+        attributes = get_attributes_as_json(data)
+        self.assertEqual(attributes, self.json_expected, 'Attribute dictionaries do not match')
+
+    def test_get_attributes_as_csv(self):
+        data = '''csv1,"csv2", csv3
+csvValue1,"csvValue2", csvValue3'''
+        attributes = get_attributes_as_csv(data)
+        self.assertEqual(attributes, self.csv_expected, 'Attribute dictionaries do not match')
+
+    def test_get_attributes_using_custom(self):
+        data = '''custom1=customValue1
+custom2=customValue2'''
+        attributes = get_attributes_using_custom(data, self.plugin)
+        self.assertEqual(attributes, self.custom_expected, 'Attribute dictionaries do not match')
+
+    def test_get_attributes_from_metadatafile_json(self):
+        ''' Test the json file format case '''
+        s3 = boto3.client('s3')
+        attributes = get_attributes_from_metadatafile(s3, self.bucket, self.keyBase + 'json', 'json', None)
+        self.assertEqual(attributes, self.json_expected, 'Attribute dictionaries do not match')
+        
+    def test_get_attributes_from_metadatafile_csv(self):
+        ''' Test the csv file format case '''
+        s3 = boto3.client('s3')
+        attributes = get_attributes_from_metadatafile(s3, self.bucket, self.keyBase + 'csv', 'csv', None)
+        self.assertEqual(attributes, self.csv_expected, 'Attribute dictionaries do not match')
+        
+    def test_get_attributes_from_metadatafile_custom(self):
+        ''' Test the custom file format case '''
+        s3 = boto3.client('s3')
+        attributes = get_attributes_from_metadatafile(s3, self.bucket, self.keyBase + 'custom', 'custom', self.plugin)
+        self.assertEqual(attributes, self.custom_expected, 'Attribute dictionaries do not match')
+
+    def test_companion_resolver(self):
+        ''' Companions are found in both directions and missing companions are only probed once '''
+        s3 = boto3.client('s3')
+        dataKey = 'data/unittest-a1234-15-imager_1234567890.tif'
+        resolver = CompanionResolver(s3, {'metafileExtensions': ['xml', 'custom', 'json']})
+        (data, metafileFormat) = resolver.get_metafile_data(self.bucket, dataKey)
+        self.assertEqual(metafileFormat, 'custom', 'Expected the first existing extension to win')
+        self.assertEqual(get_attributes_from_companion(resolver, self.bucket, dataKey, self.plugin), self.custom_expected)
+        self.assertEqual(len(resolver.listings), 1, 'Expected a single LIST for all of the candidates')
+
+        self.assertEqual(resolver.find_datafile(self.bucket, self.keyBase + 'json')[0], dataKey, 'Data file not found')
+
+        resolver = CompanionResolver(s3, {'metafileFormat': 'csv'})
+        self.assertIsNone(resolver.get_metafile_data(self.bucket, 'data/no-such-file.tif'), 'Expected no companion')
+        self.assertIn((self.bucket, 'meta/no-such-file.csv'), resolver.missing, 'Missing companion was not cached')
+
+    def test_find_datafile_listing(self):
+        ''' Only the stem with an extension is listed, in the same directory, with one bounded LIST '''
+        class ListingS3(object):
+            def __init__(self):
+                self.requests = []
+            def list_objects_v2(self, **kwargs):
+                self.requests.append(kwargs)
+                return {'Contents': [{'Key': 'data/run1/a.tif', 'Size': 10}]}
+        s3 = ListingS3()
+        resolver = CompanionResolver(s3, {})
+        self.assertEqual(resolver.find_datafile('mybucket', 'meta/run1/a.json'), ('data/run1/a.tif', 10))
+        self.assertEqual(s3.requests, [{'Bucket': 'mybucket', 'Prefix': 'data/run1/a.', 'Delimiter': '/', 'MaxKeys': DatafileMaxKeys}])
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    logFormat = '%(levelname)s:%(asctime)s:HABITAT:%(module)s-%(lineno)d: %(message)s'
+    logLevel = logging.INFO
+    logging.basicConfig(format=logFormat, level=logLevel)
+
+    unittest.main()
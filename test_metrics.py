@@ -0,0 +1,60 @@
+'''
+File: test_metrics.py
+
+Unit tests for metrics.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import metrics
+from metrics import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def test_sampled(self):
+        self.assertTrue(start({'metricsSampleRate': 1}))
+        with timer('stage'):
+            pass
+        with timer('stage'):
+            pass
+        count('bytes', 10)
+        count('bytes', 5)
+        timed('other', lambda x: x)(1)
+        record = emit(records=2)
+        self.assertEqual(record['records'], 2)
+        self.assertEqual(record['counters'], {'bytes': 15})
+        self.assertEqual((record['stages']['stage']['count'], record['stages']['other']['count']), (2, 1))
+        self.assertIsNone(emit(), 'Batch was emitted twice')
+
+    def test_not_sampled(self):
+        self.assertFalse(start({}))
+        with timer('stage'):
+            pass
+        count('bytes', 10)
+        self.assertIsNone(emit())
+        self.assertEqual((stages, counters), ({}, {}), 'Metrics were recorded for an unsampled batch')
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    unittest.main()
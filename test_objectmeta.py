@@ -0,0 +1,181 @@
+'''
+File: test_objectmeta.py
+
+Unit tests for objectmeta.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import logging
+import StringIO
+import boto3
+import objectmeta
+from objectmeta import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        import configutils
+        self.configs = configutils.load_configs()
+        self.bucket = self.configs['bucket']
+        self.key = 'data/unittest-a1234-15-imager_1234567890.tif'
+        self.body_expected = {
+                'bodykey1': 'value1',
+                'bodykey2': 'value2'
+                }
+        self.head_expected = {
+                'LastModified': 'DUMMY LASTMODIFIED',
+                'ContentLength': 115
+                }
+        self.s3meta_expected = {
+                's3meta1': 'metaValue1',
+                's3meta2': 'metaValue2'
+                }
+
+    def test_get_no_attributes_from_object(self):
+        s3 = boto3.client('s3')
+        inspectHead = False
+        getMetadataFromS3Object = False
+        dataMaxBodyBytes = 0
+        attributes = get_attributes_from_object(s3, self.bucket, self.key,
+                inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, None)
+        expected = {}
+        self.assertEqual(attributes, expected, 'Attribute dictionaries do not match')
+
+    def test_get_just_head_attributes_from_object(self):
+        s3 = boto3.client('s3')
+        inspectHead = True
+        getMetadataFromS3Object = False
+        dataMaxBodyBytes = 0
+        attributes = get_attributes_from_object(s3, self.bucket, self.key,
+                inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, None)
+        self.assertIsNotNone(attributes.get('LastModified', None), 'Missing the LastModified attribute')
+        attributes['LastModified'] = 'DUMMY LASTMODIFIED'
+        self.assertEqual(attributes, self.head_expected, 'Attribute dictionaries do not match')
+
+    def test_get_just_s3meta_attributes_from_object(self):
+        s3 = boto3.client('s3')
+        inspectHead = False
+        getMetadataFromS3Object = True
+        dataMaxBodyBytes = 0
+        attributes = get_attributes_from_object(s3, self.bucket, self.key,
+                inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, None)
+        self.assertEqual(attributes, self.s3meta_expected, 'Attribute dictionaries do not match')
+
+    def test_get_head_and_s3meta_attributes_from_object(self):
+        s3 = boto3.client('s3')
+        inspectHead = True
+        getMetadataFromS3Object = True
+        dataMaxBodyBytes = 0
+        attributes = get_attributes_from_object(s3, self.bucket, self.key,
+                inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, None)
+        self.assertIsNotNone(attributes.get('LastModified', None), 'Missing the LastModified attribute')
+        attributes['LastModified'] = 'DUMMY LASTMODIFIED'
+        expected = {}
+        expected.update(self.head_expected)
+        expected.update(self.s3meta_expected)
+        self.assertEqual(attributes, expected, 'Attribute dictionaries do not match')
+
+    def test_get_attributes_from_shadow(self):
+        ''' The unit test object's user metadata is not marked as a shadow copy '''
+        s3 = boto3.client('s3')
+        self.assertIsNone(get_attributes_from_shadow(s3, self.bucket, self.key, True), 'Expected no shadow copy')
+
+    def test_get_just_body_attributes_from_object(self):
+        s3 = boto3.client('s3')
+        inspectHead = False
+        getMetadataFromS3Object = False
+        dataMaxBodyBytes = 40
+        dataPlugin = 'defaultDataBodyParser'
+        attributes = get_attributes_from_object(s3, self.bucket, self.key,
+                inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, dataPlugin)
+        self.assertEqual(attributes, self.body_expected, 'Attribute dictionaries do not match')
+
+    def test_get_all_attributes_from_object(self):
+        s3 = boto3.client('s3')
+        inspectHead = True
+        getMetadataFromS3Object = True
+        dataMaxBodyBytes = 40
+        dataPlugin = 'defaultDataBodyParser'
+        attributes = get_attributes_from_object(s3, self.bucket, self.key,
+                inspectHead, getMetadataFromS3Object, dataMaxBodyBytes, dataPlugin)
+        print '\n\nAttributes:'
+        print attributes
+        self.assertIsNotNone(attributes.get('LastModified', None), 'Missing the LastModified attribute')
+        attributes['LastModified'] = 'DUMMY LASTMODIFIED'
+        expected = {}
+        expected.update(self.body_expected)
+        expected.update(self.head_expected)
+        expected.update(self.s3meta_expected)
+        self.assertEqual(attributes, expected, 'Attribute dictionaries do not match')
+
+    def test_get_attributes_from_object_with_registry(self):
+        s3 = boto3.client('s3')
+        registry = pluginregistry.PluginRegistry([{'module': 'defaultDataBodyParser', 'suffix': '.tif', 'maxBytes': 40}])
+        attributes = get_attributes_from_object(s3, self.bucket, self.key, False, False, 0, None, registry)
+        self.assertEqual(attributes, self.body_expected, 'Attribute dictionaries do not match')
+
+        registry = pluginregistry.PluginRegistry([{'module': 'defaultDataBodyParser', 'suffix': '.png', 'maxBytes': 40}])
+        attributes = get_attributes_from_object(s3, self.bucket, self.key, False, False, 0, None, registry)
+        self.assertEqual(attributes, {}, 'Expected the body not to be parsed')
+
+    def test_content_type_route(self):
+        ''' The body is only read when the content type of the object (from a HEAD) selects a route '''
+        class HeadS3(object):
+            def __init__(self, contentType):
+                self.contentType = contentType
+                self.bytesRead = 0
+            def head_object(self, Bucket, Key):
+                return {'ContentType': self.contentType, 'ContentLength': 40, 'LastModified': 'DUMMY LASTMODIFIED'}
+            def get_object(self, Bucket, Key, Range):
+                data = 'bodykey1=value1\nbodykey2=value2\n'
+                self.bytesRead += len(data)
+                return {'Body': StringIO.StringIO(data), 'ContentRange': 'bytes 0-{}/{}'.format(len(data) - 1, len(data)),
+                        'ContentType': self.contentType, 'ContentLength': len(data), 'LastModified': 'DUMMY LASTMODIFIED'}
+        registry = pluginregistry.PluginRegistry([{'module': 'defaultDataBodyParser', 'contentType': 'image/tiff', 'maxBytes': 1024}])
+        s3 = HeadS3('application/pdf')
+        attributes = get_attributes_from_object(s3, self.bucket, self.key, True, False, 0, None, registry)
+        self.assertEqual(attributes, {'LastModified': 'DUMMY LASTMODIFIED', 'ContentLength': 40})
+        self.assertEqual(s3.bytesRead, 0, 'Expected no body bytes to be read without a parser for the content type')
+
+        s3 = HeadS3('image/tiff')
+        self.assertEqual(get_attributes_from_object(s3, self.bucket, self.key, False, False, 0, None, registry), self.body_expected)
+
+    def test_ranged_body(self):
+        ''' Only the requested ranges are fetched and the head fields describe the whole object '''
+        s3 = boto3.client('s3')
+        body = RangedBody(s3, self.bucket, self.key, 10)
+        self.assertEqual(body.head['ContentLength'], self.head_expected['ContentLength'], 'Expected the full object size')
+        self.assertEqual(body.bytesRead, 10, 'Expected only the first range to be read')
+        self.assertEqual(len(body.read_prefix(40)), 40, 'Prefix was not grown')
+        self.assertEqual(body.bytesRead, 40, 'Expected only the missing bytes to be read')
+        self.assertEqual(body.read_tail(5), body.read_range(body.size - 5, body.size + 100), 'Tail does not match')
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    logFormat = '%(levelname)s:%(asctime)s:HABITAT:%(module)s-%(lineno)d: %(message)s'
+    logLevel = logging.INFO
+    logging.basicConfig(format=logFormat, level=logLevel)
+
+    unittest.main()
@@ -0,0 +1,74 @@
+'''
+File: test_pluginregistry.py
+
+Unit tests for pluginregistry.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import pluginregistry
+from pluginregistry import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        self.routes = [
+                {'module': 'defaultMetafileParser', 'suffix': '.txt', 'maxBytes': 100},
+                {'module': 'defaultDataBodyParser', 'contentType': 'image/tiff'},
+                {'module': 'defaultDataBodyParser', 'prefix': 'data/imager/', 'maxBytes': 40}
+                ]
+
+    def test_load_plugin(self):
+        ''' Plugins are only imported once '''
+        module = load_plugin('defaultDataBodyParser')
+        self.assertIs(load_plugin('defaultDataBodyParser'), module, 'Plugin module was not reused')
+
+    def test_select(self):
+        registry = PluginRegistry(self.routes)
+        self.assertTrue(registry.has_content_type_routes())
+
+        route = registry.select('data/reader/plate.txt')
+        self.assertEqual((route.plugin, route.maxBytes), ('defaultMetafileParser', 100), 'Suffix route did not match')
+
+        route = registry.select('data/imager/image.tif')
+        self.assertEqual((route.plugin, route.maxBytes), ('defaultDataBodyParser', 40), 'Prefix route did not match')
+
+        route = registry.select('data/other/image.tif', 'image/tiff')
+        self.assertEqual(route.plugin, 'defaultDataBodyParser', 'Content type route did not match')
+        self.assertEqual(route.maxBytes, load_plugin('defaultDataBodyParser').MAX_BODY_BYTES, 'Plugin maxBytes was not used')
+
+        self.assertIsNone(registry.select('data/other/image.tif'), 'Content type route should not match without a content type')
+        self.assertIsNone(registry.select('data/other/image.jpg', 'image/jpeg'), 'Expected no parser')
+
+    def test_get_registry(self):
+        configs = {'dataBodyParserModule': 'defaultDataBodyParser', 'dataBodyParserMaxBytes': 40}
+        registry = get_registry(configs)
+        self.assertIs(get_registry(configs), registry, 'Registry was not reused')
+        route = registry.select('data/any.tif')
+        self.assertEqual((route.plugin, route.maxBytes), ('defaultDataBodyParser', 40), 'Legacy catch-all route did not match')
+        self.assertIsNone(get_registry({}).select('data/any.tif'), 'Expected no parser when none is configured')
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+'''
+File: test_retryqueue.py
+
+Unit tests for retryqueue.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import retryqueue
+from retryqueue import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        self.configs = configutils.load_configs()
+        self.directory = 'unittest_retry'
+        self.deadLetterDirectory = 'unittest_deadletter'
+        self.attributes = {
+                'region': 'us-east-1',
+                'bucket': 'mybucket',
+                'key': 'retrykey',
+                'LastModified': datetime.datetime(2016, 3, 26, 16, 14, 13)
+                }
+
+    def tearDown(self):
+        for directory in (self.directory, self.deadLetterDirectory):
+            if os.path.isdir(directory):
+                shutil.rmtree(directory)
+
+    def test_file_retry_queue(self):
+        ''' Entries are only received when due and survive as files until deleted '''
+        retryQueue = FileRetryQueue(self.directory)
+        retryQueue.put(self.attributes)
+        retryQueue.put(self.attributes, delaySeconds=60)
+        entries = retryQueue.receive(10)
+        self.assertEqual(len(entries), 1, 'Expected only the entry that is due')
+        self.assertEqual(entries[0]['attributes']['LastModified'], '2016-03-26T16:14:13')
+
+        retryQueue.retry(entries[0], 60)
+        self.assertEqual(retryQueue.receive(10), [], 'Expected the retried entry to be delayed')
+        self.assertEqual(len(FileRetryQueue(self.directory)), 2, 'Expected the entries to be durable')
+
+    def test_message_retry_queue(self):
+        retryQueue = MessageRetryQueue(messagequeue.LocalQueue())
+        retryQueue.put(self.attributes)
+        entries = retryQueue.receive(10)
+        self.assertEqual(entries[0]['attempts'], 0)
+        retryQueue.retry(entries[0], 0)
+        entries = retryQueue.receive(10)
+        self.assertEqual(entries[0]['attempts'], 1, 'Expected the attempt to be counted')
+        retryQueue.delete(entries)
+        self.assertEqual(retryQueue.receive(10), [])
+
+    def test_drainer_dead_letter(self):
+        ''' Entries that fail maxAttempts times end up in the dead-letter store '''
+        retryQueue = FileRetryQueue(self.directory)
+        deadLetterStore = FileDeadLetterStore(self.deadLetterDirectory)
+        retryQueue.put(self.attributes, attempts=1)
+        drainer = Drainer(retryQueue, deadLetterStore, 'no-such-endpoint.invalid', maxAttempts=2)
+        self.assertEqual(drainer.drain(), (0, 1), 'Expected the entry to be dead-lettered')
+        self.assertEqual(len(retryQueue), 0)
+        self.assertEqual(deadLetterStore.list_entries()[0]['attempts'], 2)
+
+    def test_drainer(self):
+        ''' Queued entries are indexed by the drainer '''
+        retryQueue = FileRetryQueue(self.directory)
+        retryQueue.put(self.attributes)
+        drainer = Drainer(retryQueue, FileDeadLetterStore(self.deadLetterDirectory), self.configs['esEndpoint'])
+        self.assertEqual(drainer.drain(), (1, 0), 'Expected the entry to be indexed')
+        self.assertEqual(len(retryQueue), 0)
+
+    def test_drainer_manifest_row(self):
+        ''' Queued manifest rows are merged into their documents '''
+        import sqlitebackend
+        backend = sqlitebackend.SqliteBackend(':memory:')
+        backend.index(dict(self.attributes, ContentLength=1024))
+        retryQueue = FileRetryQueue(self.directory)
+        retryQueue.put({'region': 'us-east-1', 'bucket': 'mybucket', 'key': 'retrykey', 'runId': '15', 'manifestFields': ['runId']})
+        drainer = Drainer(retryQueue, FileDeadLetterStore(self.deadLetterDirectory), backend)
+        self.assertEqual(drainer.drain(), (1, 0), 'Expected the entry to be indexed')
+        source = backend.get(esutils.makeUniqueId(self.attributes))['_source']
+        self.assertEqual((source['ContentLength'], source['runId']), (1024, '15'))
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    unittest.main()
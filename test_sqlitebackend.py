@@ -0,0 +1,73 @@
+'''
+File: test_sqlitebackend.py
+
+Unit tests for sqlitebackend.py (kept out of the module so that they are not deployed or imported with it)
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import sqlitebackend
+from sqlitebackend import *
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        self.backend = SqliteBackend(':memory:', ['runId'])
+        self.attributesList = [{'region': 'us-east-1', 'bucket': 'mybucket', 'key': 'data/a1234-{}.tif'.format(i),
+                'assayId': 'a1234', 'runId': i, 'note': 'plate {}'.format('even' if i % 2 == 0 else 'odd')} for i in range(5)]
+        self.backend.bulk_index(self.attributesList)
+
+    def search_keys(self, query, **kwargs):
+        return [hit['_source']['key'] for hit in self.backend.search(query, **kwargs)]
+
+    def test_get(self):
+        objectId = esutils.makeUniqueId(self.attributesList[0])
+        self.assertEqual(self.backend.get(objectId)['_source'], self.attributesList[0])
+        self.assertIsNone(self.backend.get('mybucket/missing'))
+
+    def test_search(self):
+        self.assertEqual(len(self.search_keys(None, pageSize=2)), 5, 'Expected every document across pages')
+        self.assertEqual(self.search_keys({'term': {'runId': 3}}), ['data/a1234-3.tif'])
+        self.assertEqual(len(self.search_keys({'range': {'runId': {'gte': 1, 'lt': 3}}})), 2)
+        query = {'bool': {'filter': [{'term': {'assayId': 'a1234'}}, {'match': {'note': 'even'}}], 'must_not': {'term': {'runId': 0}}}}
+        self.assertEqual(self.search_keys(query), ['data/a1234-2.tif', 'data/a1234-4.tif'])
+        sliced = self.search_keys(None, sliceId=0, maxSlices=2) + self.search_keys(None, sliceId=1, maxSlices=2)
+        self.assertEqual(sorted(sliced), self.search_keys(None), 'Slices did not cover every document exactly once')
+
+    def test_versions(self):
+        ''' Stale writes and removals (by sequencer) are skipped, and removals remove from the text index too '''
+        newer = dict(self.attributesList[0], sequencer='0055AED6DCD9028200', note='newer')
+        older = dict(self.attributesList[0], sequencer='0055AED6DCD90281E5', note='older')
+        objectId = esutils.makeUniqueId(newer)
+        self.assertEqual(self.backend.bulk_index([newer, older]), [objectId, objectId])
+        self.assertEqual(self.backend.get(objectId)['_source']['note'], 'newer')
+        self.backend.bulk_delete([older])
+        self.assertIsNotNone(self.backend.get(objectId), 'Stale removal removed the document')
+        self.backend.bulk_delete([dict(newer, sequencer='0055AED6DCD9028300')])
+        self.assertIsNone(self.backend.get(objectId))
+        self.assertEqual(self.search_keys({'match': {'note': 'newer'}}), [])
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    unittest.main()
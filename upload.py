@@ -0,0 +1,336 @@
+'''
+File: upload.py
+
+Upload data files into the habitat bucket together with their metadata.
+
+With attachMetadataToObject, the metadata is written into the S3 user metadata of the object on the same
+request as the data, so the indexer gets it from the head (getMetadataFromObject) without reading a companion
+metadata file. If no body parser applies to the file, the user metadata is also marked as a complete shadow copy,
+so a reindex can rebuild the file's document from its head alone (see backfill --from-shadow). Otherwise (or if the
+metadata does not fit in user metadata) and if metafileMode is enabled, a companion metadata file is written as well,
+before the data file for written_first and after it for written_last. It is written in the format that the indexer
+reads (json or csv, see Uploader.get_companion_format).
+
+Files are uploaded concurrently by a pool of workers, so many small files are uploaded in parallel. Large files
+are uploaded as parallel multipart uploads (boto3 managed transfers).
+
+Metadata for a file can be given on the command line (for all files) and/or in a local json sidecar file next to it
+(e.g., foo.tif.json for foo.tif), which takes precedence. Note that S3 returns user metadata keys in lower case.
+
+Usage:
+    python -m upload [--metadata '{"assayid": "a1234"}'] [--sidecar .json] [--prefix data/] [--workers 16] <file or directory>...
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import logging
+import argparse
+import threading
+import mimetypes
+import json
+import time
+import os
+import boto3
+import configutils
+import metafile
+import objectmeta
+import pluginregistry
+from boto3.s3.transfer import TransferConfig
+from multiprocessing.pool import ThreadPool
+
+DefaultWorkers = 16 # Files uploaded at once
+DefaultPartThreads = 4 # Parts of a large file uploaded at once
+DefaultPartSize = 8 * 1024 * 1024 # Files larger than this are uploaded in parts of this size
+MaxUserMetadataBytes = 2048 # S3 limit on the total size of the user metadata keys and values
+
+def get_user_metadata(metadata, shadow=False):
+    '''
+    Convert metadata to S3 user metadata (string values).
+    If shadow, the user metadata is marked as a complete shadow copy (see objectmeta.ShadowMarker).
+
+    Returns: the user metadata, or None if it cannot be stored as user metadata (not US-ASCII or too large)
+    '''
+    userMetadata = {}
+    for (name, value) in metadata.items():
+        if not isinstance(value, basestring):
+            value = json.dumps(value)
+        userMetadata[name] = value
+    if shadow:
+        userMetadata[objectmeta.ShadowMarker] = '1'
+    try:
+        size = sum(len(name.encode('ascii')) + len(value.encode('ascii')) for (name, value) in userMetadata.items())
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return None
+    if size > MaxUserMetadataBytes:
+        return None
+    return userMetadata
+
+def get_content_type(path):
+    ''' Returns: the content type that the file at path is uploaded with (and that content type routes select by) '''
+    return mimetypes.guess_type(path)[0] or 'binary/octet-stream'
+
+def is_sidecar(path, sidecar):
+    ''' Returns: True if the file at path is the sidecar metadata file of a data file, i.e., that data file is next to it '''
+    return bool(sidecar) and path.endswith(sidecar) and os.path.isfile(path[:-len(sidecar)])
+
+class Uploader(object):
+    '''
+    Uploads local files to keys under prefix (keeping their paths relative to the base directory) on a pool of workers.
+    Follows the attachMetadataToObject, metafileMode and metafilePairing configs.
+    '''
+    def __init__(self, s3, configs, prefix=None, workers=DefaultWorkers, partThreads=DefaultPartThreads, partSize=DefaultPartSize):
+        self.s3 = s3
+        self.bucket = configs['bucket']
+        self.attachMetadata = configs.get('attachMetadataToObject', False)
+        self.metafileMode = configs.get('metafileMode', 'disable')
+        self.resolver = metafile.CompanionResolver(s3, configs)
+        self.registry = pluginregistry.get_registry(configs)
+        self.prefix = prefix if prefix is not None else self.resolver.dataPrefix
+        if self.metafileMode != 'disable':
+            (self.companionExtension, self.companionFormat) = self.get_companion_format(configs)
+        self.workers = workers
+        self.transferConfig = TransferConfig(multipart_threshold=partSize, multipart_chunksize=partSize,
+                max_concurrency=partThreads, use_threads=partThreads > 1)
+        self.lock = threading.Lock()
+        self.stats = {'uploaded': 0, 'failed': 0, 'bytes': 0}
+        if self.attachMetadata and not configs.get('getMetadataFromObject', False):
+            logging.warning('attachMetadataToObject is set but getMetadataFromObject is not, so the metadata will not be indexed')
+
+    def get_companion_format(self, configs):
+        '''
+        Returns: (extension, format) of the companion metadata files to write. written_first companions are found by
+        the first of the metafileExtensions, and written_last ones are parsed as the metafileFormat.
+
+        Raises: ValueError if the format is custom, since only its plugin knows how to write it
+        '''
+        if self.metafileMode == 'written_first':
+            (extension, metafileFormat) = (self.resolver.extensions[0], self.resolver.formats[0])
+        else:
+            metafileFormat = configs.get('metafileFormat', 'json')
+            extensions = [extension for (extension, extensionFormat) in zip(self.resolver.extensions, self.resolver.formats)
+                    if extensionFormat == metafileFormat]
+            extension = extensions[0] if len(extensions) > 0 else metafileFormat
+        if metafileFormat not in ('json', 'csv'):
+            raise ValueError('Cannot write {} companion metadata files. Use metafileFormat json or csv to upload.'.format(metafileFormat))
+        return (extension, metafileFormat)
+
+    def put_metafile(self, key, metadata):
+        metaKey = self.resolver.metaPrefix + self.resolver.get_stem(key, self.resolver.dataPrefix) + '.' + self.companionExtension
+        (data, contentType) = metafile.format_metafile_data(metadata, self.companionFormat)
+        self.s3.put_object(Bucket=self.bucket, Key=metaKey, Body=data, ContentType=contentType)
+
+    def upload_file(self, path, key, metadata, complete=False):
+        '''
+        Upload the file at path to key with metadata (a dictionary of strings).
+        complete means that metadata already holds what the body parsers would extract (e.g., see watchfolder).
+
+        Returns: True on success
+        '''
+        try:
+            contentType = get_content_type(path)
+            # Without a body parser for the file, the metadata is all that the index needs beyond the key and head
+            shadow = complete or self.registry.select(key, contentType) is None
+            userMetadata = get_user_metadata(metadata, shadow) if self.attachMetadata else None
+            companion = len(metadata) > 0 and userMetadata is None
+            if companion and self.metafileMode == 'disable':
+                if not self.attachMetadata:
+                    raise ValueError('Metadata cannot be stored: attachMetadataToObject is false and metafileMode is disable')
+                raise ValueError('Metadata does not fit in S3 user metadata and metafileMode is disable')
+            if companion and self.resolver.get_stem(key, self.resolver.dataPrefix) is None:
+                raise ValueError('Key {} is not under the data prefix {}, so it cannot have a companion metadata file'.format(key, self.resolver.dataPrefix))
+
+            if companion and self.metafileMode == 'written_first':
+                self.put_metafile(key, metadata)
+            extraArgs = {'ContentType': contentType}
+            if userMetadata:
+                extraArgs['Metadata'] = userMetadata
+            self.s3.upload_file(path, self.bucket, key, ExtraArgs=extraArgs, Config=self.transferConfig)
+            if companion and self.metafileMode == 'written_last':
+                self.put_metafile(key, metadata)
+
+            with self.lock:
+                self.stats['uploaded'] += 1
+                self.stats['bytes'] += os.path.getsize(path)
+            return True
+        except Exception as e:
+            logging.error(e)
+            logging.error('Error uploading file ' + path)
+            with self.lock:
+                self.stats['failed'] += 1
+            return False
+
+    def run(self, files):
+        '''
+        Upload files, a list of (path, key, metadata) tuples
+
+        Returns: dictionary of the numbers of files uploaded and failed, the bytes uploaded, the elapsed seconds
+        and the throughput in MB/s
+        '''
+        startTime = time.time()
+        pool = ThreadPool(self.workers)
+        try:
+            pool.map(lambda args: self.upload_file(*args), files, chunksize=1)
+        finally:
+            pool.close()
+
+        stats = dict(self.stats)
+        stats['seconds'] = time.time() - startTime
+        stats['MBps'] = stats['bytes'] / (1024.0 * 1024.0) / max(stats['seconds'], 0.001)
+        logging.info('Uploaded: {uploaded} Failed: {failed} ({bytes} bytes in {seconds:.1f} seconds, {MBps:.1f} MB/s)'.format(**stats))
+        return stats
+
+def find_files(paths, prefix, metadata, sidecar):
+    '''
+    Returns: list of (path, key, metadata) tuples for the files at paths (and in the directories at paths).
+    Files ending with sidecar are read as metadata for the file they are next to rather than uploaded (files ending
+    with sidecar that are not next to a data file are data files themselves).
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = [(os.path.join(root, name), os.path.relpath(os.path.join(root, name), path))
+                    for (root, dirs, names) in os.walk(path) for name in names]
+        else:
+            found = [(path, os.path.basename(path))]
+        for (filePath, relPath) in sorted(found):
+            if is_sidecar(filePath, sidecar):
+                continue
+            fileMetadata = dict(metadata)
+            if sidecar and os.path.isfile(filePath + sidecar):
+                with open(filePath + sidecar, 'r') as f:
+                    fileMetadata.update(json.loads(f.read()))
+            files.append((filePath, prefix + relPath.replace(os.sep, '/'), fileMetadata))
+    return files
+
+def main():
+    parser = argparse.ArgumentParser(description='Upload files with their metadata into the habitat bucket')
+    parser.add_argument('paths', nargs='+', help='Files or directories to upload')
+    parser.add_argument('--metadata', default='{}', help='Metadata for all of the files as a JSON object')
+    parser.add_argument('--sidecar', default='.json', help='Suffix of local JSON metadata files next to the data files (empty to disable)')
+    parser.add_argument('--prefix', default=None, help='Key prefix to upload to (default: the data prefix, data/)')
+    parser.add_argument('--workers', type=int, default=DefaultWorkers, help='Number of files to upload at once')
+    parser.add_argument('--part-threads', type=int, default=DefaultPartThreads, help='Number of parts of a large file to upload at once')
+    args = parser.parse_args()
+
+    configs = configutils.load_configs()
+    uploader = Uploader(boto3.client('s3', region_name=configs['region']), configs, args.prefix, args.workers, args.part_threads)
+    files = find_files(args.paths, uploader.prefix, json.loads(args.metadata), args.sidecar)
+    print json.dumps(uploader.run(files), indent=4)
+
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    def setUp(self):
+        self.configs = configutils.load_configs()
+        self.key = 'data/unittest-upload-a1234-15-imager_1234567890.tif'
+
+    def test_get_user_metadata(self):
+        self.assertEqual(get_user_metadata({'assayid': 'a1234', 'plate': 7}), {'assayid': 'a1234', 'plate': '7'})
+        self.assertEqual(get_user_metadata({'assayid': 'a1234'}, True), {'assayid': 'a1234', objectmeta.ShadowMarker: '1'})
+        self.assertIsNone(get_user_metadata({'note': u'\u00b5m'}), 'Non-ASCII metadata cannot be user metadata')
+        self.assertIsNone(get_user_metadata({'note': 'x' * MaxUserMetadataBytes}), 'Metadata is too large for user metadata')
+
+    def test_find_files(self):
+        files = find_files(['unittest-samplemetadata.json'], 'data/', {'assayid': 'a1234'}, '')
+        self.assertEqual(files, [('unittest-samplemetadata.json', 'data/unittest-samplemetadata.json', {'assayid': 'a1234'})])
+
+    def test_upload_inline_metadata(self):
+        ''' The metadata is attached to the object on upload '''
+        configs = dict(self.configs)
+        configs['attachMetadataToObject'] = True
+        s3 = boto3.client('s3', region_name=configs['region'])
+        uploader = Uploader(s3, configs, workers=2)
+        stats = uploader.run([('unittest-sampledata.tif', self.key, {'assayid': 'a1234'})])
+        self.assertEqual((stats['uploaded'], stats['failed']), (1, 0))
+        response = s3.head_object(Bucket=configs['bucket'], Key=self.key)
+        self.assertEqual(response['Metadata'].get('assayid', None), 'a1234')
+        s3.delete_object(Bucket=configs['bucket'], Key=self.key)
+
+    def test_companion_format(self):
+        ''' Companion metadata files are written in the format (and with the extension) that the indexer reads '''
+        class RecordingS3(object):
+            def __init__(self):
+                self.objects = {}
+            def put_object(self, Bucket, Key, Body, ContentType):
+                self.objects[Key] = Body
+        configs = {'bucket': 'mybucket', 'metafileMode': 'written_first', 'metafileFormat': 'csv'}
+        s3 = RecordingS3()
+        Uploader(s3, configs).put_metafile('data/run1/a.tif', {'assayid': 'a1234', 'runid': 15})
+        data = s3.objects['meta/run1/a.csv']
+        self.assertEqual(metafile.parse_metafile_data(data, 'csv', None), {'assayid': 'a1234', 'runid': '15'})
+
+        configs = {'bucket': 'mybucket', 'metafileMode': 'written_last', 'metafileFormat': 'json', 'metafileExtensions': ['xml', 'json']}
+        Uploader(s3, configs).put_metafile('data/run1/b.tif', {'assayid': 'a1234'})
+        self.assertEqual(json.loads(s3.objects['meta/run1/b.json']), {'assayid': 'a1234'})
+
+        self.assertRaises(ValueError, Uploader, s3, dict(configs, metafileFormat='custom'))
+        self.assertRaises(ValueError, metafile.format_metafile_data, {'note': 'a, b'}, 'csv')
+
+    def test_content_type(self):
+        ''' Files are uploaded with the content type that they were parsed by, so content type routes match in the index too '''
+        class RecordingS3(object):
+            def __init__(self):
+                self.extraArgs = {}
+            def upload_file(self, path, bucket, key, ExtraArgs, Config):
+                self.extraArgs[key] = ExtraArgs
+        configs = {'bucket': 'mybucket', 'attachMetadataToObject': True,
+                'dataBodyParsers': [{'module': 'defaultDataBodyParser', 'contentType': 'image/tiff', 'maxBytes': 1024}]}
+        s3 = RecordingS3()
+        uploader = Uploader(s3, configs)
+        uploader.run([('unittest-sampledata.tif', 'data/a.tif', {'assayid': 'a1234'}), ('unittest-samplemetadata.json', 'data/b.dat', {})])
+        self.assertEqual(s3.extraArgs['data/a.tif'], {'ContentType': 'image/tiff', 'Metadata': {'assayid': 'a1234'}},
+                'Expected no shadow marker, since the image/tiff route parses the body')
+        self.assertEqual(s3.extraArgs['data/b.dat'], {'ContentType': 'application/json', 'Metadata': {objectmeta.ShadowMarker: '1'}})
+
+    def test_metadata_not_stored(self):
+        ''' An upload with metadata fails, naming the cause, when the configs store the metadata nowhere '''
+        class RecordingS3(object):
+            def __init__(self):
+                self.keys = []
+            def upload_file(self, path, bucket, key, ExtraArgs, Config):
+                self.keys.append(key)
+        class RecordingHandler(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.messages = []
+            def emit(self, record):
+                self.messages.append(record.getMessage())
+        s3 = RecordingS3()
+        handler = RecordingHandler()
+        logging.getLogger().addHandler(handler)
+        try:
+            stats = Uploader(s3, {'bucket': 'mybucket'}).run([('unittest-sampledata.tif', 'data/a.tif', {'assayid': 'a1234'}),
+                    ('unittest-sampledata.tif', 'data/b.tif', {})])
+        finally:
+            logging.getLogger().removeHandler(handler)
+        self.assertEqual((stats['uploaded'], stats['failed'], s3.keys), (1, 1, ['data/b.tif']))
+        self.assertIn('Metadata cannot be stored: attachMetadataToObject is false and metafileMode is disable', handler.messages)
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    logFormat = '%(levelname)s:%(asctime)s:HABITAT:%(module)s-%(lineno)d: %(message)s'
+    logLevel = logging.INFO
+    logging.basicConfig(format=logFormat, level=logLevel)
+
+    main()
@@ -0,0 +1,378 @@
+'''
+File: watchfolder.py
+
+Daemon that uploads the files dropped into local directories (e.g., the output directory of an instrument PC)
+into the habitat bucket, so that data is stored just by writing it to a folder.
+
+A file is uploaded once it has settled: its size and modification time have not changed for settleSeconds, so
+files that are still being written are not uploaded half way. New files are found with inotify when pyinotify is
+installed (Linux), and otherwise by scanning the directories every pollSeconds.
+
+The metadata is extracted locally before the upload, with the same file name routes (filenamemeta) and body
+parser plugins (pluginregistry) as the Lambda function, plus an optional local json sidecar file (as for upload).
+It is attached to the object on upload (see upload and attachMetadataToObject) and marked as a complete shadow
+copy, so the index does not have to read the body back from S3. Extraction and upload run on a pool of workers,
+so one file is parsed while others are being uploaded, and large files are uploaded as parallel multipart uploads.
+
+Uploaded files are moved into doneDir (keeping their relative paths) or deleted, if either is given.
+Otherwise they are left in place and remembered for as long as the daemon runs.
+
+Usage:
+    python -m watchfolder [--prefix data/] [--settle 5] [--done-dir <dir> | --delete] [--workers 16] <directory>...
+
+   Copyright 2016 Novartis Institutes for BioMedical Research
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+'''
+
+import unittest
+import logging
+import argparse
+import threading
+import tempfile
+import shutil
+import json
+import time
+import os
+import boto3
+import configutils
+import filenamemeta
+import objectmeta
+import pluginregistry
+import upload
+from multiprocessing.pool import ThreadPool
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+DefaultSettleSeconds = 5.0 # A file must be unchanged for this long before it is uploaded
+DefaultPollSeconds = 1.0 # How often settled files are looked for (and the directories scanned without inotify)
+IgnoredSuffixes = ('.tmp', '.part', '.partial', '.crdownload', '~') # Files that are still being written elsewhere
+
+class LocalBody(object):
+    ''' A local file with the read interface of objectmeta.RangedBody, so that body parser plugins can run on it '''
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+
+    def read_range(self, start, end):
+        ''' Return bytes start through end (inclusive, as in HTTP) of the file '''
+        end = min(end, self.size - 1)
+        if start > end:
+            return ''
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start + 1)
+
+    def read_prefix(self, nbytes):
+        return self.read_range(0, nbytes - 1)
+
+    def read_tail(self, nbytes):
+        if nbytes <= 0:
+            return ''
+        return self.read_range(max(0, self.size - nbytes), self.size - 1)
+
+def get_local_attributes(path, key, configs, sidecar=None):
+    '''
+    Extract the metadata for the file at path, to be uploaded to key, as the Lambda function would from the
+    key and the object body, and from the sidecar file next to it (which takes precedence).
+
+    Returns: dictionary of the attributes
+    '''
+    attributes = {}
+    router = filenamemeta.get_router(configs)
+    if router is not None:
+        attributes.update(router.get_attributes(key) or {})
+
+    registry = pluginregistry.get_registry(configs)
+    route = registry.select(key, upload.get_content_type(path))
+    if route is not None:
+        objectmeta.get_body_attributes_from_ranges(LocalBody(path), route, attributes)
+
+    if sidecar and os.path.isfile(path + sidecar):
+        with open(path + sidecar, 'r') as f:
+            attributes.update(json.loads(f.read()))
+    return attributes
+
+def is_ignored(path, sidecar):
+    ''' Returns: True if the file at path is not uploaded: hidden, still being written, or a sidecar (see upload.is_sidecar) '''
+    name = os.path.basename(path)
+    return name.startswith('.') or name.endswith(IgnoredSuffixes) or upload.is_sidecar(path, sidecar)
+
+class WatchFolder(object):
+    '''
+    Uploads the files that settle in directories with uploader (an upload.Uploader), under its prefix.
+
+    Files are tracked in pending (path -> [size, mtime, time of the last change]) until they have settled, and
+    then handed to the workers. handled remembers the (size, mtime) of the files that were uploaded and kept in place.
+    '''
+    def __init__(self, uploader, configs, directories, settleSeconds=DefaultSettleSeconds, pollSeconds=DefaultPollSeconds,
+            sidecar='.json', doneDir=None, delete=False):
+        self.uploader = uploader
+        self.configs = configs
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self.settleSeconds = settleSeconds
+        self.pollSeconds = pollSeconds
+        self.sidecar = sidecar
+        self.doneDir = os.path.abspath(doneDir) if doneDir is not None else None
+        self.delete = delete
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.inFlight = set()
+        self.handled = {}
+        self.pool = ThreadPool(uploader.workers)
+        self.stats = {'uploaded': 0, 'failed': 0}
+
+    def get_key(self, path):
+        for directory in self.directories:
+            if path.startswith(directory + os.sep):
+                return self.uploader.prefix + os.path.relpath(path, directory).replace(os.sep, '/')
+        return None
+
+    def touch(self, path):
+        ''' Note a change to the file at path (restarting its settle time) '''
+        if is_ignored(path, self.sidecar):
+            with self.lock:
+                self.pending.pop(path, None) # e.g., a sidecar that was written before its data file
+            return
+        if self.doneDir is not None and os.path.abspath(path).startswith(self.doneDir + os.sep):
+            return # Uploaded already and moved into doneDir (which may be inside a watched directory)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return # Removed again (or moved away by us)
+        signature = (stat.st_size, stat.st_mtime)
+        with self.lock:
+            if path in self.inFlight or self.handled.get(path, None) == signature:
+                return
+            entry = self.pending.get(path, None)
+            if entry is None or (entry[0], entry[1]) != signature:
+                self.pending[path] = [signature[0], signature[1], time.time()]
+
+    def scan(self):
+        ''' Look at every file under the directories '''
+        for directory in self.directories:
+            for (root, dirs, names) in os.walk(directory):
+                if self.doneDir is not None:
+                    dirs[:] = [name for name in dirs if os.path.join(root, name) != self.doneDir]
+                for name in names:
+                    self.touch(os.path.join(root, name))
+
+    def get_settled(self):
+        ''' Returns: the pending files that have not changed for settleSeconds, removing them from pending '''
+        now = time.time()
+        settled = []
+        for path in list(self.pending):
+            self.touch(path) # A file that is still growing restarts its settle time
+            with self.lock:
+                entry = self.pending.get(path, None)
+                if entry is None:
+                    continue
+                if not os.path.isfile(path):
+                    del self.pending[path]
+                elif now - entry[2] >= self.settleSeconds:
+                    del self.pending[path]
+                    self.inFlight.add(path)
+                    settled.append((path, (entry[0], entry[1])))
+        return settled
+
+    def handle_file(self, path, signature):
+        ''' Extract the metadata for the settled file at path locally and upload the file with it '''
+        ok = False
+        try:
+            key = self.get_key(path)
+            attributes = get_local_attributes(path, key, self.configs, self.sidecar)
+            ok = self.uploader.upload_file(path, key, attributes, complete=True)
+            if ok:
+                self.finish(path, signature)
+        except Exception as e:
+            logging.error(e)
+            logging.error('Error handling file ' + path)
+        with self.lock:
+            self.inFlight.discard(path)
+            self.stats['uploaded' if ok else 'failed'] += 1
+        if not ok:
+            self.touch(path) # Try again after it settles again
+        return ok
+
+    def finish(self, path, signature):
+        ''' Move, delete or remember the uploaded file (and its sidecar) '''
+        paths = [path] + ([path + self.sidecar] if self.sidecar and os.path.isfile(path + self.sidecar) else [])
+        if self.doneDir is not None:
+            for filePath in paths:
+                donePath = os.path.join(self.doneDir, os.path.relpath(filePath, self.get_directory(path)))
+                if not os.path.isdir(os.path.dirname(donePath)):
+                    try:
+                        os.makedirs(os.path.dirname(donePath))
+                    except OSError:
+                        pass # Made by another worker
+                shutil.move(filePath, donePath)
+        elif self.delete:
+            for filePath in paths:
+                os.remove(filePath)
+        else:
+            with self.lock:
+                self.handled[path] = signature
+
+    def get_directory(self, path):
+        return [directory for directory in self.directories if path.startswith(directory + os.sep)][0]
+
+    def run_once(self, scan=True):
+        '''
+        Find new files (if scan) and submit the settled ones to the workers.
+
+        Returns: list of AsyncResults for the submitted files
+        '''
+        if scan:
+            self.scan()
+        return [self.pool.apply_async(self.handle_file, settled) for settled in self.get_settled()]
+
+    def start_notifier(self):
+        ''' Watch the directories with inotify. Returns: the notifier, or None if pyinotify is not installed '''
+        if pyinotify is None:
+            return None
+        watchFolder = self
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if not event.dir:
+                    watchFolder.touch(event.pathname)
+        manager = pyinotify.WatchManager()
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MODIFY | pyinotify.IN_CREATE
+        for directory in self.directories:
+            manager.add_watch(directory, mask, rec=True, auto_add=True)
+        notifier = pyinotify.ThreadedNotifier(manager, Handler())
+        notifier.daemon = True
+        notifier.start()
+        return notifier
+
+    def run(self):
+        ''' Upload settled files until interrupted '''
+        notifier = self.start_notifier()
+        logging.info('Watching {} ({})'.format(', '.join(self.directories), 'inotify' if notifier else 'polling'))
+        self.scan() # Files that were dropped while the daemon was not running
+        try:
+            while True:
+                self.run_once(scan=notifier is None)
+                time.sleep(self.pollSeconds)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if notifier is not None:
+                notifier.stop()
+            self.pool.close()
+            self.pool.join()
+            logging.info('Uploaded: {uploaded} Failed: {failed}'.format(**self.stats))
+
+def main():
+    parser = argparse.ArgumentParser(description='Upload the files dropped into local directories into the habitat bucket')
+    parser.add_argument('directories', nargs='+', help='Directories to watch')
+    parser.add_argument('--prefix', default=None, help='Key prefix to upload to (default: the data prefix, data/)')
+    parser.add_argument('--settle', type=float, default=DefaultSettleSeconds, help='Seconds a file must be unchanged before it is uploaded')
+    parser.add_argument('--poll', type=float, default=DefaultPollSeconds, help='Seconds between looks for settled files')
+    parser.add_argument('--sidecar', default='.json', help='Suffix of local JSON metadata files next to the data files (empty to disable)')
+    parser.add_argument('--done-dir', default=None, help='Directory to move uploaded files into')
+    parser.add_argument('--delete', action='store_true', help='Delete uploaded files')
+    parser.add_argument('--workers', type=int, default=upload.DefaultWorkers, help='Number of files to upload at once')
+    parser.add_argument('--part-threads', type=int, default=upload.DefaultPartThreads, help='Number of parts of a large file to upload at once')
+    args = parser.parse_args()
+
+    configs = configutils.load_configs()
+    configs['attachMetadataToObject'] = True
+    uploader = upload.Uploader(boto3.client('s3', region_name=configs['region']), configs, args.prefix, args.workers, args.part_threads)
+    WatchFolder(uploader, configs, args.directories, args.settle, args.poll, args.sidecar, args.done_dir, args.delete).run()
+
+
+#############
+# unittests #
+#############
+class TestController(unittest.TestCase):
+    class RecordingUploader(object):
+        ''' Records the uploads instead of making them '''
+        def __init__(self):
+            self.prefix = 'data/'
+            self.workers = 2
+            self.uploads = []
+
+        def upload_file(self, path, key, metadata, complete=False):
+            self.uploads.append((key, metadata))
+            return True
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.configs = {'dataFilenameRegex': '^data/(?P<assayId>a[0-9]+)-(?P<runId>[0-9]+)',
+                'dataBodyParsers': [{'module': 'defaultDataBodyParser', 'suffix': '.txt'}]}
+        self.uploader = self.RecordingUploader()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            f.write(data)
+
+    def test_settle(self):
+        ''' A file is only uploaded once it has stopped changing, and only once '''
+        watchFolder = WatchFolder(self.uploader, self.configs, [self.directory], settleSeconds=0.2)
+        self.write('a1234-15.tif', 'partial')
+        self.write('a1234-15.tif.part', 'ignored')
+        self.assertEqual(watchFolder.run_once(), [], 'Unsettled file was uploaded')
+        time.sleep(0.3)
+        [result.get() for result in watchFolder.run_once()]
+        self.assertEqual([key for (key, metadata) in self.uploader.uploads], ['data/a1234-15.tif'])
+        self.assertEqual(self.uploader.uploads[0][1], {'assayId': 'a1234', 'runId': '15'})
+        time.sleep(0.3)
+        self.assertEqual(watchFolder.run_once(), [], 'Unchanged file was uploaded again')
+
+    def test_done_dir_inside_directory(self):
+        ''' Files moved into a doneDir inside a watched directory are not uploaded again (as notified by inotify) '''
+        doneDir = os.path.join(self.directory, 'done')
+        watchFolder = WatchFolder(self.uploader, self.configs, [self.directory], settleSeconds=0, doneDir=doneDir)
+        self.write('a1234-15.tif', 'data')
+        [result.get() for result in watchFolder.run_once()]
+        donePath = os.path.join(doneDir, 'a1234-15.tif')
+        self.assertTrue(os.path.isfile(donePath), 'Expected the uploaded file to be moved into doneDir')
+        watchFolder.touch(donePath) # The IN_MOVED_TO event of the move
+        self.assertEqual(watchFolder.run_once(scan=False), [], 'File in doneDir was uploaded again')
+        self.assertEqual(len(self.uploader.uploads), 1)
+
+    def test_sidecar(self):
+        ''' Sidecar files are not uploaded, but files with the sidecar suffix and no data file next to them are '''
+        watchFolder = WatchFolder(self.uploader, self.configs, [self.directory], settleSeconds=0)
+        self.write('a1234-15.txt.json', '{"operator": "jdoe"}')
+        self.write('a1234-15.txt', 'body')
+        self.write('a1234-16.json', '{"runId": 16}')
+        [result.get() for result in watchFolder.run_once()]
+        self.assertEqual(sorted(key for (key, metadata) in self.uploader.uploads), ['data/a1234-15.txt', 'data/a1234-16.json'])
+
+    def test_local_attributes(self):
+        ''' Body parser plugins and sidecar files run on the local file '''
+        self.write('a1234-15.txt', 'body')
+        self.write('a1234-15.txt.json', '{"operator": "jdoe"}')
+        attributes = get_local_attributes(os.path.join(self.directory, 'a1234-15.txt'), 'data/a1234-15.txt', self.configs, '.json')
+        self.assertEqual((attributes['assayId'], attributes['operator']), ('a1234', 'jdoe'))
+
+def AllModuleTests():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestController)
+    return unittest.TestSuite([suite1])
+
+########
+# MAIN #
+########
+if __name__ == '__main__':
+    logFormat = '%(levelname)s:%(asctime)s:HABITAT:%(module)s-%(lineno)d: %(message)s'
+    logLevel = logging.INFO
+    logging.basicConfig(format=logFormat, level=logLevel)
+
+    main()